@@ -1,25 +1,42 @@
 import os
 import io
+import time
+import asyncio
+import uuid
 import torch
 import json
 import shutil
-from typing import List
+from typing import List, Optional
 from datetime import datetime
-from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, File, UploadFile, Form, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from PIL import Image
 
 # Local imports
 import config
-from engine import ImageCaptioningEngine
+import metrics
+import profiling
+import scheduler
+import decoding
+from model_registry import ModelRegistry
+from embedding_index import VersionedEmbeddingStore
+from card_cache import CardCache
 from pdf_generator import generate_defect_pdf
+import database
 from database import create_db_and_tables, get_session
 from models import DefectRecord, Project
+import sync
+import http_cache
+import export
+import ingest
+import recaption
+import maintenance
+import archive
 
 # SQLModel
 from sqlmodel import Session, select
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, Header
 from contextlib import asynccontextmanager
 from fastapi.staticfiles import StaticFiles
 
@@ -27,10 +44,24 @@ from fastapi.staticfiles import StaticFiles
 UPLOADS_DIR = os.path.join(config.BACKEND_DIR, "outputs", "uploads")
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
+# Pooled encoder embeddings of every captioned photo (near-duplicates, similar-defect search), per model version
+embedding_stores = VersionedEmbeddingStore(
+    os.path.join(config.BACKEND_DIR, "embeddings"), nprobe=config.EMBEDDING_NPROBE, legacy_version=config.MODEL_VERSION
+)
+report_cards = CardCache(config.REPORT_CARD_CACHE_DIR, config.REPORT_CARD_CACHE_MB * 1024 * 1024)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     create_db_and_tables()
+    ingest_worker.start()
+    maintenance_scheduler.start()
+    model_registry.watch_traffic(config.MODEL_TRAFFIC_POLL_SECONDS)
     yield
+    ingest_worker.stop()
+    maintenance_scheduler.stop()
+    model_registry.stop_watching()
+    if recaption_job is not None:
+        recaption_job.stop()
 
 app = FastAPI(title="House Defect AI Service", lifespan=lifespan)
 
@@ -45,9 +76,192 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # Use the route template (e.g. /defects/{defect_id}) to keep label cardinality bounded
+    route = request.scope.get("route")
+    endpoint = getattr(route, "path", "unmatched")
+    metrics.REQUESTS_TOTAL.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+    return response
+
+@app.middleware("http")
+async def attach_request_id(request, call_next):
+    request_id = request.headers.get("x-request-id")
+    if not profiling.is_valid_request_id(request_id):
+        request_id = uuid.uuid4().hex
+    request.state.request_id = request_id
+
+    # Profiling is opt-in; the common path does not touch the profiler at all
+    if profiling.should_profile(request.url.path, request.headers):
+        # Our own id, so no client can pick (or overwrite) another's profile directory
+        profile_id = uuid.uuid4().hex
+        try:
+            deferred = request.url.path in profiling.SCHEDULED_PATHS
+            with profiling.capture(profile_id, deferred=deferred):
+                response = await call_next(request)
+        except profiling.ProfilerBusy as e:
+            response = JSONResponse(status_code=409, content={"detail": str(e)})
+        else:
+            response.headers["X-Profile-Id"] = profile_id
+    else:
+        response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
 # Initialize Engine
-print("⏳ Loading AI Model into memory...")
-engine = ImageCaptioningEngine()
+if config.INFERENCE_SOCKET:
+    # Shared model mode: this worker only preprocesses, the inference server owns the weights
+    from inference_server import RemoteEngine, configure_torch_threads
+    configure_torch_threads(intra_op=1)
+    print(f"🔌 Using inference server at {config.INFERENCE_SOCKET}")
+    model_registry = ModelRegistry()
+    model_registry.add(config.MODEL_VERSION, RemoteEngine(config.INFERENCE_SOCKET))
+else:
+    from inference_server import configure_torch_threads
+    configure_torch_threads(config.TORCH_INTRA_OP_THREADS, config.TORCH_INTER_OP_THREADS)
+    print("⏳ Loading AI Model into memory...")
+    model_registry = ModelRegistry(
+        config.MODEL_VERSIONS_DIR,
+        max_resident=config.MAX_RESIDENT_MODELS,
+        memory_budget=config.MODEL_MEMORY_BUDGET_MB * 1024 * 1024,
+        warmup=decoding.PROFILES.values(),
+        traffic_file=config.MODEL_TRAFFIC_FILE,
+    )
+    model_registry.register(config.MODEL_VERSION, config.MODEL_PATH)
+try:
+    # A split saved by PUT /models/traffic outlives restarts
+    restored = model_registry.reload_traffic()
+except Exception as e:
+    print(f"⚠️ Saved model traffic not applied: {e}")
+    restored = False
+if not restored:
+    model_registry.set_traffic({config.MODEL_VERSION: 100}, persist=False)
+
+
+def find_duplicates(project_ids, embeddings, model_version):
+    """
+    For each new photo, the (defect_id, caption, confidence) of an existing photo in
+    the same project, captioned by the same model version, that it nearly duplicates,
+    or None if it needs a fresh caption.
+    """
+    matches = [None] * len(embeddings)
+    if config.NEAR_DUPLICATE_THRESHOLD > 1:
+        return matches
+    store = embedding_stores.store(model_version)
+    hits = [store.nearest(p, e) for p, e in zip(project_ids, embeddings)]
+    hits = [h if h and h[1] >= config.NEAR_DUPLICATE_THRESHOLD else None for h in hits]
+    ids = {h[0] for h in hits if h}
+    if not ids:
+        return matches
+    with Session(database.engine) as session:
+        rows = session.exec(
+            select(DefectRecord.id, DefectRecord.caption, DefectRecord.confidence).where(DefectRecord.id.in_(ids))
+        ).all()
+    existing = {row[0]: tuple(row) for row in rows}
+    for i, hit in enumerate(hits):
+        # The store can briefly lag a deleted record; only reuse captions that still exist
+        if hit and hit[0] in existing and existing[hit[0]][1]:
+            matches[i] = existing[hit[0]]
+    return matches
+
+
+def _caption_batch(items, priority, model_version, on_tokens=None, reuse=True, deadline=None, **params):
+    """
+    Scheduler batch runner: items are {"image", "project_id"} dicts, results
+    {"caption", "embedding", "reused_from", "model_version"}. Jobs only share a
+    batch when they were routed to the same model version. reuse=False always
+    decodes, even for near-duplicates of stored photos. `deadline` (socket mode
+    only) is passed on to the inference server.
+    """
+    images = [item["image"] for item in items]
+    engine = model_registry.get(model_version)
+    if config.INFERENCE_SOCKET:
+        # The inference server schedules across workers too, so pass the class and time left along.
+        # Partial tokens, embeddings and tiles are not sent over the socket; streams get the final caption only.
+        params.pop("tiled", None)
+        deadline_ms = None if deadline is None else max(1, int((deadline - time.monotonic()) * 1000))
+        results = engine.caption_batch(images, priority=priority, deadline_ms=deadline_ms, **params)
+    else:
+        if on_tokens is not None:
+            params["on_tokens"] = on_tokens
+        project_ids = [item["project_id"] for item in items]
+        match = (lambda embeddings: find_duplicates(project_ids, embeddings, model_version)) if reuse else None
+        results = engine.caption_batch(images, reuse=match, **params)
+    for result in results:
+        result["model_version"] = model_version
+    return results
+
+
+inference_scheduler = scheduler.InferenceScheduler(
+    _caption_batch,
+    max_batch=config.SCHEDULER_MAX_BATCH,
+    bulk_max_batch=config.SCHEDULER_BULK_MAX_BATCH,
+    forward_deadline=bool(config.INFERENCE_SOCKET),
+).start()
+profile_selector = decoding.AdaptiveProfileSelector(
+    queue_thresholds=config.PROFILE_FALLBACK_QUEUE_DEPTH,
+    latency_thresholds=config.PROFILE_FALLBACK_LATENCY,
+)
+
+
+def choose_profile(requested):
+    """Validate the requested profile and step it down if the service is under load."""
+    requested = requested or config.DEFAULT_DECODING_PROFILE
+    try:
+        return profile_selector.select(requested, metrics.QUEUE_DEPTH.get())
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+async def schedule_caption(request, image, project_id, priority, deadline_ms, profile, model_version=None,
+                           on_tokens=None, tiled=False):
+    """
+    Queue one image on the scheduler and wait for its result ({"caption",
+    "embedding", "reused_from", "model_version"}, plus "regions" when tiled).
+    The model version comes from the registry's traffic split unless given. The job is cancelled if the
+    client disconnects (pass request=None to skip that check) or the deadline
+    passes while queued.
+    """
+    if priority not in scheduler.PRIORITIES:
+        raise HTTPException(status_code=422, detail=f"priority must be one of {sorted(scheduler.PRIORITIES)}")
+    if deadline_ms is None and priority == "interactive":
+        deadline_ms = config.INTERACTIVE_DEADLINE_MS
+    deadline = scheduler.deadline_from_ms(deadline_ms)
+
+    started = time.perf_counter()
+    # Tiled jobs only batch with other tiled jobs; untiled params stay as before
+    extra = {"tiled": True} if tiled else {}
+    future = inference_scheduler.submit(
+        [{"image": image, "project_id": project_id}],
+        priority=priority, deadline=deadline, on_tokens=on_tokens, wrap=profiling.pending(),
+        model_version=model_version or model_registry.choose(), **decoding.get_profile(profile), **extra
+    )
+    waiter = asyncio.wrap_future(future)
+    while True:
+        try:
+            done, _ = await asyncio.wait({waiter}, timeout=0.25)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        if done:
+            break
+        if future.running():
+            continue
+        if request is not None and await request.is_disconnected():
+            future.cancel()
+            raise HTTPException(status_code=499, detail="Client disconnected")
+        if deadline is not None and time.monotonic() >= deadline:
+            # Left queued: the scheduler drops it unrun and counts it under "deadline"
+            raise HTTPException(status_code=504, detail="Deadline passed before the image was captioned")
+    try:
+        result = waiter.result()[0]
+        profile_selector.observe(time.perf_counter() - started)
+        return result
+    except scheduler.DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
 
 # --- API Endpoints ---
 
@@ -56,17 +270,209 @@ def status():
     return {
         "status": "online", 
         "model": "ViT-GPT2 Thai",
-        "device": config.DEVICE
+        "device": config.DEVICE,
+        "queue": inference_scheduler.pending(),
+        "ingest_pending": ingest.pending_count(database.engine)
     }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus text exposition of per-stage latencies, counters and gauges."""
+    return PlainTextResponse(metrics.render_latest(), media_type="text/plain; version=0.0.4")
+
+# --- Profiling Traces ---
+
+def require_admin(x_admin_token: str = Header(None)):
+    if not profiling.is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.get("/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def get_profile(profile_id: str):
+    if not profiling.is_valid_request_id(profile_id):
+        raise HTTPException(status_code=400, detail="Invalid profile id")
+    artifacts = profiling.list_artifacts(profile_id)
+    if not artifacts:
+        raise HTTPException(status_code=404, detail="No profile for this request")
+    return {"profile_id": profile_id, "artifacts": artifacts}
+
+@app.get("/profiles/{profile_id}/{artifact}", dependencies=[Depends(require_admin)])
+def download_profile(profile_id: str, artifact: str):
+    if not profiling.is_valid_request_id(profile_id):
+        raise HTTPException(status_code=400, detail="Invalid profile id")
+    if artifact not in profiling.list_artifacts(profile_id):
+        raise HTTPException(status_code=404, detail="Profile artifact not found")
+    return FileResponse(
+        os.path.join(profiling.profile_dir(profile_id), artifact),
+        filename=f"{profile_id}_{artifact}"
+    )
+
+# --- Model Registry ---
+
+@app.get("/models", dependencies=[Depends(require_admin)])
+def list_models():
+    return model_registry.status()
+
+@app.post("/models/{version}/load", status_code=202, dependencies=[Depends(require_admin)])
+def load_model(version: str):
+    """Start loading a checkpoint in the background so a later traffic switch is instant."""
+    try:
+        model_registry.load(version)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"loading": version}
+
+@app.put("/models/traffic", dependencies=[Depends(require_admin)])
+def set_model_traffic(weights: dict):
+    """
+    Switch or split caption traffic, e.g. {"base": 90, "retrain-2024-06": 10}.
+    Returns once every target is loaded; requests already queued keep their model.
+    Other workers follow within MODEL_TRAFFIC_POLL_SECONDS.
+    """
+    unknown = [v for v in weights if v not in model_registry.versions()]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Unknown model versions: {unknown}")
+    try:
+        return {"traffic": model_registry.set_traffic(weights)}
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+# --- Re-captioning ---
+
+# The job this worker started, if any; the others see it through RECAPTION_STATE_FILE
+recaption_job = None
+
+def _recaption_status():
+    """This worker's running job, else the last job any worker ran (404 if none)."""
+    if recaption_job is not None and recaption_job.state == "running":
+        return recaption_job.status()
+    status = recaption.load_state(config.RECAPTION_STATE_FILE)
+    if status is None and recaption_job is not None:
+        status = recaption_job.status()
+    if status is None:
+        raise HTTPException(status_code=404, detail="No re-caption job")
+    return status
+
+def _caption_recaption(items, model_version):
+    # Every record being re-captioned is in the embedding store already, so reuse would
+    # just hand back its own old caption
+    future = inference_scheduler.submit(
+        items, priority="bulk", model_version=model_version, reuse=False,
+        **decoding.get_profile(config.RECAPTION_PROFILE)
+    )
+    return [{**result, "decoding_profile": config.RECAPTION_PROFILE} for result in future.result()]
+
+@app.post("/recaption", status_code=202, dependencies=[Depends(require_admin)])
+def start_recaption(options: dict):
+    """
+    Re-caption existing defects with `target_version`, e.g.
+    {"target_version": "retrain-2024-06", "project_id": 3, "since": "2024-01-01", "dry_run": true}.
+    Filters: project_id, model_versions (default: anything not already on the target),
+    since/until. Records edited by hand are skipped. A stopped job started again with
+    the same filters resumes where it left off.
+    """
+    global recaption_job
+    if recaption_job is not None and recaption_job.state == "running":
+        raise HTTPException(status_code=409, detail="A re-caption job is already running")
+    target = options.get("target_version")
+    if target not in model_registry.versions():
+        raise HTTPException(status_code=404, detail=f"Unknown model version: {target}")
+    filters = {key: options[key] for key in ("project_id", "model_versions", "since", "until") if options.get(key)}
+    try:
+        recaption.selection(filters, target)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    job = recaption.RecaptionJob(
+        database.engine, _load_pending, _caption_recaption, apply_caption, target,
+        filters=filters, index=index_embedding,
+        batch_size=int(options.get("batch_size") or config.RECAPTION_BATCH_SIZE),
+        rate=float(options.get("rate", config.RECAPTION_RATE)),
+        dry_run=bool(options.get("dry_run")),
+        checkpoint_path=config.RECAPTION_CHECKPOINT,
+        state_file=config.RECAPTION_STATE_FILE,
+    )
+    try:
+        recaption_job = job.start()
+    except recaption.RecaptionBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return recaption_job.status()
+
+@app.get("/recaption", dependencies=[Depends(require_admin)])
+def recaption_status():
+    return _recaption_status()
+
+@app.get("/recaption/diff", response_class=PlainTextResponse, dependencies=[Depends(require_admin)])
+def recaption_diff():
+    """Caption changes a dry run would make, as -/+ line pairs."""
+    if not _recaption_status()["dry_run"]:
+        raise HTTPException(status_code=404, detail="No dry-run re-caption job")
+    if recaption.load_state(config.RECAPTION_STATE_FILE) is None:
+        lines = recaption_job.diff_lines()
+    else:
+        lines = recaption.saved_diff_lines(config.RECAPTION_STATE_FILE)
+    return StreamingResponse(lines, media_type="text/plain; charset=utf-8")
+
+@app.delete("/recaption", dependencies=[Depends(require_admin)])
+def stop_recaption():
+    """Stop after the current batch, in whichever worker runs the job; progress is checkpointed."""
+    if recaption_job is not None and recaption_job.state == "running":
+        recaption_job.stop()
+        return recaption_job.status()
+    status = _recaption_status()
+    if status["state"] == "running":
+        recaption.request_stop(config.RECAPTION_STATE_FILE)
+        status["state"] = "stopping"
+    return status
+
+# --- Maintenance ---
+
+def _run_maintenance(dry_run=False):
+    outputs_dir = os.path.join(config.BACKEND_DIR, "outputs")
+    return maintenance.run_maintenance(
+        database.engine, outputs_dir, os.path.join(config.BACKEND_DIR, "reports"),
+        # The old report generator wrote temp_pdf_*.jpg under whatever directory the server ran in
+        [outputs_dir, os.path.join(os.getcwd(), "outputs"), config.REPORT_CARD_CACHE_DIR],
+        grace_seconds=config.MAINTENANCE_GRACE_SECONDS,
+        # Listed under the archive lock, so a project archived mid-sweep keeps its photos
+        keep=lambda: archive.referenced_images(database.engine, config.ARCHIVE_DIR),
+        lock=archive.lock(config.ARCHIVE_DIR),
+        retention_days=config.REPORT_RETENTION_DAYS,
+        report_max_bytes=config.REPORT_RETENTION_MB * 1024 * 1024,
+        vacuum=config.MAINTENANCE_VACUUM,
+        dry_run=dry_run,
+    )
+
+maintenance_scheduler = maintenance.MaintenanceScheduler(
+    _run_maintenance, config.MAINTENANCE_QUIET_HOURS, config.MAINTENANCE_INTERVAL_HOURS,
+    is_idle=lambda: metrics.QUEUE_DEPTH.get() == 0 and ingest.pending_count(database.engine) == 0,
+    state_file=config.MAINTENANCE_STATE_FILE,
+)
+
+@app.post("/maintenance", dependencies=[Depends(require_admin)])
+def run_maintenance(dry_run: bool = False):
+    """Sweep and compact now instead of waiting for the quiet hours; dry_run only reports what would go."""
+    try:
+        return maintenance_scheduler.run_now(dry_run=dry_run)
+    except maintenance.MaintenanceBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.get("/maintenance", dependencies=[Depends(require_admin)])
+def maintenance_status():
+    """Space reclaimed by the last completed run, whichever worker ran it."""
+    maintenance_scheduler.load_state()
+    if maintenance_scheduler.last_report is None:
+        raise HTTPException(status_code=404, detail="Maintenance has not run yet")
+    return maintenance_scheduler.last_report
+
 # --- Project CRUD ---
 
 @app.get("/projects", response_model=List[Project])
-def get_projects(session: Session = Depends(get_session)):
-    return session.exec(select(Project)).all()
+def get_projects(request: Request, session: Session = Depends(get_session)):
+    return http_cache.json_rows(request, session, select(Project.__table__))
 
 @app.post("/projects", response_model=Project)
 def create_project(project: Project, session: Session = Depends(get_session)):
+    project.archive_path = project.archived_max_defect_id = None
     session.add(project)
     session.commit()
     session.refresh(project)
@@ -83,19 +489,203 @@ def delete_project(project_id: int, session: Session = Depends(get_session)):
     # Ideally should cascade delete defects first
     statement = select(DefectRecord).where(DefectRecord.project_id == project_id)
     defects = session.exec(statement).all()
+    image_paths = [d.image_path for d in defects if d.image_path]
+    archive_path = project.archive_path
     for d in defects:
         session.delete(d)
         
     session.delete(project)
     session.commit()
+    if archive_path:
+        image_paths += archive.remove_archive(config.ARCHIVE_DIR, archive_path)
+    for image_path in image_paths:
+        full_path = os.path.join(config.BACKEND_DIR, "outputs", image_path)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+    embedding_stores.remove_project(project_id)
     return {"success": True, "message": "Project and its defects deleted"}
 
+@app.post("/projects/{project_id}/archive")
+def archive_project(project_id: int):
+    """
+    Move a finished project's defects out of the main database into its own
+    archive file (see archive.py). The project stays listed and readable;
+    restore it before changing anything.
+    """
+    try:
+        moved = archive.archive_project(database.engine, project_id, config.ARCHIVE_DIR)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"success": True, "archived_defects": moved}
+
+@app.post("/projects/{project_id}/restore")
+def restore_project(project_id: int):
+    try:
+        restored = archive.restore_project(database.engine, project_id, config.ARCHIVE_DIR)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"success": True, "restored_defects": restored}
+
+@app.get("/projects/{project_id}/export")
+def export_project(
+    project_id: int,
+    request: Request,
+    images: bool = True, # False exports the manifest only
+    session: Session = Depends(get_session)
+):
+    """
+    Stream a ZIP of the project's photos plus manifest.json/manifest.csv.
+    Supports single byte ranges (with If-Range) so interrupted downloads resume.
+    """
+    project = session.get(Project, project_id)
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    query = select(DefectRecord).where(DefectRecord.project_id == project_id).order_by(DefectRecord.id)
+    if project.archive_path:
+        with archive.shard_session(config.ARCHIVE_DIR, project) as shard:
+            defects = shard.exec(query).all()
+    else:
+        defects = session.exec(query).all()
+    session.close()
+
+    bundle = export.build_project_archive(
+        project, defects, os.path.join(config.BACKEND_DIR, "outputs"), include_images=images
+    )
+    # Strong validator: any edit, delete or file change alters versions, count or size
+    latest = max((d.version or 0 for d in defects), default=0)
+    tag = f'"{project_id}-{project.version or 0}-{latest}-{len(defects)}-{bundle.size}-{int(images)}"'
+    headers = {
+        "ETag": tag,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="project_{project_id}_export.zip"',
+    }
+
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    if if_range is None or if_range == tag:
+        try:
+            byte_range = export.parse_range(request.headers.get("range"), bundle.size)
+        except ValueError:
+            raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{bundle.size}"})
+    if byte_range is None:
+        headers["Content-Length"] = str(bundle.size)
+        return StreamingResponse(bundle.stream(), media_type="application/zip", headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{bundle.size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(bundle.stream(start, end), status_code=206, media_type="application/zip", headers=headers)
+
 # --- Defect Operations ---
 
+async def read_upload(file, durable=False):
+    """
+    Read, decode and store an uploaded photo. Returns (image, safe_filename, save_path).
+    With durable=True the file is fsynced, so it survives a crash once the record is committed.
+    """
+    stage = metrics.PREDICT_STAGE_SECONDS
+    with stage.time(stage="upload_read"):
+        image_data = await file.read()
+    with stage.time(stage="image_decode"):
+        image = Image.open(io.BytesIO(image_data)).convert("RGB")
+
+    # Save image to disk
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    safe_filename = f"{timestamp}_{file.filename}"
+    save_path = os.path.join(UPLOADS_DIR, safe_filename)
+
+    with stage.time(stage="disk_write"):
+        with open(save_path, "wb") as f:
+            f.write(image_data)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+    return image, safe_filename, save_path
+
+def new_defect(filename, safe_filename, project_id, decoding_profile):
+    """An uncaptioned DefectRecord for a stored upload (status "pending" until apply_caption)."""
+    return DefectRecord(
+        filename=filename,
+        caption="",
+        label="detected_defect",
+        confidence=0.0,
+        image_path=f"uploads/{safe_filename}", # Relative to static mount
+        room="General",
+        severity="Low",
+        project_id=project_id,
+        decoding_profile=decoding_profile,
+        status=ingest.PENDING
+    )
+
+def apply_caption(defect, result):
+    defect.caption = result["caption"]
+    # None when it could not be measured (e.g. an old inference server), never a made-up value
+    defect.confidence = result.get("confidence")
+    defect.label = result.get("label") or defect.label
+    # Without a trained defect head severity stays at the model default
+    defect.severity = result.get("severity") or defect.severity
+    defect.duplicate_of = result["reused_from"]
+    defect.model_version = result["model_version"]
+    if "regions" in result:
+        # Untiled results (e.g. re-captioning) keep the regions a tiled upload found
+        defect.regions = result["regions"]
+    if "decoding_profile" in result:
+        # Uploads record their profile up front; re-captions bring the one they ran with
+        defect.decoding_profile = result["decoding_profile"]
+    defect.status = ingest.DONE
+
+def index_embedding(defect, result):
+    if result["embedding"] is None:
+        return
+    try:
+        embedding_stores.add(result["model_version"], defect.id, defect.project_id, result["embedding"])
+    except ValueError as e:
+        # A model version with a different encoder width; its photos are not indexed
+        print(f"⚠️ Embedding not stored: {e}")
+
+def save_defect(session, filename, safe_filename, result, project_id, decoding_profile):
+    """Store the DefectRecord for a captioned upload and index its embedding."""
+    defect = new_defect(filename, safe_filename, project_id, decoding_profile)
+    apply_caption(defect, result)
+    with metrics.PREDICT_STAGE_SECONDS.time(stage="db_commit"):
+        session.add(defect)
+        session.commit()
+        session.refresh(defect)
+    index_embedding(defect, result)
+    return defect
+
+def defect_payload(defect):
+    return {
+        "success": True,
+        "id": defect.id,
+        "filename": defect.filename,
+        "caption": defect.caption,
+        "label": defect.label,
+        "confidence": defect.confidence,
+        "severity": defect.severity,
+        "image_url": f"/static/{defect.image_path}",
+        "timestamp": defect.timestamp,
+        "project_id": defect.project_id,
+        "decoding_profile": defect.decoding_profile,
+        "duplicate_of": defect.duplicate_of,
+        "model_version": defect.model_version,
+        "regions": defect.regions,
+        "status": defect.status
+    }
+
 @app.post("/predict")
 async def predict(
+    request: Request,
     project_id: int = Form(...), # Require project_id
     file: UploadFile = File(...),
+    priority: str = Form("interactive"), # "interactive" or "bulk"
+    deadline_ms: Optional[int] = Form(None), # Give up if still queued after this long
+    profile: Optional[str] = Form(None), # fast-greedy / balanced / quality
+    tiled: bool = Form(False), # Also caption overlapping tiles of large photos
     session: Session = Depends(get_session)
 ):
     try:
@@ -103,68 +693,206 @@ async def predict(
         project = session.get(Project, project_id)
         if not project:
              raise HTTPException(status_code=404, detail="Project not found")
+        if project.archive_path:
+            raise HTTPException(status_code=409, detail="Project is archived; restore it first")
+        # Return the pooled connection while the image waits in the scheduler queue
+        session.close()
+        decoding_profile = choose_profile(profile)
 
-        # Read image
-        image_data = await file.read()
-        image = Image.open(io.BytesIO(image_data)).convert("RGB")
-        
-        # Save image to disk
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        safe_filename = f"{timestamp}_{file.filename}"
-        save_path = os.path.join(UPLOADS_DIR, safe_filename)
-        
-        with open(save_path, "wb") as f:
-            f.write(image_data)
-        
-        # Preprocess & Generate
-        caption = engine.predict(image)
-        
-        # Create Database Record
-        label = "detected_defect" 
-        confidence = 0.95
-        
-        defect = DefectRecord(
-            filename=file.filename,
-            caption=caption,
-            label=label,
-            confidence=confidence,
-            image_path=f"uploads/{safe_filename}", # Relative to static mount
-            room="General",
-            severity="Low",
-            project_id=project_id
-        )
-        session.add(defect)
-        session.commit()
-        session.refresh(defect)
-        
-        return {
-            "success": True,
-            "id": defect.id,
-            "filename": defect.filename,
-            "caption": defect.caption,
-            "label": defect.label,
-            "confidence": defect.confidence,
-            "image_url": f"/static/uploads/{safe_filename}",
-            "timestamp": defect.timestamp,
-            "project_id": defect.project_id
-        }
+        image, safe_filename, save_path = await read_upload(file)
+
+        # Preprocess & Generate on the scheduler thread (engine records preprocess/generate/token_decode)
+        try:
+            result = await schedule_caption(
+                request, image, project_id, priority, deadline_ms, decoding_profile, tiled=tiled
+            )
+        except HTTPException:
+            # Dropped before captioning; nothing will reference the stored upload
+            os.remove(save_path)
+            raise
+
+        defect = save_defect(session, file.filename, safe_filename, result, project_id, decoding_profile)
+        return defect_payload(defect)
     except Exception as e:
         print(f"❌ Prediction Error: {e}")
         if isinstance(e, HTTPException):
             raise e
         return {"success": False, "error": str(e)}
 
+@app.post("/predict/async", status_code=202)
+async def predict_async(
+    project_id: int = Form(...),
+    file: UploadFile = File(...),
+    profile: Optional[str] = Form(None),
+    session: Session = Depends(get_session)
+):
+    """
+    Accept an upload without waiting for the caption: the photo is stored and a
+    pending DefectRecord committed, then the ingest worker captions it in a
+    batch. The finished record arrives through /sync (or GET /defects).
+    """
+    project = session.get(Project, project_id)
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if project.archive_path:
+        raise HTTPException(status_code=409, detail="Project is archived; restore it first")
+    try:
+        decoding.get_profile(profile or config.INGEST_PROFILE)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    _, safe_filename, _ = await read_upload(file, durable=True)
+    defect = new_defect(file.filename, safe_filename, project_id, profile or config.INGEST_PROFILE)
+    with metrics.PREDICT_STAGE_SECONDS.time(stage="db_commit"):
+        session.add(defect)
+        session.commit()
+        session.refresh(defect)
+    ingest_worker.notify()
+    return defect_payload(defect)
+
+def _load_pending(defect):
+    path = os.path.join(config.BACKEND_DIR, "outputs", defect.image_path)
+    with Image.open(path) as image:
+        return {
+            "image": image.convert("RGB"), "project_id": defect.project_id,
+            "profile": defect.decoding_profile or config.INGEST_PROFILE,
+        }
+
+def _caption_pending(items):
+    # Each upload keeps the profile it was accepted with; one scheduler job per profile,
+    # all in the bulk class so interactive requests stay ahead of them
+    model_version = model_registry.choose()
+    groups = {}
+    for i, item in enumerate(items):
+        groups.setdefault(item["profile"], []).append(i)
+    jobs = [
+        (indexes, inference_scheduler.submit(
+            [items[i] for i in indexes], priority="bulk", model_version=model_version, **decoding.get_profile(profile)
+        ))
+        for profile, indexes in groups.items()
+    ]
+    results = [None] * len(items)
+    for indexes, future in jobs:
+        for i, result in zip(indexes, future.result()):
+            results[i] = result
+    return results
+
+def _apply_pending(defect, result):
+    apply_caption(defect, result)
+    index_embedding(defect, result)
+
+ingest_worker = ingest.IngestWorker(
+    _load_pending, _caption_pending, _apply_pending,
+    batch_size=config.INGEST_BATCH_SIZE,
+    poll_seconds=config.INGEST_POLL_SECONDS,
+    lease_seconds=config.INGEST_LEASE_SECONDS,
+)
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+@app.post("/predict/stream")
+async def predict_stream(
+    project_id: int = Form(...),
+    file: UploadFile = File(...),
+    priority: str = Form("interactive"),
+    deadline_ms: Optional[int] = Form(None),
+    profile: Optional[str] = Form(None),
+    session: Session = Depends(get_session)
+):
+    """
+    Same as /predict, but answers with Server-Sent Events: `token` events carry
+    the partial caption ({text, delta, reset}) as it is decoded, then a single
+    `record` event carries the committed DefectRecord (or `error` on failure).
+    Beam search streams the current best beam, so `reset` marks a rewrite.
+    """
+    project = session.get(Project, project_id)
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if project.archive_path:
+        raise HTTPException(status_code=409, detail="Project is archived; restore it first")
+    session.close()
+    decoding_profile = choose_profile(profile)
+    if priority not in scheduler.PRIORITIES:
+        raise HTTPException(status_code=422, detail=f"priority must be one of {sorted(scheduler.PRIORITIES)}")
+    image, safe_filename, save_path = await read_upload(file)
+    filename = file.filename
+
+    async def events():
+        loop = asyncio.get_running_loop()
+        updates = asyncio.Queue()
+        # Pin the model up front so partial tokens are decoded with its own vocabulary
+        model_version = model_registry.choose()
+        tokenizer = getattr(model_registry.get(model_version), "tokenizer", None)
+        detokenizer = tokenizer.detokenizer() if tokenizer is not None else None
+
+        def on_tokens(index, token_ids):
+            # Called on the scheduler thread after every decoding step
+            loop.call_soon_threadsafe(updates.put_nowait, token_ids)
+
+        task = asyncio.ensure_future(schedule_caption(
+            None, image, project_id, priority, deadline_ms, decoding_profile, model_version,
+            on_tokens=on_tokens if detokenizer is not None else None,
+        ))
+        task.add_done_callback(lambda _: updates.put_nowait(None))
+        saved = False
+        try:
+            finished = False
+            while not finished:
+                token_ids = await updates.get()
+                # Coalesce steps that piled up while the client was slow; only the newest matters
+                while token_ids is not None and not updates.empty():
+                    token_ids = updates.get_nowait()
+                if token_ids is None:
+                    finished = True
+                    continue
+                text, delta, reset = detokenizer.update(token_ids)
+                yield sse_event("token", {"text": text, "delta": delta, "reset": reset})
+
+            try:
+                result = await task
+            except HTTPException as e:
+                yield sse_event("error", {"status": e.status_code, "detail": e.detail})
+                return
+            except Exception as e:
+                print(f"❌ Prediction Error: {e}")
+                yield sse_event("error", {"status": 500, "detail": str(e)})
+                return
+
+            with Session(database.engine) as write_session:
+                defect = save_defect(write_session, filename, safe_filename, result, project_id, decoding_profile)
+                saved = True
+                yield sse_event("record", defect_payload(defect))
+        finally:
+            # Client went away mid-stream: drop the job if it has not run yet
+            if not task.done():
+                task.cancel()
+            if not saved and os.path.exists(save_path):
+                os.remove(save_path)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.get("/defects", response_model=List[DefectRecord])
 def get_defects(
+    request: Request,
     project_id: int = None, # Optional filter
     session: Session = Depends(get_session)
 ):
-    query = select(DefectRecord).order_by(DefectRecord.timestamp.desc())
+    # Plain rows straight to JSON (with ETag/304 and compression), see http_cache.py
+    table = DefectRecord.__table__
+    query = select(table).order_by(table.c.timestamp.desc())
     if project_id:
-        query = query.where(DefectRecord.project_id == project_id)
-        
-    defects = session.exec(query).all()
-    return defects
+        query = query.where(table.c.project_id == project_id)
+        project = session.get(Project, project_id)
+        if project is not None and project.archive_path:
+            # Archived rows never change, so the hot database's version still makes a valid ETag
+            with archive.shard_session(config.ARCHIVE_DIR, project) as shard:
+                return http_cache.json_rows(request, session, query, source=shard)
+    return http_cache.json_rows(request, session, query)
 
 @app.delete("/defects/{defect_id}")
 def delete_defect(defect_id: int, session: Session = Depends(get_session)):
@@ -180,8 +908,32 @@ def delete_defect(defect_id: int, session: Session = Depends(get_session)):
             
     session.delete(defect)
     session.commit()
+    embedding_stores.remove(defect_id)
     return {"success": True, "message": "Defect deleted"}
 
+@app.get("/defects/{defect_id}/similar")
+def similar_defects(defect_id: int, k: int = 10, session: Session = Depends(get_session)):
+    """Defects in the same project whose photos look most like this one, best first."""
+    defect = session.get(DefectRecord, defect_id)
+    if not defect:
+        raise HTTPException(status_code=404, detail="Defect not found")
+    # Only photos embedded by the same model version are comparable
+    store = embedding_stores.store(defect.model_version or config.MODEL_VERSION)
+    embedding = store.get(defect_id)
+    if embedding is None:
+        raise HTTPException(status_code=404, detail="No embedding stored for this defect")
+
+    hits = store.search(defect.project_id, embedding, k=max(1, min(k, 100)), exclude=defect_id)
+    ids = [hit[0] for hit in hits]
+    records = {d.id: d for d in session.exec(select(DefectRecord).where(DefectRecord.id.in_(ids))).all()}
+    return [
+        {"defect": records[i], "similarity": round(score, 4)}
+        for i, score in hits if i in records
+    ]
+
+# Model outputs whose manual correction protects a record from re-captioning
+USER_OUTPUT_FIELDS = {"caption", "label", "severity"}
+
 @app.patch("/defects/{defect_id}", response_model=DefectRecord)
 def update_defect(
     defect_id: int, 
@@ -192,9 +944,11 @@ def update_defect(
     if not defect:
         raise HTTPException(status_code=404, detail="Defect not found")
     
-    # Update fields
+    # Update fields (id, the sync version and the edit flag are managed by the server)
     for key, value in updates.items():
-        if hasattr(defect, key):
+        if hasattr(defect, key) and key not in ("id", "version", "user_edited"):
+            if key in USER_OUTPUT_FIELDS and getattr(defect, key) != value:
+                defect.user_edited = True
             setattr(defect, key, value)
     
     session.add(defect)
@@ -202,6 +956,22 @@ def update_defect(
     session.refresh(defect)
     return defect
 
+@app.get("/sync")
+def sync_changes(
+    since: int = 0,
+    project_id: Optional[int] = None,
+    limit: int = 1000,
+    session: Session = Depends(get_session)
+):
+    """
+    Incremental sync: projects and defects created or updated after version
+    `since`, plus ids deleted since then. Call again with the returned
+    `version` (immediately while `has_more` is true).
+    """
+    return archive.changes_since(
+        session, config.ARCHIVE_DIR, since=since, project_id=project_id, limit=max(1, min(limit, 5000))
+    )
+
 @app.post("/generate-report")
 async def generate_report(
     files: List[UploadFile] = File(...),
@@ -221,12 +991,11 @@ async def generate_report(
             file = files[i]
             meta = meta_list[i]
             
-            # Read and convert image
+            # Decoded only if its card is not cached yet
             image_data = await file.read()
-            image = Image.open(io.BytesIO(image_data)).convert("RGB")
             
             report_items.append({
-                "image": image,
+                "image_data": image_data,
                 "caption": meta.get("caption", ""),
                 "room": meta.get("room", "Unknown"),
                 "severity": meta.get("severity", "Low")
@@ -234,11 +1003,11 @@ async def generate_report(
             
         # Generate PDF
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_filename = f"DefectReport_{timestamp}.pdf"
+        output_filename = f"DefectReport_{timestamp}_{uuid.uuid4().hex[:8]}.pdf"
         output_path = os.path.join(config.BACKEND_DIR, "reports", output_filename)
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         
-        generate_defect_pdf(report_items, output_path)
+        generate_defect_pdf(report_items, output_path, card_cache=report_cards)
         
         # Return as downloadable file
         return FileResponse(
@@ -260,6 +1029,10 @@ async def generate_report_db(
         # Fetch defects from DB
         statement = select(DefectRecord).where(DefectRecord.id.in_(defect_ids)).order_by(DefectRecord.timestamp.desc())
         defects = session.exec(statement).all()
+        missing = set(defect_ids) - {d.id for d in defects}
+        if missing:
+            defects += archive.find_defects(session, config.ARCHIVE_DIR, missing)
+            defects.sort(key=lambda d: d.timestamp, reverse=True)
         
         if not defects:
             raise HTTPException(status_code=404, detail="No defects found for the given IDs")
@@ -275,16 +1048,13 @@ async def generate_report_db(
             full_path = os.path.join(config.BACKEND_DIR, "outputs", defect.image_path)
             
             if os.path.exists(full_path):
-                try:
-                    image = Image.open(full_path).convert("RGB")
-                    report_items.append({
-                        "image": image,
-                        "caption": defect.caption,
-                        "room": defect.room or "Unknown",
-                        "severity": defect.severity or "Low"
-                    })
-                except Exception as img_err:
-                    print(f"⚠️ Error loading image {full_path}: {img_err}")
+                # Unreadable photos are skipped by generate_defect_pdf
+                report_items.append({
+                    "image_path": full_path,
+                    "caption": defect.caption,
+                    "room": defect.room or "Unknown",
+                    "severity": defect.severity or "Low"
+                })
             else:
                  print(f"⚠️ Image file missing: {full_path}")
 
@@ -293,11 +1063,14 @@ async def generate_report_db(
 
         # Generate PDF
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_filename = f"DefectReport_Selected_{timestamp}.pdf"
+        output_filename = f"DefectReport_Selected_{timestamp}_{uuid.uuid4().hex[:8]}.pdf"
         output_path = os.path.join(config.BACKEND_DIR, "reports", output_filename)
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         
-        generate_defect_pdf(report_items, output_path)
+        try:
+            generate_defect_pdf(report_items, output_path, card_cache=report_cards)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         # Return as downloadable file
         return FileResponse(
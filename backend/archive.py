@@ -0,0 +1,285 @@
+"""
+Cold-project archival into per-project SQLite shards.
+
+archive_project moves a finished project's DefectRecords out of
+database.db into a file of their own, ARCHIVE_DIR/project_<id>.db, which
+also keeps a copy of the Project row. The Project itself stays behind as a
+stub with archive_path set. Project lists, sync and ids keep working, but
+the archived rows no longer weigh on the hot tables and their indexes. Run
+maintenance afterwards so VACUUM can return the freed pages.
+
+Reads of an archived project go to its shard, which is opened on demand
+and kept open, up to ARCHIVE_OPEN_SHARDS of them. That covers GET /defects?project_id=, /sync?project_id=,
+export and /generate-report-db. Archived defects are read-only. Editing them,
+deleting them or uploading into the project needs restore_project, which
+copies the rows back and removes the shard.
+
+Rows are moved with Core statements inside one write transaction. The
+change feed therefore sees the project update but no defect deletes, and
+clients keep their copies. Restored defects get fresh versions, so clients
+that first synced while the project was archived pick them up.
+
+Photos stay in outputs/uploads. referenced_images lists them so the
+maintenance sweep does not take them for orphans. The sweep holds lock()
+while it runs, as do archive_project and restore_project, so a photo is
+never caught between the hot database and a shard.
+"""
+import os
+import fcntl
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlalchemy import delete, event, func, insert, text, update
+from sqlmodel import Session, SQLModel, create_engine, select
+
+import config
+import ingest
+import sync
+from models import DefectRecord, Project
+
+BATCH = 1000
+
+_engines = OrderedDict()  # path -> engine, least recently used first
+_engines_lock = threading.Lock()
+
+
+def shard_name(project_id):
+    return f"project_{project_id}.db"
+
+
+def shard_engine(archive_dir, project):
+    """Engine for an archived project's shard, opened on first use."""
+    path = os.path.join(archive_dir, project.archive_path)
+    evicted = []
+    with _engines_lock:
+        engine = _engines.get(path)
+        if engine is not None:
+            _engines.move_to_end(path)
+        else:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Archive of project {project.id} is missing: {path}")
+            engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+            _engines[path] = engine
+            while len(_engines) > max(1, config.ARCHIVE_OPEN_SHARDS):
+                evicted.append(_engines.popitem(last=False)[1])
+    # Sessions still using an evicted engine keep their connection until they close
+    for old in evicted:
+        old.dispose()
+    return engine
+
+
+@contextmanager
+def _scan_engine(archive_dir, project):
+    """Engine for a one-off pass over a shard: the cached one if open, else a temporary one."""
+    path = os.path.join(archive_dir, project.archive_path)
+    with _engines_lock:
+        engine = _engines.get(path)
+    if engine is not None:
+        yield engine
+        return
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Archive of project {project.id} is missing: {path}")
+    engine = create_engine(f"sqlite:///{path}")
+    try:
+        yield engine
+    finally:
+        engine.dispose()
+
+
+def _close_shard(path):
+    with _engines_lock:
+        engine = _engines.pop(path, None)
+    if engine is not None:
+        engine.dispose()
+
+
+def shard_session(archive_dir, project):
+    return Session(shard_engine(archive_dir, project))
+
+
+@contextmanager
+def lock(archive_dir):
+    """Exclusive lock on the archive directory, held across processes."""
+    os.makedirs(archive_dir, exist_ok=True)
+    with open(os.path.join(archive_dir, ".lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def changes_since(session, archive_dir, since=0, project_id=None, limit=1000):
+    """
+    sync.changes_since, with an archived project's defects read from its
+    shard. Their versions predate the archive, so a client that starts
+    syncing the project from 0 still gets all of them.
+    """
+    project = session.get(Project, project_id) if project_id else None
+    if project is None or not project.archive_path:
+        return sync.changes_since(session, since=since, project_id=project_id, limit=limit)
+    with shard_session(archive_dir, project) as shard:
+        return sync.changes_since(session, since=since, project_id=project_id, limit=limit, defect_session=shard)
+
+
+def archived_projects(session):
+    return session.exec(select(Project).where(Project.archive_path.is_not(None))).all()
+
+
+def find_defects(session, archive_dir, defect_ids):
+    """Archived DefectRecords with these ids, from whichever shards hold them."""
+    missing, found = set(defect_ids), []
+    for project in archived_projects(session):
+        if not missing:
+            break
+        with _scan_engine(archive_dir, project) as engine, Session(engine) as shard:
+            rows = shard.exec(select(DefectRecord).where(DefectRecord.id.in_(list(missing)))).all()
+        found.extend(rows)
+        missing -= {row.id for row in rows}
+    return found
+
+
+def referenced_images(db_engine, archive_dir):
+    """image_path of every archived defect."""
+    paths = set()
+    with Session(db_engine) as session:
+        projects = archived_projects(session)
+    for project in projects:
+        with _scan_engine(archive_dir, project) as engine, engine.connect() as connection:
+            query = select(DefectRecord.__table__.c.image_path).where(DefectRecord.__table__.c.image_path.is_not(None))
+            paths.update(connection.execute(query).scalars())
+    return paths
+
+
+def _copy(source, target, query, table, versions=None):
+    """Stream `query` from one connection into `table` on another, BATCH rows at a time."""
+    copied = 0
+    for rows in source.execute(query.execution_options(yield_per=BATCH)).mappings().partitions():
+        rows = [dict(row) for row in rows]
+        if versions is not None:
+            for row in rows:
+                row["version"] = next(versions)
+        target.execute(insert(table), rows)
+        copied += len(rows)
+    return copied
+
+
+def archive_project(db_engine, project_id, archive_dir):
+    """
+    Move a project's defects into its shard and leave the Project as a stub.
+    Returns the number of defects moved. Raises LookupError for an unknown
+    project, and ValueError if it is already archived or still has uploads
+    waiting for captions.
+    """
+    with lock(archive_dir):
+        table = DefectRecord.__table__
+        path = os.path.join(archive_dir, shard_name(project_id))
+        tmp = f"{path}.tmp"
+        with db_engine.begin() as connection:
+            # Reserving the version takes the write lock, so no edit can land between copy and delete
+            version = sync.next_versions(connection, 1)[0]
+            project = connection.execute(select(Project.__table__).where(Project.id == project_id)).mappings().first()
+            if project is None:
+                raise LookupError(f"Project {project_id} not found")
+            if project["archive_path"]:
+                raise ValueError(f"Project {project_id} is already archived")
+            busy = connection.execute(
+                select(func.count()).select_from(table)
+                .where(table.c.project_id == project_id, table.c.status.in_([ingest.PENDING, ingest.CAPTIONING]))
+            ).scalar()
+            if busy:
+                raise ValueError(f"Project {project_id} has {busy} uploads still being captioned")
+
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            shard = create_engine(f"sqlite:///{tmp}")
+            try:
+                SQLModel.metadata.create_all(shard, tables=[Project.__table__, table])
+                with shard.begin() as out:
+                    out.execute(insert(Project.__table__), [dict(project)])
+                    moved = _copy(connection, out, select(table).where(table.c.project_id == project_id), table)
+            finally:
+                shard.dispose()
+            with open(tmp, "rb+") as f:
+                os.fsync(f.fileno())
+            max_id = connection.execute(select(func.max(table.c.id)).where(table.c.project_id == project_id)).scalar()
+
+            connection.execute(delete(table).where(table.c.project_id == project_id))
+            connection.execute(
+                update(Project.__table__).where(Project.id == project_id)
+                .values(archive_path=shard_name(project_id), archived_max_defect_id=max_id, version=version)
+            )
+            # If the commit fails the project stays hot; archiving again overwrites this file
+            _close_shard(path)
+            os.replace(tmp, path)
+        print(f"📦 Archived project {project_id}: {moved} defects -> {path}")
+        return moved
+
+
+def restore_project(db_engine, project_id, archive_dir):
+    """Move an archived project's defects back into the hot database; returns how many."""
+    with lock(archive_dir):
+        table = DefectRecord.__table__
+        with Session(db_engine) as session:
+            project = session.get(Project, project_id)
+            if project is None:
+                raise LookupError(f"Project {project_id} not found")
+            if not project.archive_path:
+                raise ValueError(f"Project {project_id} is not archived")
+            shard = shard_engine(archive_dir, project)
+        path = os.path.join(archive_dir, project.archive_path)
+
+        with shard.connect() as source, db_engine.begin() as connection:
+            count = source.execute(select(func.count()).select_from(table)).scalar()
+            versions = iter(sync.next_versions(connection, count + 1))
+            # Checked again under the write lock, in case another restore got here first
+            if connection.execute(select(Project.__table__.c.archive_path).where(Project.id == project_id)).scalar() is None:
+                raise ValueError(f"Project {project_id} is not archived")
+            restored = _copy(source, connection, select(table).order_by(table.c.id), table, versions)
+            connection.execute(
+                update(Project.__table__).where(Project.id == project_id)
+                .values(archive_path=None, archived_max_defect_id=None, version=next(versions))
+            )
+        _close_shard(path)
+        os.remove(path)
+        print(f"📤 Restored project {project_id}: {restored} defects")
+        return restored
+
+
+def remove_archive(archive_dir, archive_path):
+    """Delete a deleted project's shard; returns the image paths its defects referenced."""
+    path = os.path.join(archive_dir, archive_path)
+    if not os.path.exists(path):
+        return []
+    _close_shard(path)
+    shard = create_engine(f"sqlite:///{path}")
+    try:
+        with shard.connect() as connection:
+            image_paths = [p for p in connection.execute(select(DefectRecord.__table__.c.image_path)).scalars() if p]
+    finally:
+        shard.dispose()
+    os.remove(path)
+    return image_paths
+
+
+@event.listens_for(Session, "before_flush")
+def _skip_archived_ids(session, flush_context, instances):
+    """
+    SQLite hands out max(id) + 1, so archiving the newest defects would let
+    their ids be reused and collide on restore. New defects start above the
+    highest archived id instead. This runs after sync's listener, whose
+    counter UPDATE already holds the write lock.
+    """
+    new = [o for o in session.new if isinstance(o, DefectRecord) and o.id is None]
+    if not new:
+        return
+    connection = session.connection()
+    floor = connection.execute(text("SELECT max(archived_max_defect_id) FROM project")).scalar()
+    if floor is None:
+        return
+    top = connection.execute(text("SELECT max(id) FROM defectrecord")).scalar() or 0
+    if top >= floor:
+        return
+    for defect_id, defect in enumerate(new, start=floor + 1):
+        defect.id = defect_id
@@ -0,0 +1,248 @@
+"""
+Offline benchmark for ImageCaptioningEngine.
+
+Measures images/sec and p50/p95/p99 latency across batch sizes, beam widths,
+max lengths, input resolutions and precision modes, split into preprocess,
+generate and decode. Runs against a tiny random checkpoint by default so it
+works on any CPU box; pass --model-path to benchmark the real weights.
+
+    uv run bench_engine.py --output bench/HEAD.json
+    uv run bench_engine.py --output bench/new.json --compare bench/HEAD.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import platform
+import argparse
+import tempfile
+import itertools
+import subprocess
+
+import torch
+from PIL import Image
+
+import config
+from engine import ImageCaptioningEngine
+from tiny_model import build_tiny_checkpoint
+
+PRECISIONS = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of floats."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(values):
+    return {
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+    }
+
+
+def parse_resolution(text):
+    if "x" in text:
+        w, h = text.lower().split("x")
+        return int(w), int(h)
+    return int(text), int(text)
+
+
+def parse_list(text, cast=str):
+    return [cast(v) for v in text.split(",") if v]
+
+
+def make_images(count, resolution, seed=0):
+    """Random-noise RGB images so JPEG-style decode/resize cost is realistic."""
+    g = torch.Generator().manual_seed(seed)
+    w, h = resolution
+    images = []
+    for _ in range(count):
+        pixels = torch.randint(0, 256, (h, w, 3), dtype=torch.uint8, generator=g)
+        images.append(Image.fromarray(pixels.numpy(), "RGB"))
+    return images
+
+
+def bench_case(engine, batch_size, num_beams, max_length, resolution, iterations, warmup):
+    images = make_images(batch_size, resolution)
+    timings = {"preprocess": [], "generate": [], "decode": [], "total": []}
+
+    for i in range(warmup + iterations):
+        t0 = time.perf_counter()
+        pixel_values = engine.preprocess(images)
+        t1 = time.perf_counter()
+        output_ids = engine.generate(pixel_values, max_length=max_length, num_beams=num_beams)
+        t2 = time.perf_counter()
+        engine.decode(output_ids)
+        t3 = time.perf_counter()
+        if i < warmup:
+            continue
+        timings["preprocess"].append(t1 - t0)
+        timings["generate"].append(t2 - t1)
+        timings["decode"].append(t3 - t2)
+        timings["total"].append(t3 - t0)
+
+    total_time = sum(timings["total"])
+    return {
+        "images_per_sec": (batch_size * iterations) / total_time if total_time else 0.0,
+        "latency": {stage: summarize(values) for stage, values in timings.items()},
+    }
+
+
+def case_key(case):
+    return f"{case['precision']}|bs={case['batch_size']}|beams={case['num_beams']}|len={case['max_length']}|res={case['resolution']}"
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=config.BACKEND_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    model_path = args.model_path
+    synthetic = model_path is None
+    tmp_dir = None
+    if synthetic:
+        tmp_dir = tempfile.TemporaryDirectory(prefix="tiny_vit_gpt2_")
+        model_path = build_tiny_checkpoint(tmp_dir.name, image_size=args.model_image_size)
+        print(f"🧪 Using synthetic checkpoint at {model_path}")
+
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "synthetic_model": synthetic,
+            "model_path": None if synthetic else model_path,
+            "device": config.DEVICE,
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+            "python": platform.python_version(),
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "fast_generate": not args.hf_generate,
+        },
+        "cases": [],
+    }
+
+    try:
+        for precision in parse_list(args.precisions):
+            dtype = PRECISIONS[precision]
+            try:
+                engine = ImageCaptioningEngine(model_path=model_path, dtype=dtype)
+            except Exception as e:
+                print(f"⚠️ Skipping precision {precision}: {e}")
+                continue
+            if args.hf_generate:
+                engine.fast_generator = None
+
+            grid = itertools.product(
+                parse_list(args.batch_sizes, int),
+                parse_list(args.beams, int),
+                parse_list(args.max_lengths, int),
+                parse_list(args.resolutions),
+            )
+            for batch_size, num_beams, max_length, resolution in grid:
+                if synthetic:
+                    # Random weights hit EOS at random; force full-length decodes so runs are comparable
+                    engine.model.generation_config.min_length = max_length
+                case = {
+                    "precision": precision,
+                    "batch_size": batch_size,
+                    "num_beams": num_beams,
+                    "max_length": max_length,
+                    "resolution": resolution,
+                }
+                try:
+                    case.update(bench_case(
+                        engine, batch_size, num_beams, max_length,
+                        parse_resolution(resolution), args.iterations, args.warmup,
+                    ))
+                except Exception as e:
+                    case["error"] = str(e)
+                    print(f"❌ {case_key(case)}: {e}")
+                else:
+                    p50 = case["latency"]["total"]["p50"] * 1000
+                    print(f"⏱️ {case_key(case)}: {case['images_per_sec']:.2f} img/s, p50 {p50:.1f} ms")
+                results["cases"].append(case)
+            del engine
+    finally:
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    return results
+
+
+def compare(current, baseline, threshold):
+    """
+    Compare p50 total latency per case against a baseline run.
+    Returns a list of (key, baseline_p50, current_p50, ratio) that regressed by more than threshold.
+    """
+    base_cases = {case_key(c): c for c in baseline.get("cases", []) if "error" not in c}
+    regressions = []
+    for case in current.get("cases", []):
+        key = case_key(case)
+        base = base_cases.get(key)
+        if base is None or "error" in case:
+            continue
+        old = base["latency"]["total"]["p50"]
+        new = case["latency"]["total"]["p50"]
+        ratio = new / old if old else 1.0
+        print(f"{'🔺' if ratio > 1 + threshold else '  '} {key}: {old * 1000:.1f} ms -> {new * 1000:.1f} ms ({ratio:.2f}x)")
+        if ratio > 1 + threshold:
+            regressions.append((key, old, new, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ImageCaptioningEngine throughput and latency")
+    parser.add_argument("--model-path", default=None, help="Real checkpoint directory (default: tiny synthetic model)")
+    parser.add_argument("--model-image-size", type=int, default=224, help="Input size of the synthetic ViT")
+    parser.add_argument("--batch-sizes", default="1,4")
+    parser.add_argument("--beams", default="1,4")
+    parser.add_argument("--max-lengths", default="20,50")
+    parser.add_argument("--resolutions", default="224,1600x1200", help="Input photo sizes, e.g. 224,4000x3000")
+    parser.add_argument("--precisions", default="fp32", help=f"Comma list of {','.join(PRECISIONS)}")
+    parser.add_argument("--hf-generate", action="store_true", help="Decode with model.generate instead of fast_generate")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--output", default=None, help="Write results JSON here")
+    parser.add_argument("--compare", default=None, help="Baseline results JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Allowed p50 slowdown before failing (0.10 = 10%%)")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"❌ {len(regressions)} case(s) regressed by more than {args.threshold:.0%}")
+            return 1
+        print("✅ No regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
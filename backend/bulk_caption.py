@@ -0,0 +1,335 @@
+"""
+Offline bulk captioning for historical photo archives.
+
+Walks a directory or .zip, decodes and preprocesses images in a
+multiprocess DataLoader, captions them in batches through
+ImageCaptioningEngine and writes DefectRecords plus stored images in bulk
+transactions. Each photo's encoder embedding is added to the embedding
+store so the archive shows up in similar-defect search. A checkpoint file records every finished image, so an
+interrupted run picks up where it stopped. The checkpoint belongs to the project it was written for; resuming
+it into another project is refused.
+
+    uv run bulk_caption.py /data/inspections_2019.zip --project-id 3
+    uv run bulk_caption.py /data/site_photos --project-name "Archive 2019" --batch-size 32
+"""
+import os
+import io
+import sys
+import time
+import hashlib
+import zipfile
+import argparse
+
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+from transformers import ViTImageProcessor
+from sqlmodel import Session, select
+
+import config
+from decoding import PROFILE_ORDER, get_profile
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+
+def list_images(source):
+    """Relative paths of every image under a directory or inside a zip, sorted for stable ordering."""
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as zf:
+            names = [n for n in zf.namelist() if not n.endswith("/")]
+    else:
+        names = []
+        for root, _, files in os.walk(source):
+            for f in files:
+                names.append(os.path.relpath(os.path.join(root, f), source))
+    return sorted(n for n in names if os.path.splitext(n)[1].lower() in IMAGE_EXTENSIONS)
+
+
+def stored_filename(source, relpath, project_id):
+    """
+    Deterministic upload name so a resumed run overwrites rather than duplicates.
+    It covers the archive and target project too: two archives that both hold
+    DCIM/IMG_0001.jpg must not share (and later delete) one stored file.
+    """
+    key = f"{project_id}\0{os.path.abspath(source)}\0{relpath}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return f"bulk_{digest}_{os.path.basename(relpath)}"
+
+
+class ArchiveDataset(Dataset):
+    """
+    Reads, stores and preprocesses one image per item inside DataLoader workers.
+    Zip handles and the processor are opened lazily per worker process.
+    """
+
+    def __init__(self, source, relpaths, model_path, uploads_dir, project_id):
+        self.source = source
+        self.project_id = project_id
+        self.relpaths = relpaths
+        self.model_path = model_path
+        self.uploads_dir = uploads_dir
+        self.is_zip = zipfile.is_zipfile(source)
+        self._zip = None
+        self._processor = None
+
+    def __len__(self):
+        return len(self.relpaths)
+
+    def _read(self, relpath):
+        if self.is_zip:
+            if self._zip is None:
+                self._zip = zipfile.ZipFile(self.source)
+            return self._zip.read(relpath)
+        with open(os.path.join(self.source, relpath), "rb") as f:
+            return f.read()
+
+    def __getitem__(self, idx):
+        relpath = self.relpaths[idx]
+        try:
+            if self._processor is None:
+                self._processor = ViTImageProcessor.from_pretrained(self.model_path)
+            data = self._read(relpath)
+            image = Image.open(io.BytesIO(data)).convert("RGB")
+            pixel_values = self._processor(images=image, return_tensors="pt").pixel_values[0]
+
+            name = stored_filename(self.source, relpath, self.project_id)
+            with open(os.path.join(self.uploads_dir, name), "wb") as f:
+                f.write(data)
+            return {"relpath": relpath, "pixel_values": pixel_values, "stored": name}
+        except Exception as e:
+            return {"relpath": relpath, "error": str(e)}
+
+
+def collate(items):
+    ok = [i for i in items if "error" not in i]
+    return {
+        "relpaths": [i["relpath"] for i in ok],
+        "stored": [i["stored"] for i in ok],
+        "pixel_values": torch.stack([i["pixel_values"] for i in ok]) if ok else None,
+        "failed": [(i["relpath"], i["error"]) for i in items if "error" in i],
+    }
+
+
+class Checkpoint:
+    """
+    Append-only log of `status<TAB>relpath` lines, fsynced after each committed batch.
+    The first line, `project<TAB>id`, names the project the images went into.
+    """
+
+    def __init__(self, path, project_id):
+        self.path = path
+        self.done = set()
+        owner = self.project_of(path)
+        # Checkpoints from before the project line was written are taken as this project's
+        if owner is not None and owner != project_id:
+            raise ValueError(
+                f"Checkpoint {path} is for project {owner}, not {project_id}; "
+                f"resume with --project-id {owner} or pass a new --checkpoint"
+            )
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    status, _, relpath = line.rstrip("\n").partition("\t")
+                    if relpath and status != "project":
+                        self.done.add(relpath)
+        new = not os.path.exists(path)
+        self._f = open(path, "a", encoding="utf-8")
+        if new:
+            self._f.write(f"project\t{project_id}\n")
+
+    @staticmethod
+    def project_of(path):
+        """Project id a checkpoint was written for, or None (no file, or an older checkpoint)."""
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            status, _, value = f.readline().rstrip("\n").partition("\t")
+        return int(value) if status == "project" else None
+
+    def mark(self, relpaths, status="ok"):
+        for relpath in relpaths:
+            self._f.write(f"{status}\t{relpath}\n")
+            self.done.add(relpath)
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def close(self):
+        self._f.close()
+
+
+def run_bulk(source, project_id, engine, db_engine, uploads_dir, checkpoint_path,
+             batch_size=16, num_workers=None, max_length=None, num_beams=None, repetition_penalty=None,
+             decoding_profile=None, embedding_store=None, log_every=10):
+    """
+    Caption every not-yet-checkpointed image under `source` into `project_id`.
+    Returns a dict with processed/failed/skipped counts and throughput.
+    """
+    from models import DefectRecord
+
+    os.makedirs(uploads_dir, exist_ok=True)
+    if num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 2) - 1)
+
+    checkpoint = Checkpoint(checkpoint_path, project_id)
+    all_paths = list_images(source)
+    pending = [p for p in all_paths if p not in checkpoint.done]
+    skipped = len(all_paths) - len(pending)
+    print(f"📂 {len(all_paths)} images found, {skipped} already done, {len(pending)} to caption")
+
+    processed = failed = 0
+    start = time.perf_counter()
+    if pending:
+        loader = DataLoader(
+            ArchiveDataset(source, pending, engine.model_path, uploads_dir, project_id),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            collate_fn=collate,
+            persistent_workers=num_workers > 0,
+            prefetch_factor=4 if num_workers > 0 else None,
+        )
+        try:
+            for step, batch in enumerate(loader, start=1):
+                for relpath, error in batch["failed"]:
+                    print(f"⚠️ Skipping {relpath}: {error}")
+                failed += len(batch["failed"])
+
+                if batch["pixel_values"] is not None:
+                    pixel_values = batch["pixel_values"].to(engine.device, dtype=engine.model.dtype)
+                    embeddings, hidden = engine.embed(pixel_values)
+                    output_ids, scores = engine.generate(
+                        pixel_values, max_length=max_length, num_beams=num_beams,
+                        repetition_penalty=repetition_penalty, encoder_hidden_states=hidden, return_scores=True,
+                    )
+                    captions = engine.decode(output_ids)
+                    triage = engine.triage(embeddings, captions)
+
+                    with Session(db_engine) as session:
+                        # A crash between commit and checkpoint leaves committed rows behind; don't add them twice
+                        stored_paths = [f"uploads/{stored}" for stored in batch["stored"]]
+                        existing = set(session.exec(
+                            select(DefectRecord.image_path).where(DefectRecord.image_path.in_(stored_paths))
+                        ).all())
+                        records = [
+                            DefectRecord(
+                                filename=os.path.basename(relpath),
+                                caption=caption,
+                                label=result["label"],
+                                confidence=round(score, 4),
+                                image_path=f"uploads/{stored}",
+                                room="General",
+                                severity=result["severity"] or "Low",
+                                project_id=project_id,
+                                decoding_profile=decoding_profile,
+                                model_version=engine.version,
+                            )
+                            for relpath, stored, caption, score, result in zip(
+                                batch["relpaths"], batch["stored"], captions, scores.exp().tolist(), triage
+                            )
+                            if f"uploads/{stored}" not in existing
+                        ]
+                        session.add_all(records)
+                        session.flush()
+                        defect_ids = [r.id for r in records]
+                        session.commit()
+                    if embedding_store is not None and defect_ids:
+                        new = [i for i, stored in enumerate(batch["stored"]) if f"uploads/{stored}" not in existing]
+                        embedding_store.add_many(defect_ids, project_id, embeddings[new].cpu().numpy())
+                    processed += len(records)
+                    skipped += len(existing)
+
+                # Checkpoint only after the DB commit so a crash never loses a record
+                checkpoint.mark(batch["relpaths"])
+                checkpoint.mark([r for r, _ in batch["failed"]], status="failed")
+
+                if step % log_every == 0:
+                    elapsed = time.perf_counter() - start
+                    rate = processed / elapsed if elapsed else 0.0
+                    remaining = len(pending) - processed - failed
+                    eta = remaining / rate if rate else float("inf")
+                    print(f"⏳ {processed + failed}/{len(pending)} images, {rate:.1f} img/s, ETA {eta / 60:.1f} min")
+        finally:
+            checkpoint.close()
+    else:
+        checkpoint.close()
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "processed": processed,
+        "failed": failed,
+        "skipped": skipped,
+        "elapsed_sec": elapsed,
+        "images_per_sec": processed / elapsed if elapsed else 0.0,
+    }
+    print(f"✅ Captioned {processed} images ({failed} failed, {skipped} skipped) at {summary['images_per_sec']:.1f} img/s")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-caption an archive of inspection photos")
+    parser.add_argument("source", help="Directory or .zip of images")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--project-id", type=int)
+    target.add_argument("--project-name", help="Create a new project with this name")
+    parser.add_argument("--checkpoint", default=None, help="Resume log (default: <source>.bulk_checkpoint)")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=None, help="Decode/preprocess processes (default: cores - 1)")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads for generate")
+    parser.add_argument("--profile", choices=PROFILE_ORDER, default=config.DEFAULT_DECODING_PROFILE,
+                        help="Decoding profile (see decoding.py)")
+    parser.add_argument("--model-path", default=None)
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    from database import engine as db_engine, create_db_and_tables
+    from engine import ImageCaptioningEngine
+    from embedding_index import VersionedEmbeddingStore
+    from models import Project
+
+    source = os.path.abspath(args.source)
+    checkpoint_path = args.checkpoint or f"{source.rstrip(os.sep)}.bulk_checkpoint"
+    # Checked before --project-name creates a project the checkpoint could never resume into
+    owner = Checkpoint.project_of(checkpoint_path)
+    if owner is not None and (args.project_name or owner != args.project_id):
+        print(f"❌ Checkpoint {checkpoint_path} is for project {owner}; "
+              f"resume with --project-id {owner} or pass a new --checkpoint")
+        return 1
+
+    create_db_and_tables()
+    with Session(db_engine) as session:
+        if args.project_name:
+            project = Project(name=args.project_name)
+            session.add(project)
+            session.commit()
+            session.refresh(project)
+            print(f"✅ Created project '{project.name}' (ID: {project.id})")
+        else:
+            project = session.get(Project, args.project_id)
+            if not project:
+                print(f"❌ Project {args.project_id} not found")
+                return 1
+            if project.archive_path:
+                print(f"❌ Project {args.project_id} is archived; restore it first")
+                return 1
+        project_id = project.id
+
+    engine = ImageCaptioningEngine(model_path=args.model_path)
+    run_bulk(
+        source, project_id, engine, db_engine,
+        uploads_dir=os.path.join(config.BACKEND_DIR, "outputs", "uploads"),
+        checkpoint_path=checkpoint_path,
+        batch_size=args.batch_size,
+        num_workers=args.workers,
+        decoding_profile=args.profile,
+        embedding_store=VersionedEmbeddingStore(
+            os.path.join(config.BACKEND_DIR, "embeddings"), nprobe=config.EMBEDDING_NPROBE,
+            legacy_version=config.MODEL_VERSION,
+        ).store(engine.version),
+        **get_profile(args.profile),
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
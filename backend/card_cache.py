@@ -0,0 +1,115 @@
+"""
+Disk cache of prepared PDF report cards.
+
+A card is everything generate_defect_pdf works out for one defect: the
+photo cropped to the card's aspect ratio, scaled to print resolution and
+encoded as JPEG, plus the measured layout of its room/severity tags and
+caption lines. Consecutive reports for a project mostly repeat the same
+defects, so a cached card turns the expensive crop/encode/layout work into
+one file read.
+
+Each card is one file named by its key. The key covers the photo's content
+hash and the text fields the card shows, so an edited caption simply gets a
+new card. The cache stays under max_bytes by evicting the least recently
+used files, with file mtimes as the access clock, so recency survives
+restarts.
+"""
+import os
+import json
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+SUFFIX = ".card"
+_HEADER = struct.Struct("<I")
+
+_digest_cache = {}
+_DIGEST_CACHE_SIZE = 100_000
+
+
+def image_digest(item):
+    """Content hash of a report item's photo: raw bytes, a file path, or a PIL image."""
+    if item.get("image_data") is not None:
+        return hashlib.sha1(item["image_data"]).hexdigest()
+    if item.get("image_path") is not None:
+        path = item["image_path"]
+        stat = os.stat(path)
+        file_key = (path, stat.st_size, stat.st_mtime_ns)
+        digest = _digest_cache.get(file_key)
+        if digest is None:
+            with open(path, "rb") as f:
+                digest = hashlib.file_digest(f, "sha1").hexdigest()
+            if len(_digest_cache) >= _DIGEST_CACHE_SIZE:
+                _digest_cache.pop(next(iter(_digest_cache)))
+            _digest_cache[file_key] = digest
+        return digest
+    image = item["image"]
+    digest = hashlib.sha1(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def card_key(digest, *fields):
+    """Cache key for a card showing the photo with this digest and these text fields."""
+    return hashlib.sha256("\x1f".join([digest, *map(str, fields)]).encode("utf-8")).hexdigest()
+
+
+class CardCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sizes = OrderedDict()  # key -> file size, least recently used first
+        self.total = 0
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith(SUFFIX):
+                stat = os.stat(os.path.join(directory, name))
+                entries.append((stat.st_mtime_ns, name[:-len(SUFFIX)], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._sizes[key] = size
+            self.total += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, key):
+        """(jpeg_bytes, layout) for a cached card, or None."""
+        with self._lock:
+            if key not in self._sizes:
+                return None
+            self._sizes.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            with self._lock:
+                self.total -= self._sizes.pop(key, 0)
+            return None
+        (header_size,) = _HEADER.unpack_from(data)
+        layout = json.loads(data[_HEADER.size:_HEADER.size + header_size])
+        return data[_HEADER.size + header_size:], layout
+
+    def put(self, key, image_bytes, layout):
+        header = json.dumps(layout, ensure_ascii=False).encode("utf-8")
+        data = _HEADER.pack(len(header)) + header + image_bytes
+        tmp = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        with self._lock:
+            self.total += len(data) - self._sizes.pop(key, 0)
+            self._sizes[key] = len(data)
+            while self.total > self.max_bytes and len(self._sizes) > 1:
+                old_key, size = self._sizes.popitem(last=False)
+                self.total -= size
+                try:
+                    os.remove(self._path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    def __len__(self):
+        return len(self._sizes)
@@ -5,12 +5,29 @@ BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # --- Path Configuration ---
 MODEL_PATH = os.path.join(BACKEND_DIR, "models")
+# Registry name for MODEL_PATH; other versions live in MODEL_VERSIONS_DIR/<version>/
+MODEL_VERSION = os.environ.get("MODEL_VERSION", "base")
+MODEL_VERSIONS_DIR = os.environ.get("MODEL_VERSIONS_DIR", os.path.join(BACKEND_DIR, "model_versions"))
+# Traffic split saved by PUT /models/traffic; every worker checks it this often and follows it
+MODEL_TRAFFIC_FILE = os.environ.get("MODEL_TRAFFIC_FILE", os.path.join(BACKEND_DIR, "model_traffic.json"))
+MODEL_TRAFFIC_POLL_SECONDS = float(os.environ.get("MODEL_TRAFFIC_POLL_SECONDS", "5"))
+# Loaded checkpoints kept in memory; the least recently used idle one is evicted first
+MAX_RESIDENT_MODELS = int(os.environ.get("MAX_RESIDENT_MODELS", "2"))
+MODEL_MEMORY_BUDGET_MB = int(os.environ.get("MODEL_MEMORY_BUDGET_MB", "0")) # 0 = no budget
 
 # Font Configuration
 # Font Configuration
 FONT_URL = "https://github.com/googlefonts/sarabun/raw/main/fonts/ttf/Sarabun-Regular.ttf"
 FONT_PATH = os.path.join(BACKEND_DIR, "Sarabun-Regular.ttf")
 
+# --- PDF Reports ---
+# Report photos are cropped and scaled to this resolution at their printed size
+REPORT_IMAGE_DPI = int(os.environ.get("REPORT_IMAGE_DPI", "200"))
+REPORT_JPEG_QUALITY = int(os.environ.get("REPORT_JPEG_QUALITY", "85"))
+# Prepared defect cards are reused across reports (see card_cache.py); least recently used are evicted past the limit
+REPORT_CARD_CACHE_DIR = os.environ.get("REPORT_CARD_CACHE_DIR", os.path.join(BACKEND_DIR, "card_cache"))
+REPORT_CARD_CACHE_MB = int(os.environ.get("REPORT_CARD_CACHE_MB", "512"))
+
 # --- Device Configuration ---
 def get_device():
     try:
@@ -30,3 +47,105 @@ DEVICE = get_device()
 MAX_LENGTH = 50
 NUM_BEAMS = 4
 REPETITION_PENALTY = 1.2
+
+# --- Profiling ---
+# Capture a cProfile/torch-profiler trace for every /predict and report request.
+# Leave off in production; use the X-Profile header with PROFILE_ADMIN_TOKEN instead.
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "0") == "1"
+PROFILE_ADMIN_TOKEN = os.environ.get("PROFILE_ADMIN_TOKEN")
+# Kept outside outputs/ so traces are not exposed through the /static mount
+PROFILES_DIR = os.path.join(BACKEND_DIR, "profiles")
+
+# --- Inference Server ---
+# When set, HTTP workers forward preprocessed tensors to the single inference
+# server listening on this Unix socket instead of loading their own model copy.
+INFERENCE_SOCKET = os.environ.get("INFERENCE_SOCKET")
+# Thread counts for the process that runs the model (0 = torch default)
+TORCH_INTRA_OP_THREADS = int(os.environ.get("TORCH_INTRA_OP_THREADS", "0"))
+TORCH_INTER_OP_THREADS = int(os.environ.get("TORCH_INTER_OP_THREADS", "0"))
+# Largest batch the inference server will assemble from concurrent requests
+INFERENCE_MAX_BATCH = int(os.environ.get("INFERENCE_MAX_BATCH", "8"))
+
+# --- Decoding ---
+# Use the KV-cached decode loop in fast_generate.py; unsupported settings fall back to model.generate
+FAST_GENERATE = os.environ.get("FAST_GENERATE", "1") == "1"
+# Run the per-token decoder step under torch.compile (slow first call, so warmed up at startup)
+FAST_GENERATE_COMPILE = os.environ.get("FAST_GENERATE_COMPILE", "0") == "1"
+# KV cache lengths are rounded up to a multiple of this to bound recompiles
+GENERATE_LENGTH_BUCKET = int(os.environ.get("GENERATE_LENGTH_BUCKET", "16"))
+
+# --- Scheduling ---
+# Largest micro-batch the scheduler runs for each priority class. Bulk batches stay
+# small so an interactive request never waits behind a long bulk batch.
+SCHEDULER_MAX_BATCH = int(os.environ.get("SCHEDULER_MAX_BATCH", "8"))
+SCHEDULER_BULK_MAX_BATCH = int(os.environ.get("SCHEDULER_BULK_MAX_BATCH", "2"))
+# Interactive requests without an explicit deadline are dropped after this long in the queue
+INTERACTIVE_DEADLINE_MS = int(os.environ.get("INTERACTIVE_DEADLINE_MS", "30000"))
+
+# --- Decoding Profiles ---
+# Profile used when a request does not name one (see decoding.py)
+DEFAULT_DECODING_PROFILE = os.environ.get("DEFAULT_DECODING_PROFILE", "quality")
+# Automatic fallback to cheaper profiles under load: each value is one downgrade step.
+# Queue depth counts waiting + running inference jobs; latency is a moving average in seconds.
+PROFILE_FALLBACK_QUEUE_DEPTH = [int(v) for v in os.environ.get("PROFILE_FALLBACK_QUEUE_DEPTH", "8,24").split(",") if v]
+PROFILE_FALLBACK_LATENCY = [float(v) for v in os.environ.get("PROFILE_FALLBACK_LATENCY", "5,15").split(",") if v]
+
+# --- Embeddings ---
+# An upload whose encoder embedding is at least this similar (cosine) to an existing photo
+# in the same project reuses that photo's caption instead of running the decoder. >1 disables,
+# which is the default until a threshold has been measured on real site photos.
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("NEAR_DUPLICATE_THRESHOLD", "1.01"))
+# Inverted lists scanned per similarity query once a project is large enough to be indexed
+EMBEDDING_NPROBE = int(os.environ.get("EMBEDDING_NPROBE", "8"))
+
+# --- Async Ingestion ---
+# /predict/async uploads are captioned by a background worker in batches of this size
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "8"))
+# How often the worker checks for uploads accepted by other processes
+INGEST_POLL_SECONDS = float(os.environ.get("INGEST_POLL_SECONDS", "2"))
+INGEST_PROFILE = os.environ.get("INGEST_PROFILE", "quality")
+# A claimed upload not finished within this many seconds is assumed abandoned (worker crashed) and re-queued
+INGEST_LEASE_SECONDS = float(os.environ.get("INGEST_LEASE_SECONDS", "600"))
+
+# --- Re-captioning ---
+# Admin re-caption jobs (see recaption.py) run at most this many images per second
+# through the bulk scheduler class; 0 removes the limit
+RECAPTION_RATE = float(os.environ.get("RECAPTION_RATE", "2"))
+RECAPTION_BATCH_SIZE = int(os.environ.get("RECAPTION_BATCH_SIZE", "8"))
+RECAPTION_PROFILE = os.environ.get("RECAPTION_PROFILE", "quality")
+# Last committed defect id of the running job, so a restart resumes there
+RECAPTION_CHECKPOINT = os.environ.get("RECAPTION_CHECKPOINT", os.path.join(BACKEND_DIR, "recaption_checkpoint.json"))
+# Status of the current/last job, shared by all workers; its .lock keeps one job running at a time
+RECAPTION_STATE_FILE = os.environ.get("RECAPTION_STATE_FILE", os.path.join(BACKEND_DIR, "recaption.json"))
+
+# --- Tiled Inference ---
+# /predict with tiled=true also captions overlapping tiles of large photos (see tiling.py).
+# Tile side in source pixels; tiles grow until at most TILE_MAX_TILES cover the photo.
+TILE_SIZE = int(os.environ.get("TILE_SIZE", "1024"))
+TILE_OVERLAP = float(os.environ.get("TILE_OVERLAP", "0.25"))
+TILE_MAX_TILES = int(os.environ.get("TILE_MAX_TILES", "12"))
+# Regional captions at least this alike are merged into one region with several boxes
+TILE_MERGE_SIMILARITY = float(os.environ.get("TILE_MERGE_SIMILARITY", "0.8"))
+
+# --- Maintenance ---
+# Orphaned uploads, expired reports and stray temp files are deleted and the database
+# compacted (see maintenance.py) once per interval, inside the quiet hours (local
+# "start-end", may wrap midnight), and only while no inference work is queued
+MAINTENANCE_QUIET_HOURS = tuple(int(v) for v in os.environ.get("MAINTENANCE_QUIET_HOURS", "2-5").split("-"))
+MAINTENANCE_INTERVAL_HOURS = float(os.environ.get("MAINTENANCE_INTERVAL_HOURS", "24"))
+# Files younger than this are never swept: /predict writes the photo before its record commits
+MAINTENANCE_GRACE_SECONDS = int(os.environ.get("MAINTENANCE_GRACE_SECONDS", "3600"))
+# Generated PDFs are kept this many days; past REPORT_RETENTION_MB the oldest go first (0 = no cap)
+REPORT_RETENTION_DAYS = float(os.environ.get("REPORT_RETENTION_DAYS", "30"))
+REPORT_RETENTION_MB = int(os.environ.get("REPORT_RETENTION_MB", "0"))
+# VACUUM rewrites the whole database file under an exclusive lock, and uploads that wait longer than
+# SQLite's 5 s busy timeout fail, so it only runs when turned on (best with traffic stopped)
+MAINTENANCE_VACUUM = os.environ.get("MAINTENANCE_VACUUM", "0") == "1"
+# Last run and report, shared by the workers; only the one holding its lock runs maintenance
+MAINTENANCE_STATE_FILE = os.environ.get("MAINTENANCE_STATE_FILE", os.path.join(BACKEND_DIR, "maintenance.json"))
+
+# --- Archival ---
+# Archived projects keep their defects in one SQLite file each under this directory (see archive.py)
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", os.path.join(BACKEND_DIR, "archive"))
+# Shards kept open for reads; the least recently used one is closed past this
+ARCHIVE_OPEN_SHARDS = int(os.environ.get("ARCHIVE_OPEN_SHARDS", "8"))
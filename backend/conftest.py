@@ -0,0 +1,21 @@
+import pytest
+from sqlmodel import create_engine
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """The app on a tiny random checkpoint and a scratch database."""
+    import config
+    import database
+    from tiny_model import build_tiny_checkpoint
+
+    work = tmp_path_factory.mktemp("app")
+    config.MODEL_PATH = build_tiny_checkpoint(str(work / "model"), image_size=32, hidden_size=32)
+    config.BACKEND_DIR = str(work)
+    config.MODEL_TRAFFIC_FILE = str(work / "model_traffic.json")
+    config.MAINTENANCE_STATE_FILE = str(work / "maintenance.json")
+    config.RECAPTION_STATE_FILE = str(work / "recaption.json")
+    database.engine = create_engine(f"sqlite:///{work / 'app.db'}", connect_args={"check_same_thread": False})
+    database.create_db_and_tables()
+    import app
+    return app
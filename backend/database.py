@@ -1,5 +1,10 @@
+from sqlalchemy import MetaData, inspect, text
+from sqlalchemy.schema import CreateTable
 from sqlmodel import SQLModel, create_engine, Session
 
+import sync
+import archive # noqa: F401 -- registers the id listener for archived defects
+
 sqlite_file_name = "database.db"
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
@@ -8,6 +13,69 @@ engine = create_engine(sqlite_url, connect_args=connect_args)
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    add_missing_columns(engine)
+    relax_not_null(engine)
+    sync.backfill_versions(engine)
+
+def add_missing_columns(db_engine):
+    """
+    create_all never alters existing tables, so add any nullable model columns an
+    older database.db is missing (same ALTER TABLE approach as migrate_v2.py),
+    plus the indexes declared on them.
+    """
+    inspector = inspect(db_engine)
+    with db_engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            added = set()
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(dialect=db_engine.dialect)}'
+                default = column.default.arg if column.default is not None and column.default.is_scalar else None
+                if isinstance(default, (str, int, float)):
+                    ddl += f" DEFAULT {default!r}" if isinstance(default, str) else f" DEFAULT {default}"
+                connection.execute(text(ddl))
+                added.add(column.name)
+                print(f"✅ Added '{column.name}' column to '{table.name}'")
+            for index in table.indexes:
+                if added & {c.name for c in index.columns}:
+                    index.create(bind=connection, checkfirst=True)
+
+def relax_not_null(db_engine):
+    """
+    SQLite cannot drop a NOT NULL constraint in place, so rebuild any table where an
+    older database.db declares NOT NULL on a column the model now allows to be None
+    (e.g. DefectRecord.confidence): create it from the model, copy the rows, swap it in.
+    Run after add_missing_columns so every model column exists in the old table.
+    """
+    inspector = inspect(db_engine)
+    # The copy needs the other tables too so its foreign keys resolve
+    metadata = MetaData()
+    for table in SQLModel.metadata.sorted_tables:
+        table.to_metadata(metadata)
+    for table in SQLModel.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c["name"]: c for c in inspector.get_columns(table.name)}
+        relaxed = [
+            c.name for c in table.columns
+            if c.nullable and not c.primary_key and c.name in existing and not existing[c.name]["nullable"]
+        ]
+        if not relaxed:
+            continue
+        rebuilt = table.to_metadata(metadata, name=f"{table.name}__rebuild")
+        shared = ", ".join(f'"{c.name}"' for c in table.columns if c.name in existing)
+        with db_engine.begin() as connection:
+            connection.execute(CreateTable(rebuilt))
+            connection.execute(text(f'INSERT INTO "{rebuilt.name}" ({shared}) SELECT {shared} FROM "{table.name}"'))
+            connection.execute(text(f'DROP TABLE "{table.name}"'))
+            connection.execute(text(f'ALTER TABLE "{rebuilt.name}" RENAME TO "{table.name}"'))
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+        print(f"✅ Allowed NULL in {relaxed} on '{table.name}'")
 
 def get_session():
     with Session(engine) as session:
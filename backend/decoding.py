@@ -0,0 +1,79 @@
+"""
+Named decoding profiles and load-based fallback.
+
+A profile bundles the generate() settings that trade caption quality for
+latency. Requests pick one by name; when the inference queue or recent
+latency crosses the configured thresholds, AdaptiveProfileSelector steps
+the request down to a cheaper profile. The profile that actually ran is
+stored on the DefectRecord so degraded captions can be re-run later.
+"""
+import threading
+
+import config
+
+# Cheapest first; fallback only ever moves towards the front of this list
+PROFILE_ORDER = ["fast-greedy", "balanced", "quality"]
+
+
+def build_profiles():
+    """Profile name -> generate kwargs, derived from the model settings in config."""
+    return {
+        "fast-greedy": {
+            "num_beams": 1,
+            "max_length": min(config.MAX_LENGTH, 32),
+            "repetition_penalty": config.REPETITION_PENALTY,
+        },
+        "balanced": {
+            "num_beams": min(config.NUM_BEAMS, 2),
+            "max_length": config.MAX_LENGTH,
+            "repetition_penalty": config.REPETITION_PENALTY,
+        },
+        "quality": {
+            "num_beams": config.NUM_BEAMS,
+            "max_length": config.MAX_LENGTH,
+            "repetition_penalty": config.REPETITION_PENALTY,
+        },
+    }
+
+
+PROFILES = build_profiles()
+
+
+def get_profile(name):
+    """Generate kwargs for a profile name; raises ValueError for unknown names."""
+    if name not in PROFILES:
+        raise ValueError(f"Unknown decoding profile '{name}', expected one of {PROFILE_ORDER}")
+    return dict(PROFILES[name])
+
+
+class AdaptiveProfileSelector:
+    """
+    Picks the profile to run for a request given current load.
+
+    Each threshold list holds one value per downgrade step: crossing the
+    first moves one profile cheaper, crossing the second moves two, and so
+    on. Latency is an exponentially weighted average of recent caption
+    times (queue wait + decode) fed in through observe().
+    """
+
+    def __init__(self, queue_thresholds=(), latency_thresholds=(), smoothing=0.2):
+        self.queue_thresholds = sorted(queue_thresholds)
+        self.latency_thresholds = sorted(latency_thresholds)
+        self.smoothing = smoothing
+        self.latency = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.latency += self.smoothing * (seconds - self.latency)
+
+    def steps(self, queue_depth):
+        by_queue = sum(1 for t in self.queue_thresholds if queue_depth >= t)
+        by_latency = sum(1 for t in self.latency_thresholds if self.latency >= t)
+        return max(by_queue, by_latency)
+
+    def select(self, requested, queue_depth):
+        """Return the profile name to run: `requested`, or a cheaper one under load."""
+        get_profile(requested)
+        index = PROFILE_ORDER.index(requested)
+        return PROFILE_ORDER[max(0, index - self.steps(queue_depth))]
@@ -0,0 +1,169 @@
+"""
+Defect category and severity from the caption model's encoder output.
+
+DefectHead is a pair of linear classifiers over the mean-pooled ViT
+embedding that caption_batch computes anyway, so triage costs two small
+matrix multiplies and no second image pass. The head is fitted from the
+labels and severities inspectors corrected through PATCH /defects (records
+flagged user_edited; the rest are the model's own guesses) and the photos'
+embeddings in the embedding store. Only records captioned by the same
+checkpoint count, since another version's encoder embeds differently.
+
+    python defect_head.py --model-dir ./model_versions/v2
+
+This writes defect_head.pt next to the checkpoint. A model directory without
+one still gets a category: label_from_caption picks it from keywords in the
+Thai caption.
+"""
+import os
+import argparse
+
+import numpy as np
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+CATEGORIES = ["wall_crack", "leaking_pipe", "peeling_paint", "broken_tile", "mold_growth", "unknown"]
+SEVERITIES = ["Low", "Medium", "High", "Critical"]
+HEAD_FILE = "defect_head.pt"
+
+# First match wins, so more specific words come first
+CAPTION_KEYWORDS = [
+    ("กระเบื้อง", "broken_tile"),
+    ("เชื้อรา", "mold_growth"),
+    ("ร้าว", "wall_crack"),
+    ("รั่ว", "leaking_pipe"),
+    ("ซึม", "leaking_pipe"),
+    ("ลอก", "peeling_paint"),
+    ("สีพอง", "peeling_paint"),
+]
+
+
+def label_from_caption(caption):
+    """Defect category named by the caption, or "unknown"."""
+    for keyword, category in CAPTION_KEYWORDS:
+        if keyword in caption:
+            return category
+    return "unknown"
+
+
+class DefectHead(nn.Module):
+    def __init__(self, hidden_size, categories=CATEGORIES, severities=SEVERITIES):
+        super().__init__()
+        self.categories = list(categories)
+        self.severities = list(severities)
+        self.category = nn.Linear(hidden_size, len(self.categories))
+        self.severity = nn.Linear(hidden_size, len(self.severities))
+
+    def forward(self, embeddings):
+        # Same normalization as the embedding store, which the head is trained from
+        embeddings = F.normalize(embeddings.float(), dim=-1)
+        return self.category(embeddings), self.severity(embeddings)
+
+    @torch.no_grad()
+    def predict(self, embeddings):
+        """{"label", "label_confidence", "severity"} per row of a [N, hidden] embedding batch."""
+        category_logits, severity_logits = self(embeddings)
+        category_probs = category_logits.softmax(dim=-1)
+        best = category_probs.argmax(dim=-1).tolist()
+        severity = severity_logits.argmax(dim=-1).tolist()
+        return [
+            {"label": self.categories[c], "label_confidence": float(category_probs[i, c]), "severity": self.severities[s]}
+            for i, (c, s) in enumerate(zip(best, severity))
+        ]
+
+    def save(self, model_dir):
+        torch.save({
+            "hidden_size": self.category.in_features,
+            "categories": self.categories,
+            "severities": self.severities,
+            "state_dict": self.state_dict(),
+        }, os.path.join(model_dir, HEAD_FILE))
+
+    @classmethod
+    def load(cls, model_dir, device="cpu"):
+        """The head saved in `model_dir`, or None if it has not been trained."""
+        path = os.path.join(model_dir, HEAD_FILE)
+        if not os.path.exists(path):
+            return None
+        saved = torch.load(path, map_location=device)
+        head = cls(saved["hidden_size"], saved["categories"], saved["severities"])
+        head.load_state_dict(saved["state_dict"])
+        return head.to(device).eval()
+
+
+def fit(embeddings, labels, severities, epochs=300, lr=0.05, weight_decay=1e-4):
+    """
+    Train a DefectHead by full-batch softmax regression. `labels` and
+    `severities` are per-row names, None where unknown (that row then only
+    trains the other classifier).
+    """
+    embeddings = torch.as_tensor(embeddings, dtype=torch.float32)
+    head = DefectHead(embeddings.shape[1])
+    targets = [
+        (head.category, torch.tensor([head.categories.index(v) if v in head.categories else -100 for v in labels])),
+        (head.severity, torch.tensor([head.severities.index(v) if v in head.severities else -100 for v in severities])),
+    ]
+    optimizer = torch.optim.AdamW(head.parameters(), lr=lr, weight_decay=weight_decay)
+    inputs = F.normalize(embeddings, dim=-1)
+    for _ in range(epochs):
+        optimizer.zero_grad()
+        loss = sum(
+            F.cross_entropy(layer(inputs), target, ignore_index=-100)
+            for layer, target in targets if (target >= 0).any()
+        )
+        loss.backward()
+        optimizer.step()
+    return head.eval()
+
+
+def main(argv=None):
+    from sqlmodel import Session, or_, select
+
+    import config
+    import database
+    from embedding_index import VersionedEmbeddingStore
+    from models import DefectRecord
+
+    parser = argparse.ArgumentParser(description="Train the category/severity head from labelled defects")
+    parser.add_argument("--model-dir", default=config.MODEL_PATH)
+    parser.add_argument("--model-version", default=None,
+                        help="Registry version of --model-dir (default: MODEL_VERSION for MODEL_PATH, else the directory name)")
+    parser.add_argument("--embeddings", default=os.path.join(config.BACKEND_DIR, "embeddings"))
+    parser.add_argument("--epochs", type=int, default=300)
+    args = parser.parse_args(argv)
+
+    version = args.model_version
+    if version is None:
+        same = os.path.abspath(args.model_dir) == os.path.abspath(config.MODEL_PATH)
+        version = config.MODEL_VERSION if same else os.path.basename(os.path.normpath(args.model_dir))
+    produced_by = DefectRecord.model_version == version
+    if version == config.MODEL_VERSION:
+        # Records from before the registry have no version; MODEL_PATH captioned them
+        produced_by = or_(produced_by, DefectRecord.model_version.is_(None))
+
+    store = VersionedEmbeddingStore(args.embeddings, legacy_version=config.MODEL_VERSION).store(version)
+    vectors, labels, severities = [], [], []
+    with Session(database.engine) as session:
+        query = select(DefectRecord).where(DefectRecord.status == "done", DefectRecord.user_edited == True, produced_by)  # noqa: E712
+        for defect in session.exec(query):
+            label = defect.label if defect.label in CATEGORIES else None
+            severity = defect.severity if defect.severity in SEVERITIES else None
+            vector = store.get(defect.id)
+            if vector is None or (label is None and severity is None):
+                continue
+            vectors.append(vector)
+            labels.append(label)
+            severities.append(severity)
+    if not vectors:
+        print(f"❌ No hand-corrected defects from model version '{version}' with stored embeddings")
+        return 1
+
+    head = fit(np.stack(vectors), labels, severities, epochs=args.epochs)
+    head.save(args.model_dir)
+    print(f"✅ Trained defect head on {len(vectors)} corrected photos -> {os.path.join(args.model_dir, HEAD_FILE)}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,356 @@
+"""
+Persistent image-embedding store with a per-project approximate index.
+
+Every captioned photo's pooled ViT embedding is appended to a memory-mapped
+float16 matrix (embeddings.f16) next to parallel defect_id / project_id
+columns. Rows are never moved; deleting a defect just tombstones its row.
+
+Search is per project. Small projects are scanned exactly. Projects above
+IVF_MIN_ROWS get an in-memory inverted-file index: k-means centroids plus
+one posting list per centroid. A query scans only the `nprobe` closest
+lists, and rows added since the last build are scanned exactly until the
+index is rebuilt. At 1M rows a query touches a few thousand vectors
+instead of the whole matrix.
+
+Several processes may share one directory (uvicorn workers, the bulk
+captioner). Writes take an fcntl lock on store.lock and first catch up
+with rows other processes appended, which meta.json's count announces.
+Reads catch up whenever meta.json has changed.
+"""
+import os
+import json
+import fcntl
+import bisect
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+IVF_MIN_ROWS = 4096
+_INITIAL_CAPACITY = 1024
+
+
+class _IVFIndex:
+    """Inverted-file index over one project's rows (row numbers into the store)."""
+
+    def __init__(self, matrix, rows, n_lists, iterations=8, seed=0, chunk=65536):
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(rows, size=min(len(rows), n_lists * 64), replace=False))
+        sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = sample[assign == c]
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    centroids[c] = centroid / (np.linalg.norm(centroid) or 1.0)
+        self.centroids = centroids
+
+        # Assign every row in chunks so a large project never materialises as float32 at once
+        assign = np.concatenate([
+            np.argmax(np.asarray(matrix[rows[i:i + chunk]], dtype=np.float32) @ centroids.T, axis=1)
+            for i in range(0, len(rows), chunk)
+        ])
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(n_lists + 1))
+        self.lists = [rows[order[bounds[c]:bounds[c + 1]]] for c in range(n_lists)]
+        self.size = len(rows)
+        self.max_row = int(rows[-1])
+
+    def candidates(self, query, nprobe):
+        nearest = np.argsort(-(self.centroids @ query))[:nprobe]
+        return np.concatenate([self.lists[c] for c in nearest])
+
+
+class EmbeddingStore:
+    def __init__(self, directory, nprobe=8):
+        self.directory = directory
+        self.nprobe = nprobe
+        self._lock = threading.RLock()
+        self._meta_path = os.path.join(self.directory, "meta.json")
+        self.dim = None
+        self.count = 0
+        self.capacity = 0
+        self._vectors = self._defect_ids = self._project_ids = None
+        self._row_of = {}
+        self._project_rows = {}
+        self._indexes = {}
+        self._meta_stamp = None
+        os.makedirs(self.directory, exist_ok=True)
+        self._refresh()
+
+    # --- Storage ---
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _open(self):
+        mode = "r+"
+        self._vectors = np.memmap(self._path("embeddings.f16"), dtype=np.float16, mode=mode, shape=(self.capacity, self.dim))
+        self._defect_ids = np.memmap(self._path("defect_ids.i64"), dtype=np.int64, mode=mode, shape=(self.capacity,))
+        self._project_ids = np.memmap(self._path("project_ids.i64"), dtype=np.int64, mode=mode, shape=(self.capacity,))
+
+    def _grow(self, needed):
+        capacity = max(_INITIAL_CAPACITY, self.capacity)
+        while capacity < needed:
+            capacity *= 2
+        if capacity == self.capacity:
+            return
+        if self._vectors is not None:
+            self._flush()
+            self._vectors = self._defect_ids = self._project_ids = None
+        for name, width in (("embeddings.f16", 2 * self.dim), ("defect_ids.i64", 8), ("project_ids.i64", 8)):
+            with open(self._path(name), "ab") as f:
+                f.truncate(capacity * width)
+        self.capacity = capacity
+        self._open()
+
+    def _write_meta(self):
+        tmp = self._meta_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "count": self.count, "capacity": self.capacity}, f)
+        os.replace(tmp, self._meta_path)
+        self._meta_stamp = self._stamp()
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self._meta_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self):
+        """Take in rows appended by other processes since meta.json was last read."""
+        stamp = self._stamp()
+        if stamp is None or stamp == self._meta_stamp:
+            return
+        with open(self._meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        self._meta_stamp = stamp
+        if meta["capacity"] != self.capacity:
+            self._vectors = self._defect_ids = self._project_ids = None
+            self.dim, self.capacity = meta["dim"], meta["capacity"]
+            self._open()
+        start, self.count = self.count, meta["count"]
+        ids = np.asarray(self._defect_ids[start:self.count])
+        projects = np.asarray(self._project_ids[start:self.count])
+        live = np.flatnonzero(ids >= 0)
+        for row in live:
+            self._row_of[int(ids[row])] = start + int(row)
+        for project_id in set(projects[live].tolist()):
+            if project_id in self._project_rows:
+                self._project_rows[project_id].extend((start + live[projects[live] == project_id]).tolist())
+
+    @contextmanager
+    def _writing(self):
+        """Exclusive across threads and processes, caught up with everyone else's rows."""
+        with self._lock, open(self._path("store.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _flush(self):
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._defect_ids.flush()
+            self._project_ids.flush()
+        self._write_meta()
+
+    def flush(self):
+        with self._writing():
+            self._flush()
+
+    @staticmethod
+    def normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    # --- Writes ---
+
+    def add(self, defect_id, project_id, embedding):
+        """Append (or replace) the embedding for a defect."""
+        self.add_many([defect_id], project_id, [embedding])
+
+    def add_many(self, defect_ids, project_id, embeddings):
+        """Append (or replace) embeddings for several defects of one project."""
+        vectors = self.normalize(embeddings)
+        if len(vectors) == 0:
+            return
+        with self._writing():
+            if self.dim is None:
+                self.dim = vectors.shape[-1]
+            elif vectors.shape[-1] != self.dim:
+                raise ValueError(f"Embedding has {vectors.shape[-1]} dims, store holds {self.dim}")
+            for defect_id in defect_ids:
+                self._remove(defect_id)
+            self._grow(self.count + len(vectors))
+            start = self.count
+            self._vectors[start:start + len(vectors)] = vectors.astype(np.float16)
+            self._defect_ids[start:start + len(vectors)] = defect_ids
+            self._project_ids[start:start + len(vectors)] = project_id
+            self.count += len(vectors)
+            for row, defect_id in enumerate(defect_ids, start=start):
+                self._row_of[defect_id] = row
+            if project_id in self._project_rows:
+                self._project_rows[project_id].extend(range(start, self.count))
+            # Write metadata on every call so a crash loses at most the in-flight rows
+            self._write_meta()
+
+    def remove(self, defect_id):
+        with self._writing():
+            return self._remove(defect_id)
+
+    def _remove(self, defect_id):
+        row = self._row_of.pop(defect_id, None)
+        if row is None:
+            return False
+        self._defect_ids[row] = -1
+        project_id = int(self._project_ids[row])
+        if project_id in self._project_rows:
+            self._project_rows[project_id].remove(row)
+        # The IVF index keeps the tombstoned row; searches filter it out
+        return True
+
+    def remove_project(self, project_id):
+        with self._writing():
+            for row in self._rows(project_id):
+                self._row_of.pop(int(self._defect_ids[row]), None)
+                self._defect_ids[row] = -1
+            self._project_rows.pop(project_id, None)
+            self._indexes.pop(project_id, None)
+
+    # --- Reads ---
+
+    def get(self, defect_id):
+        with self._lock:
+            self._refresh()
+            row = self._row_of.get(defect_id)
+            # Another process may have removed it since
+            if row is None or self._defect_ids[row] != defect_id:
+                return None
+            return np.asarray(self._vectors[row], dtype=np.float32)
+
+    def _rows(self, project_id):
+        if self._vectors is None:
+            return []
+        rows = self._project_rows.get(project_id)
+        if rows is None:
+            live = (self._project_ids[:self.count] == project_id) & (self._defect_ids[:self.count] >= 0)
+            rows = np.flatnonzero(live).tolist()
+            self._project_rows[project_id] = rows
+        return rows
+
+    def _index(self, project_id, rows):
+        index = self._indexes.get(project_id)
+        # Rebuild once the project has grown by half since the last build
+        if index is None or len(rows) > index.size * 1.5:
+            index = _IVFIndex(self._vectors, np.asarray(rows, dtype=np.int64), n_lists=int(np.sqrt(len(rows))))
+            self._indexes[project_id] = index
+        return index
+
+    def search(self, project_id, embedding, k=10, exclude=None):
+        """Top-k (defect_id, cosine similarity) pairs within one project, best first."""
+        query = self.normalize(embedding)
+        with self._lock:
+            self._refresh()
+            if self.dim is None or query.shape[-1] != self.dim:
+                return []
+            rows = self._rows(project_id)
+            if not rows:
+                return []
+            if len(rows) >= IVF_MIN_ROWS:
+                index = self._index(project_id, rows)
+                # Rows are appended in increasing order, so anything past max_row is newer than the index
+                fresh = rows[bisect.bisect_right(rows, index.max_row):]
+                candidates = np.concatenate([index.candidates(query, self.nprobe), np.asarray(fresh, dtype=np.int64)])
+            else:
+                candidates = np.asarray(rows, dtype=np.int64)
+            candidates = candidates[self._defect_ids[candidates] >= 0]
+            scores = np.asarray(self._vectors[candidates], dtype=np.float32) @ query
+            defect_ids = np.asarray(self._defect_ids[candidates])
+
+        results = []
+        for i in np.argsort(-scores):
+            defect_id = int(defect_ids[i])
+            if defect_id == exclude:
+                continue
+            results.append((defect_id, float(scores[i])))
+            if len(results) >= k:
+                break
+        return results
+
+    def nearest(self, project_id, embedding):
+        """Best match in the project as (defect_id, similarity), or None."""
+        hits = self.search(project_id, embedding, k=1)
+        return hits[0] if hits else None
+
+
+class VersionedEmbeddingStore:
+    """
+    One EmbeddingStore per model version, in `directory`/<version>. Two
+    encoders embed photos differently even at the same width, so photos are
+    only compared with photos captioned by the same version.
+
+    A store from before versioning (meta.json directly in `directory`) is
+    moved to `legacy_version`, the version that wrote it.
+    """
+
+    _FILES = ("embeddings.f16", "defect_ids.i64", "project_ids.i64", "meta.json")
+
+    def __init__(self, directory, nprobe=8, legacy_version=None):
+        self.directory = directory
+        self.nprobe = nprobe
+        self._stores = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        if legacy_version and os.path.exists(os.path.join(self.directory, "meta.json")):
+            self._adopt_legacy(legacy_version)
+
+    def _adopt_legacy(self, version):
+        target = os.path.join(self.directory, version)
+        if os.path.exists(os.path.join(target, "meta.json")):
+            return
+        os.makedirs(target, exist_ok=True)
+        # meta.json last: until it moves, the store is still where other workers look for it
+        for name in self._FILES:
+            try:
+                os.replace(os.path.join(self.directory, name), os.path.join(target, name))
+            except FileNotFoundError:
+                pass
+        print(f"📦 Moved existing embeddings to model version '{version}'")
+
+    def store(self, version):
+        """The EmbeddingStore for one model version, created on first use."""
+        with self._lock:
+            store = self._stores.get(version)
+            if store is None:
+                store = EmbeddingStore(os.path.join(self.directory, version), nprobe=self.nprobe)
+                self._stores[version] = store
+            return store
+
+    def versions(self):
+        on_disk = {
+            name for name in os.listdir(self.directory)
+            if os.path.exists(os.path.join(self.directory, name, "meta.json"))
+        }
+        with self._lock:
+            return sorted(on_disk | set(self._stores))
+
+    def add(self, version, defect_id, project_id, embedding):
+        """Index a defect under the version that captioned it, dropping any row another version holds."""
+        for other in self.versions():
+            if other != version:
+                self.store(other).remove(defect_id)
+        self.store(version).add(defect_id, project_id, embedding)
+
+    def remove(self, defect_id):
+        return any([self.store(version).remove(defect_id) for version in self.versions()])
+
+    def remove_project(self, project_id):
+        for version in self.versions():
+            self.store(version).remove_project(project_id)
@@ -4,14 +4,22 @@ from PIL import Image
 from transformers import VisionEncoderDecoderModel, ViTImageProcessor
 from tokenizer import ThaiTokenizerV2
 import config
+import metrics
+import tiling
+from defect_head import DefectHead, label_from_caption
+from fast_generate import FastCaptionGenerator
 
 class ImageCaptioningEngine:
-    def __init__(self, model_path=None, **kwargs):
+    def __init__(self, model_path=None, version=None, **kwargs):
         self.device = config.DEVICE
         self.model_path = model_path if model_path else config.MODEL_PATH
+        # Name recorded on every DefectRecord this engine captions
+        self.version = version or (os.path.basename(os.path.normpath(model_path)) if model_path else config.MODEL_VERSION)
         self.model = None
         self.tokenizer = None
         self.processor = None
+        self.fast_generator = None
+        self.defect_head = None
         self.model_kwargs = kwargs
         
         self._load_model()
@@ -30,12 +38,117 @@ class ImageCaptioningEngine:
             self.processor = ViTImageProcessor.from_pretrained(self.model_path)
             
             self.model.to(self.device)
+            self.model.eval()
+            if config.FAST_GENERATE and FastCaptionGenerator.is_supported_model(self.model):
+                self.fast_generator = FastCaptionGenerator(
+                    self.model, bucket=config.GENERATE_LENGTH_BUCKET, compile=config.FAST_GENERATE_COMPILE
+                )
+            self.defect_head = DefectHead.load(self.model_path, self.device)
+            metrics.MODEL_MEMORY_BYTES.set(metrics.model_memory_bytes(self.model))
             print(f"✅ Model loaded on {self.device}!")
         except Exception as e:
             print(f"❌ Error loading model: {e}")
             raise e
 
-    def predict(self, image_source, max_length=50, num_beams=4):
+    def _load_image(self, image_source):
+        if isinstance(image_source, str):
+            return Image.open(image_source).convert("RGB")
+        return image_source if image_source.mode == "RGB" else image_source.convert("RGB")
+
+    def preprocess(self, images):
+        """
+        Convert a list of images (paths or PIL) into a pixel_values batch on the engine device.
+        """
+        images = [self._load_image(img) for img in images]
+        with metrics.PREDICT_STAGE_SECONDS.time(stage="preprocess"):
+            pixel_values = self.processor(images=images, return_tensors="pt").pixel_values
+        return pixel_values.to(self.device, dtype=self.model.dtype)
+
+    def generate(self, pixel_values, max_length=None, num_beams=None, repetition_penalty=None, on_step=None,
+                 encoder_hidden_states=None, return_scores=False):
+        """
+        Run the decoder over a pixel_values batch and return output token ids. Unset settings come from config.
+        on_step(sequences) receives the best partial hypotheses after each token, and precomputed
+        encoder_hidden_states skip the ViT pass (both fast generator only).
+        With return_scores, returns (output_ids, scores): each caption's mean token
+        log-probability from the search itself.
+        """
+        kwargs = {
+            "max_length": max_length or config.MAX_LENGTH,
+            "num_beams": num_beams or config.NUM_BEAMS,
+            "repetition_penalty": repetition_penalty or config.REPETITION_PENALTY,
+        }
+        with metrics.PREDICT_STAGE_SECONDS.time(stage="generate"), torch.no_grad():
+            output = None
+            if self.fast_generator is not None:
+                output = self.fast_generator.generate(
+                    pixel_values, on_step=on_step, encoder_hidden_states=encoder_hidden_states,
+                    return_scores=return_scores, **kwargs
+                )
+            if output is None:
+                if not return_scores:
+                    return self.model.generate(pixel_values, **kwargs)
+                generated = self.model.generate(pixel_values, output_scores=True, return_dict_in_generate=True, **kwargs)
+                if kwargs["num_beams"] == 1:
+                    return generated.sequences, self._greedy_scores(generated)
+                output = generated.sequences, generated.sequences_scores
+            if not return_scores or kwargs["num_beams"] == 1:
+                return output
+            # Beam scores are divided by length ** length_penalty; undo that down to a per-token mean
+            sequences, scores = output
+            length_penalty = self.model.generation_config.length_penalty
+            if length_penalty is not None and length_penalty != 1.0:
+                lengths = self._live_tokens(sequences).sum(dim=1).clamp(min=1).to(scores.dtype)
+                scores = scores * lengths ** (length_penalty - 1.0)
+            return sequences, scores
+
+    def _live_tokens(self, sequences):
+        """Mask of generated tokens (after the start token) up to and including the first EOS."""
+        tokens = sequences[:, 1:]
+        eos = torch.zeros_like(tokens, dtype=torch.bool)
+        if self.model.generation_config.eos_token_id is not None:
+            eos = torch.isin(tokens, torch.tensor(self.model.generation_config.eos_token_id, device=tokens.device))
+        # Positions after the first EOS are padding
+        return (eos.long().cumsum(dim=1) - eos.long()) == 0
+
+    def _greedy_scores(self, output):
+        """Mean token log-probability of greedy model.generate output, up to and including EOS."""
+        token_scores = self.model.compute_transition_scores(output.sequences, output.scores, normalize_logits=True)
+        live = self._live_tokens(output.sequences)
+        return (token_scores * live).sum(dim=1) / live.sum(dim=1).clamp(min=1)
+
+    def warmup(self, settings=({},)):
+        """Decode a dummy image per generate() setting so compilation and allocator growth happen before traffic."""
+        if self.fast_generator is None:
+            return
+        size = self.processor.size
+        image_size = size.get("height") or size.get("shortest_edge")
+        print("🔥 Warming up decoder...")
+        pixel_values = torch.zeros((1, 3, image_size, image_size), dtype=self.model.dtype, device=self.device)
+        for kwargs in settings:
+            self.generate(pixel_values, **kwargs)
+
+    def embed(self, pixel_values):
+        """Mean-pooled encoder embeddings [N, hidden] plus the encoder states they were pooled from."""
+        with metrics.PREDICT_STAGE_SECONDS.time(stage="encode"), torch.no_grad():
+            hidden = self.model.encoder(pixel_values=pixel_values).last_hidden_state
+        return hidden.mean(dim=1).float(), hidden
+
+    def triage(self, embeddings, captions):
+        """
+        {"label", "severity"} per image from its pooled encoder embedding. Without a
+        trained defect head the label comes from the caption and severity is None.
+        """
+        if self.defect_head is not None:
+            return [{"label": p["label"], "severity": p["severity"]} for p in self.defect_head.predict(embeddings)]
+        return [{"label": label_from_caption(caption), "severity": None} for caption in captions]
+
+    def decode(self, output_ids):
+        """Turn generated token ids into caption strings."""
+        with metrics.PREDICT_STAGE_SECONDS.time(stage="token_decode"):
+            return self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+
+    def predict(self, image_source, max_length=None, num_beams=None, repetition_penalty=None):
         """
         Predict caption for a single image.
         Args:
@@ -43,20 +156,105 @@ class ImageCaptioningEngine:
         Returns:
             str: Generated caption
         """
-        if isinstance(image_source, str):
-            image = Image.open(image_source).convert("RGB")
-        else:
-            image = image_source.convert("RGB")
+        return self.predict_batch(
+            [image_source], max_length=max_length, num_beams=num_beams, repetition_penalty=repetition_penalty
+        )[0]
 
-        pixel_values = self.processor(images=image, return_tensors="pt").pixel_values.to(self.device)
-        
-        with torch.no_grad():
-            output_ids = self.model.generate(
-                pixel_values, 
-                max_length=max_length, 
-                num_beams=num_beams, 
-                repetition_penalty=2.0
+    def predict_batch(self, image_sources, max_length=None, num_beams=None, repetition_penalty=None, on_tokens=None):
+        """
+        Predict captions for several images in one generate call.
+        Args:
+            image_sources: List of image paths or PIL Image objects
+            on_tokens: Optional callback(index, token_ids) with each image's partial caption ids
+        Returns:
+            list[str]: Generated captions, in input order
+        """
+        pixel_values = self.preprocess(image_sources)
+        on_step = None
+        if on_tokens is not None:
+            def on_step(sequences):
+                for i, ids in enumerate(sequences.tolist()):
+                    on_tokens(i, ids)
+        output_ids = self.generate(
+            pixel_values, max_length=max_length, num_beams=num_beams,
+            repetition_penalty=repetition_penalty, on_step=on_step,
+        )
+        return self.decode(output_ids)
+
+    def _tiles(self, images):
+        """Crops of every tile of every image, pre-scaled to the encoder input, as (owner index, box, crop)."""
+        size = self.processor.size
+        side = size.get("height") or size.get("shortest_edge")
+        tiles = []
+        for owner, image in enumerate(images):
+            boxes = tiling.tile_boxes(*image.size, config.TILE_SIZE, config.TILE_OVERLAP, config.TILE_MAX_TILES)
+            if len(boxes) == 1:
+                continue
+            for box in boxes:
+                # Crop and downscale in one pass; the processor then only normalizes
+                tiles.append((owner, box, image.resize((side, side), Image.BILINEAR, box=box, reducing_gap=2.0)))
+        return tiles
+
+    def caption_batch(self, image_sources, max_length=None, num_beams=None, repetition_penalty=None,
+                      on_tokens=None, reuse=None, tiled=False):
+        """
+        Like predict_batch, but also returns each image's encoder embedding and lets
+        near-duplicates skip the decoder.
+        Args:
+            image_sources: List of image paths or PIL Image objects
+            on_tokens: Optional callback(index, token_ids) with each decoded image's partial caption ids
+            reuse: Optional callback(embeddings) returning, per image, None or the
+                (defect_id, caption, confidence) of an existing photo whose caption should be reused
+            tiled: Also caption overlapping tiles of large images (see tiling.py), in the
+                same encoder and decoder batch as the whole images
+        Returns:
+            list[dict]: {"caption", "confidence", "label", "severity", "embedding" (float32 numpy),
+                "reused_from"} per image, in input order, plus "regions" ([{"caption", "boxes"}]) when tiled.
+                Confidence is the caption's geometric-mean token probability from the search
+                scores; label and severity come from triage().
+        """
+        images = [self._load_image(img) for img in image_sources]
+        tiles = self._tiles(images) if tiled else []
+        pixel_values = self.preprocess(images + [crop for _, _, crop in tiles])
+        embeddings, hidden = self.embed(pixel_values)
+        vectors = embeddings[:len(images)].cpu().numpy()
+        matches = reuse(vectors) if reuse is not None else [None] * len(vectors)
+        captions = [match[1] if match else None for match in matches]
+        confidences = [match[2] if match else None for match in matches]
+
+        # Rows to decode: whole images without a reusable caption, then every tile
+        todo = [i for i, match in enumerate(matches) if match is None]
+        rows = todo + list(range(len(images), len(images) + len(tiles)))
+        tile_captions = []
+        if rows:
+            on_step = None
+            if on_tokens is not None:
+                def on_step(sequences):
+                    for j, ids in enumerate(sequences[:len(todo)].tolist()):
+                        on_tokens(todo[j], ids)
+            index = torch.tensor(rows, device=pixel_values.device)
+            output_ids, scores = self.generate(
+                pixel_values[index], max_length=max_length, num_beams=num_beams,
+                repetition_penalty=repetition_penalty, on_step=on_step, encoder_hidden_states=hidden[index],
+                return_scores=True,
             )
-        
-        caption = self.tokenizer.decode(output_ids[0], skip_special_tokens=True)
-        return caption
+            decoded = self.decode(output_ids)
+            for i, caption, score in zip(todo, decoded, scores.exp().tolist()):
+                captions[i] = caption
+                confidences[i] = round(score, 4)
+            tile_captions = decoded[len(todo):]
+
+        results = [
+            {"caption": caption, "confidence": confidence, **triage, "embedding": vector,
+             "reused_from": match[0] if match else None}
+            for caption, confidence, triage, vector, match in zip(
+                captions, confidences, self.triage(embeddings[:len(images)], captions), vectors, matches
+            )
+        ]
+        if tiled:
+            for owner, result in enumerate(results):
+                result["regions"] = tiling.merge_regions(
+                    [(caption, box) for (tile_owner, box, _), caption in zip(tiles, tile_captions) if tile_owner == owner],
+                    similarity=config.TILE_MERGE_SIMILARITY,
+                )
+        return results
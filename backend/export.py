@@ -0,0 +1,292 @@
+"""
+Streaming ZIP export of a project's photos and defect metadata.
+
+The whole archive is laid out before the first byte is sent. Entries are
+STORED (the photos are JPEGs already), and each entry's CRC goes in a data
+descriptor after its data. Every offset and the total length therefore
+follow from file sizes alone. The response streams straight from disk in
+CHUNK-sized reads, advertises Content-Length, and serves Range requests by
+skipping to the right entry.
+
+A resumed download still needs the CRCs of the entries it skipped, for the
+central directory. Those files are read again but not sent, and their CRCs
+are cached per (path, size, mtime). Memory use is independent of archive
+size. Archives over 4 GiB or 65535 entries switch to Zip64 records.
+"""
+import io
+import os
+import csv
+import json
+import zlib
+import struct
+import threading
+from datetime import datetime
+
+CHUNK = 1024 * 1024
+_MAX32 = 0xFFFFFFFF
+_UTF8_AND_DESCRIPTOR = 0x0808
+_CRC_CACHE_SIZE = 100_000
+
+_crc_cache = {}
+_crc_lock = threading.Lock()
+
+
+def _dos_datetime(moment):
+    moment = max(moment, datetime(1980, 1, 1))
+    date = ((moment.year - 1980) << 9) | (moment.month << 5) | moment.day
+    time = (moment.hour << 11) | (moment.minute << 5) | (moment.second // 2)
+    return time, date
+
+
+class _Entry:
+    __slots__ = ("name", "path", "data", "size", "modified", "offset", "crc", "_key")
+
+    def __init__(self, name, path=None, data=None, modified=None):
+        self.name = name.encode("utf-8")
+        self.path = path
+        self.data = data
+        if path is not None:
+            stat = os.stat(path)
+            self.size = stat.st_size
+            self.modified = datetime.fromtimestamp(stat.st_mtime)
+            self._key = (path, stat.st_size, stat.st_mtime_ns)
+            self.crc = _crc_cache.get(self._key)
+        else:
+            self.size = len(data)
+            self.modified = modified or datetime.now()
+            self._key = None
+            self.crc = zlib.crc32(data)
+        self.offset = 0
+
+    def remember_crc(self, crc):
+        self.crc = crc
+        if self._key is not None:
+            with _crc_lock:
+                if len(_crc_cache) >= _CRC_CACHE_SIZE:
+                    _crc_cache.pop(next(iter(_crc_cache)))
+                _crc_cache[self._key] = crc
+
+
+class ZipStream:
+    """A STORED zip archive of files and in-memory blobs with a precomputed layout."""
+
+    def __init__(self, entries, zip64=None):
+        self.entries = entries
+        self.zip64 = zip64 if zip64 is not None else self._needs_zip64()
+        offset = 0
+        for entry in entries:
+            entry.offset = offset
+            offset += self._local_header_size(entry) + entry.size + self._descriptor_size()
+        self.central_offset = offset
+        self.central_size = sum(46 + len(e.name) + (28 if self.zip64 else 0) for e in entries)
+        self.size = self.central_offset + self.central_size + (56 + 20 if self.zip64 else 0) + 22
+
+    def _needs_zip64(self):
+        if len(self.entries) >= 0xFFFF:
+            return True
+        # Upper bound on the classic layout; anything near 4 GiB goes Zip64
+        total = sum(30 + 46 + 2 * len(e.name) + 16 + e.size for e in self.entries) + 22
+        return total >= _MAX32
+
+    # --- Records ---
+
+    def _local_header_size(self, entry):
+        return 30 + len(entry.name) + (20 if self.zip64 else 0)
+
+    def _descriptor_size(self):
+        return 24 if self.zip64 else 16
+
+    def _version(self):
+        return 45 if self.zip64 else 20
+
+    def _local_header(self, entry):
+        time, date = _dos_datetime(entry.modified)
+        if self.zip64:
+            extra = struct.pack("<HHQQ", 0x0001, 16, entry.size, entry.size)
+            sizes = (_MAX32, _MAX32)
+        else:
+            extra = b""
+            sizes = (entry.size, entry.size)
+        return struct.pack(
+            "<IHHHHHIIIHH", 0x04034B50, self._version(), _UTF8_AND_DESCRIPTOR, 0, time, date,
+            0, *sizes, len(entry.name), len(extra),
+        ) + entry.name + extra
+
+    def _descriptor(self, entry):
+        if self.zip64:
+            return struct.pack("<IIQQ", 0x08074B50, entry.crc, entry.size, entry.size)
+        return struct.pack("<IIII", 0x08074B50, entry.crc, entry.size, entry.size)
+
+    def _central_header(self, entry):
+        time, date = _dos_datetime(entry.modified)
+        if self.zip64:
+            extra = struct.pack("<HHQQQ", 0x0001, 24, entry.size, entry.size, entry.offset)
+            size, offset = _MAX32, _MAX32
+        else:
+            extra = b""
+            size, offset = entry.size, entry.offset
+        return struct.pack(
+            "<IHHHHHHIIIHHHHHII", 0x02014B50, (3 << 8) | self._version(), self._version(),
+            _UTF8_AND_DESCRIPTOR, 0, time, date, entry.crc, size, size,
+            len(entry.name), len(extra), 0, 0, 0, 0o100644 << 16, offset,
+        ) + entry.name + extra
+
+    def _end_records(self):
+        count = len(self.entries)
+        records = b""
+        if self.zip64:
+            zip64_end = self.central_offset + self.central_size
+            records += struct.pack(
+                "<IQHHIIQQQQ", 0x06064B50, 44, 45, 45, 0, 0, count, count, self.central_size, self.central_offset
+            )
+            records += struct.pack("<IIQI", 0x07064B50, 0, zip64_end, 1)
+            return records + struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, 0xFFFF, 0xFFFF, _MAX32, _MAX32, 0)
+        return struct.pack(
+            "<IHHHHIIH", 0x06054B50, 0, 0, count, count, self.central_size, self.central_offset, 0
+        )
+
+    # --- Streaming ---
+
+    def _read_data(self, entry, skip):
+        """Yield entry data from `skip` onwards, computing (or reusing) its CRC on the way."""
+        if entry.data is not None:
+            if skip < entry.size:
+                yield entry.data[skip:]
+            return
+        known = entry.crc is not None
+        crc = 0
+        remaining = entry.size
+        with open(entry.path, "rb") as f:
+            if known and skip:
+                # CRC already known: seek instead of re-reading the skipped part
+                f.seek(min(skip, entry.size))
+                remaining -= min(skip, entry.size)
+                skip = 0
+            while remaining > 0:
+                chunk = f.read(min(CHUNK, remaining))
+                if not chunk:
+                    raise IOError(f"{entry.path} shrank while being exported")
+                remaining -= len(chunk)
+                if not known:
+                    crc = zlib.crc32(chunk, crc)
+                if skip >= len(chunk):
+                    skip -= len(chunk)
+                    continue
+                yield chunk[skip:] if skip else chunk
+                skip = 0
+        if not known:
+            entry.remember_crc(crc)
+
+    def _ensure_crc(self, entry):
+        if entry.crc is None:
+            for _ in self._read_data(entry, entry.size):
+                pass
+
+    def _segments(self):
+        """(offset, length, producer(skip)) for every region of the archive, in order."""
+        for entry in self.entries:
+            header = self._local_header(entry)
+            data_offset = entry.offset + len(header)
+            yield entry.offset, len(header), lambda skip, h=header: iter((h[skip:],))
+            yield data_offset, entry.size, lambda skip, e=entry: self._read_data(e, skip)
+            yield data_offset + entry.size, self._descriptor_size(), \
+                lambda skip, e=entry: iter((self._ensure_crc(e) or self._descriptor(e)[skip:],))
+        tail_length = self.size - self.central_offset
+        yield self.central_offset, tail_length, self._tail
+
+    def _tail(self, skip):
+        for entry in self.entries:
+            self._ensure_crc(entry)
+        buffer = io.BytesIO()
+        for entry in self.entries:
+            buffer.write(self._central_header(entry))
+            if buffer.tell() >= CHUNK:
+                yield from self._take(buffer, skip)
+                skip = max(0, skip - buffer.tell())
+                buffer = io.BytesIO()
+        buffer.write(self._end_records())
+        yield from self._take(buffer, skip)
+
+    @staticmethod
+    def _take(buffer, skip):
+        data = buffer.getvalue()
+        if skip < len(data):
+            yield data[skip:]
+
+    def stream(self, start=0, end=None):
+        """Yield archive bytes [start, end] (inclusive, like an HTTP byte range)."""
+        end = self.size - 1 if end is None else min(end, self.size - 1)
+        for offset, length, produce in self._segments():
+            if offset + length <= start:
+                # Before the range; CRCs of skipped entries are filled in when the directory needs them
+                continue
+            if offset > end:
+                return
+            position = max(start, offset)
+            for chunk in produce(position - offset):
+                if position + len(chunk) > end + 1:
+                    yield chunk[:end + 1 - position]
+                    return
+                yield chunk
+                position += len(chunk)
+
+
+MANIFEST_FIELDS = [
+    "id", "filename", "caption", "label", "confidence", "room", "severity", "timestamp",
+    "image_path", "archive_path", "project_id", "decoding_profile", "model_version", "duplicate_of",
+]
+
+
+def build_manifest(rows):
+    """(json_bytes, csv_bytes) for manifest rows (dicts keyed by MANIFEST_FIELDS)."""
+    as_json = json.dumps(rows, ensure_ascii=False, indent=2, default=str).encode("utf-8")
+    text = io.StringIO()
+    writer = csv.DictWriter(text, fieldnames=MANIFEST_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(rows)
+    # BOM so Excel opens the Thai captions as UTF-8
+    return as_json, ("\ufeff" + text.getvalue()).encode("utf-8")
+
+
+def build_project_archive(project, defects, outputs_dir, include_images=True, zip64=None):
+    """Lay out the export ZIP for a project: manifest.json, manifest.csv and images/."""
+    entries, rows = [], []
+    for defect in defects:
+        row = {field: getattr(defect, field, None) for field in MANIFEST_FIELDS}
+        if isinstance(row["timestamp"], datetime):
+            row["timestamp"] = row["timestamp"].isoformat()
+        row["archive_path"] = None
+        full_path = os.path.join(outputs_dir, defect.image_path) if defect.image_path else None
+        if include_images and full_path and os.path.isfile(full_path):
+            row["archive_path"] = f"images/{defect.id}_{os.path.basename(defect.image_path)}"
+            entries.append(_Entry(row["archive_path"], path=full_path))
+        rows.append(row)
+
+    modified = project.created_at
+    manifest_json, manifest_csv = build_manifest(rows)
+    head = [
+        _Entry("manifest.json", data=manifest_json, modified=modified),
+        _Entry("manifest.csv", data=manifest_csv, modified=modified),
+    ]
+    return ZipStream(head + entries, zip64=zip64)
+
+
+def parse_range(header, size):
+    """
+    (start, end) for a single "bytes=" range header, None when absent or unsupported
+    (the full body is sent), or raise ValueError when it cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            start, end = max(0, size - int(last)), size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
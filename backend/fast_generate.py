@@ -0,0 +1,401 @@
+"""
+KV-cached greedy/beam decoding specialised for the ViT-GPT2 captioner.
+
+Hugging Face `generate` is generic: every step rebuilds inputs, grows a
+dynamic cache with torch.cat and goes through several layers of Python
+dispatch. This module encodes the image once, precomputes cross-attention
+keys/values, and runs the GPT2 decoder one token at a time against a KV
+cache that is allocated once for the whole caption. The search logic
+mirrors `GenerationMixin._sample` / `_beam_search` and reuses the HF logits
+processors, so outputs match `model.generate` token for token.
+
+With compile=True the per-token step runs under torch.compile. Cache
+lengths are rounded up to a bucket so the step sees a small fixed set of
+shapes instead of recompiling for every position.
+"""
+import copy
+
+import torch
+import torch.nn.functional as F
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    MinLengthLogitsProcessor,
+    NoRepeatNGramLogitsProcessor,
+    RepetitionPenaltyLogitsProcessor,
+)
+
+# Generation options the fast path does not implement; any of these set to a
+# non-default value sends the call back to model.generate.
+_UNSUPPORTED_DEFAULTS = {
+    "do_sample": False,
+    "num_beam_groups": 1,
+    "num_return_sequences": 1,
+    "max_new_tokens": None,
+    "min_new_tokens": None,
+    "guidance_scale": None,
+    "sequence_bias": None,
+    "bad_words_ids": None,
+    "force_words_ids": None,
+    "constraints": None,
+    "forced_bos_token_id": None,
+    "forced_eos_token_id": None,
+    "suppress_tokens": None,
+    "begin_suppress_tokens": None,
+    "exponential_decay_length_penalty": None,
+    "stop_strings": None,
+    "max_time": None,
+    "watermarking_config": None,
+}
+
+
+def bucket_length(length, bucket=16):
+    """Round a cache length up to the next multiple of `bucket`."""
+    return ((length + bucket - 1) // bucket) * bucket
+
+
+class FastCaptionGenerator:
+    def __init__(self, model, bucket=16, compile=False):
+        if not self.is_supported_model(model):
+            raise ValueError("FastCaptionGenerator needs a VisionEncoderDecoderModel with a GPT2 decoder")
+        self.model = model
+        self.bucket = bucket
+        decoder = model.decoder
+        self.transformer = decoder.transformer
+        self.lm_head = decoder.lm_head
+        cfg = decoder.config
+        self.num_layers = cfg.n_layer
+        self.num_heads = cfg.n_head
+        self.head_dim = cfg.n_embd // cfg.n_head
+        self.embed_dim = cfg.n_embd
+        self.vocab_size = cfg.vocab_size
+        self._scales = []
+        for i in range(self.num_layers):
+            scale = self.head_dim ** -0.5 if cfg.scale_attn_weights else 1.0
+            if cfg.scale_attn_by_inverse_layer_idx:
+                scale /= float(i + 1)
+            self._scales.append(scale)
+
+        self.compiled = False
+        self._step = self._step_eager
+        if compile:
+            try:
+                self._step = torch.compile(self._step_bucketed, dynamic=False)
+                self.compiled = True
+            except Exception as e:
+                print(f"⚠️ torch.compile unavailable, using eager decode loop: {e}")
+
+    @staticmethod
+    def is_supported_model(model):
+        decoder = getattr(model, "decoder", None)
+        return (
+            hasattr(model, "encoder")
+            and decoder is not None
+            and decoder.config.model_type == "gpt2"
+            and getattr(decoder.config, "add_cross_attention", False)
+        )
+
+    # --- Config ---
+
+    def resolve_config(self, **kwargs):
+        """Merge call kwargs into the model's generation config, as generate() does."""
+        gen_cfg = copy.deepcopy(self.model.generation_config)
+        if hasattr(gen_cfg, "_get_default_generation_params"):
+            # transformers v5 leaves unset fields as None and fills global defaults at generate time
+            gen_cfg.update(**gen_cfg._get_default_generation_params(), defaults_only=True)
+        gen_cfg.update(**kwargs)
+        if gen_cfg.decoder_start_token_id is None:
+            gen_cfg.decoder_start_token_id = gen_cfg.bos_token_id
+        return gen_cfg
+
+    def supports(self, gen_cfg):
+        for name, default in _UNSUPPORTED_DEFAULTS.items():
+            value = getattr(gen_cfg, name, default)
+            if value is not None and value != default:
+                return False
+        if gen_cfg.encoder_repetition_penalty not in (None, 1.0):
+            return False
+        if gen_cfg.encoder_no_repeat_ngram_size not in (None, 0):
+            return False
+        if gen_cfg.decoder_start_token_id is None or gen_cfg.max_length is None:
+            return False
+        return True
+
+    def _logits_processors(self, gen_cfg, eos_ids, device):
+        # Same order as GenerationMixin._get_logits_processor for the supported subset
+        processors = LogitsProcessorList()
+        if gen_cfg.repetition_penalty is not None and gen_cfg.repetition_penalty != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(penalty=float(gen_cfg.repetition_penalty)))
+        if gen_cfg.no_repeat_ngram_size is not None and gen_cfg.no_repeat_ngram_size > 0:
+            processors.append(NoRepeatNGramLogitsProcessor(gen_cfg.no_repeat_ngram_size))
+        if gen_cfg.min_length is not None and eos_ids is not None and gen_cfg.min_length > 0:
+            processors.append(MinLengthLogitsProcessor(gen_cfg.min_length, eos_ids, device=device))
+        return processors
+
+    # --- Model pieces ---
+
+    @torch.no_grad()
+    def encode(self, pixel_values, encoder_hidden_states=None):
+        """Run the ViT once (unless its output is passed in) and return decoder-ready encoder states."""
+        hidden = encoder_hidden_states
+        if hidden is None:
+            hidden = self.model.encoder(pixel_values=pixel_values).last_hidden_state
+        if getattr(self.model, "enc_to_dec_proj", None) is not None:
+            hidden = self.model.enc_to_dec_proj(hidden)
+        return hidden
+
+    def _split_heads(self, x):
+        n, s, _ = x.shape
+        return x.view(n, s, self.num_heads, self.head_dim).transpose(1, 2)
+
+    @torch.no_grad()
+    def cross_kv(self, encoder_hidden):
+        """Cross-attention keys/values per layer, computed once per image: [layers, N, H, S, D]."""
+        keys, values = [], []
+        for block in self.transformer.h:
+            k, v = block.crossattention.c_attn(encoder_hidden).split(self.embed_dim, dim=2)
+            keys.append(self._split_heads(k))
+            values.append(self._split_heads(v))
+        return torch.stack(keys), torch.stack(values)
+
+    def allocate_cache(self, rows, max_length, dtype, device):
+        length = bucket_length(max_length, self.bucket)
+        shape = (self.num_layers, rows, self.num_heads, length, self.head_dim)
+        return torch.zeros(shape, dtype=dtype, device=device), torch.zeros(shape, dtype=dtype, device=device)
+
+    def _block_forward(self, hidden, pos, k_cache, v_cache, cross_k, cross_v, attend):
+        """One token through every decoder block. `attend(layer, q, k_cache, v_cache)` does self-attention."""
+        for i, block in enumerate(self.transformer.h):
+            residual = hidden
+            q, k, v = block.attn.c_attn(block.ln_1(hidden)).split(self.embed_dim, dim=2)
+            k_cache[i].index_copy_(2, pos, self._split_heads(k))
+            v_cache[i].index_copy_(2, pos, self._split_heads(v))
+            attn = attend(i, self._split_heads(q), k_cache[i], v_cache[i])
+            hidden = residual + block.attn.c_proj(attn.transpose(1, 2).reshape(hidden.shape))
+
+            residual = hidden
+            q = block.crossattention.q_attn(block.ln_cross_attn(hidden))
+            attn = F.scaled_dot_product_attention(
+                self._split_heads(q), cross_k[i], cross_v[i], scale=self._scales[i]
+            )
+            hidden = residual + block.crossattention.c_proj(attn.transpose(1, 2).reshape(hidden.shape))
+
+            hidden = hidden + block.mlp(block.ln_2(hidden))
+        return self.lm_head(self.transformer.ln_f(hidden))[:, -1, :]
+
+    def _embed(self, tokens, pos):
+        return (self.transformer.wte(tokens) + self.transformer.wpe(pos)).unsqueeze(1)
+
+    def _step_eager(self, tokens, pos, k_cache, v_cache, cross_k, cross_v):
+        # Attend over exactly the filled prefix, matching the HF cache shapes
+        length = int(pos.item()) + 1
+
+        def attend(i, q, kc, vc):
+            return F.scaled_dot_product_attention(q, kc[:, :, :length], vc[:, :, :length], scale=self._scales[i])
+
+        return self._block_forward(self._embed(tokens, pos), pos, k_cache, v_cache, cross_k, cross_v, attend)
+
+    def _step_bucketed(self, tokens, pos, k_cache, v_cache, cross_k, cross_v):
+        # Attend over the whole bucket with a mask so shapes stay static under torch.compile
+        mask = (torch.arange(k_cache.shape[3], device=pos.device) <= pos).view(1, 1, 1, -1)
+
+        def attend(i, q, kc, vc):
+            return F.scaled_dot_product_attention(q, kc, vc, attn_mask=mask, scale=self._scales[i])
+
+        return self._block_forward(self._embed(tokens, pos), pos, k_cache, v_cache, cross_k, cross_v, attend)
+
+    # --- Search ---
+
+    @torch.no_grad()
+    def generate(self, pixel_values, on_step=None, encoder_hidden_states=None, return_scores=False, **kwargs):
+        """
+        Drop-in for `model.generate(pixel_values, **kwargs)` for greedy and beam search.
+        Returns None if the requested configuration is not supported, so callers can fall back.
+
+        `on_step(sequences)` is called after every decoding step with the current
+        best hypothesis per input image ([batch, cur_len] token ids): the sequence
+        itself for greedy decoding, the top running beam for beam search.
+        Passing the ViT's `encoder_hidden_states` skips re-encoding the images.
+        With `return_scores` the result is (sequences, scores): each sequence's
+        log-probability divided by its length (to the power of length_penalty
+        for beam search), as in `sequences_scores` from model.generate.
+        """
+        gen_cfg = self.resolve_config(**kwargs)
+        if not self.supports(gen_cfg):
+            return None
+
+        device = pixel_values.device
+        eos = gen_cfg.eos_token_id
+        eos_ids = None
+        if eos is not None:
+            eos_ids = torch.tensor(eos if isinstance(eos, list) else [eos], device=device)
+        pad_id = gen_cfg.pad_token_id if gen_cfg.pad_token_id is not None else (
+            int(eos_ids[0]) if eos_ids is not None else None
+        )
+        processors = self._logits_processors(gen_cfg, eos_ids, device)
+
+        encoder_hidden = self.encode(pixel_values, encoder_hidden_states)
+        if gen_cfg.num_beams and gen_cfg.num_beams > 1:
+            sequences, scores = self._beam_search(encoder_hidden, gen_cfg, processors, eos_ids, pad_id, on_step)
+        else:
+            sequences, scores = self._greedy(encoder_hidden, gen_cfg, processors, eos_ids, pad_id, on_step)
+        return (sequences, scores) if return_scores else sequences
+
+    def _greedy(self, encoder_hidden, gen_cfg, processors, eos_ids, pad_id, on_step=None):
+        batch_size = encoder_hidden.shape[0]
+        device = encoder_hidden.device
+        max_length = gen_cfg.max_length
+
+        cross_k, cross_v = self.cross_kv(encoder_hidden)
+        k_cache, v_cache = self.allocate_cache(batch_size, max_length, encoder_hidden.dtype, device)
+        sequences = torch.full((batch_size, max_length), pad_id if pad_id is not None else 0, dtype=torch.long, device=device)
+        sequences[:, 0] = gen_cfg.decoder_start_token_id
+        unfinished = torch.ones(batch_size, dtype=torch.long, device=device)
+        log_prob_sum = torch.zeros(batch_size, dtype=torch.float32, device=device)
+        generated = torch.zeros(batch_size, dtype=torch.float32, device=device)
+
+        cur_len = 1
+        while cur_len < max_length:
+            pos = torch.tensor([cur_len - 1], device=device)
+            logits = self._step(sequences[:, cur_len - 1], pos, k_cache, v_cache, cross_k, cross_v)
+            scores = processors(sequences[:, :cur_len], logits.to(dtype=torch.float32))
+            next_tokens = torch.argmax(scores, dim=-1)
+            token_log_probs = F.log_softmax(scores, dim=-1).gather(1, next_tokens[:, None]).squeeze(1)
+            log_prob_sum += token_log_probs * unfinished
+            generated += unfinished
+            if eos_ids is not None:
+                next_tokens = next_tokens * unfinished + pad_id * (1 - unfinished)
+            sequences[:, cur_len] = next_tokens
+            cur_len += 1
+            if on_step is not None:
+                on_step(sequences[:, :cur_len])
+
+            done = torch.zeros_like(unfinished, dtype=torch.bool) | (cur_len >= max_length)
+            if eos_ids is not None:
+                done = done | torch.isin(next_tokens, eos_ids)
+            unfinished = unfinished & ~done
+            if unfinished.max() == 0:
+                break
+        return sequences[:, :cur_len], log_prob_sum / generated.clamp(min=1)
+
+    @staticmethod
+    def _gather(tensor, indices):
+        while indices.dim() < tensor.dim():
+            indices = indices.unsqueeze(-1)
+        return torch.take_along_dim(tensor, indices, dim=1)
+
+    def _beam_search(self, encoder_hidden, gen_cfg, processors, eos_ids, pad_id, on_step=None):
+        batch_size = encoder_hidden.shape[0]
+        num_beams = gen_cfg.num_beams
+        device = encoder_hidden.device
+        max_length = gen_cfg.max_length
+        length_penalty = gen_cfg.length_penalty
+        early_stopping = gen_cfg.early_stopping
+        vocab_size = self.vocab_size
+        rows = batch_size * num_beams
+        prompt_len = 1
+
+        # Beams share the image: expand encoder-side tensors once
+        encoder_hidden = encoder_hidden.repeat_interleave(num_beams, dim=0)
+        cross_k, cross_v = self.cross_kv(encoder_hidden)
+        k_cache, v_cache = self.allocate_cache(rows, max_length, encoder_hidden.dtype, device)
+
+        n_eos = eos_ids.shape[0] if eos_ids is not None else 0
+        beams_to_keep = max(2, 1 + n_eos) * num_beams
+        top_num_beam_mask = torch.cat((
+            torch.ones(num_beams, dtype=torch.bool), torch.zeros(beams_to_keep - num_beams, dtype=torch.bool)
+        )).to(device)
+
+        # Same fill rule as _beam_search (a pad id of 0 falls through to EOS there too)
+        fill = (pad_id or int(eos_ids[0])) if eos_ids is not None else -1
+        running_sequences = torch.full((batch_size, num_beams, max_length), fill, dtype=torch.long, device=device)
+        running_sequences[:, :, 0] = gen_cfg.decoder_start_token_id
+        sequences = running_sequences.clone()
+        running_beam_scores = torch.zeros((batch_size, num_beams), dtype=torch.float, device=device)
+        running_beam_scores[:, 1:] = -1e9
+        beam_scores = torch.full((batch_size, num_beams), -1e9, dtype=torch.float, device=device)
+        is_sent_finished = torch.zeros((batch_size, num_beams), dtype=torch.bool, device=device)
+        heuristic_unsatisfied = torch.ones((batch_size, 1), dtype=torch.bool, device=device)
+        running_beam_indices = torch.full(
+            (batch_size, num_beams, max_length - prompt_len), -1, dtype=torch.int32, device=device
+        )
+        beam_indices = running_beam_indices.clone()
+        batch_offset = torch.arange(batch_size, device=device).view(-1, 1) * num_beams
+
+        cur_len = prompt_len
+        while True:
+            flat_running = running_sequences[:, :, :cur_len].reshape(rows, cur_len)
+            pos = torch.tensor([cur_len - 1], device=device)
+            logits = self._step(flat_running[:, -1], pos, k_cache, v_cache, cross_k, cross_v)
+            log_probs = F.log_softmax(logits.to(dtype=torch.float32), dim=-1)
+            log_probs = processors(flat_running, log_probs)
+            log_probs = log_probs.view(batch_size, num_beams, vocab_size) + running_beam_scores[:, :, None]
+            log_probs = log_probs.view(batch_size, num_beams * vocab_size)
+
+            # Top-K continuations over all beams
+            topk_log_probs, topk_indices = torch.topk(log_probs, k=beams_to_keep)
+            topk_beam = topk_indices // vocab_size
+            topk_running_beam_indices = self._gather(running_beam_indices, topk_beam)
+            topk_running_sequences = self._gather(running_sequences, topk_beam)
+            topk_ids = topk_indices % vocab_size
+            topk_running_sequences[:, :, cur_len] = topk_ids
+            topk_running_beam_indices[:, :, cur_len - prompt_len] = (topk_beam + batch_offset).to(torch.int32)
+
+            # Which continuations hit EOS or max_length
+            hits_stop = torch.full_like(topk_ids, cur_len + 1 >= max_length, dtype=torch.bool)
+            if eos_ids is not None:
+                hits_stop = hits_stop | torch.isin(topk_ids, eos_ids)
+
+            # Best still-running beams for the next step
+            topk_running_log_probs = topk_log_probs + hits_stop.to(torch.float32) * -1.0e9
+            next_topk = torch.topk(topk_running_log_probs, k=num_beams)[1]
+            running_sequences = self._gather(topk_running_sequences, next_topk)
+            running_beam_scores = self._gather(topk_running_log_probs, next_topk)
+            running_beam_indices = self._gather(topk_running_beam_indices, next_topk)
+
+            # Merge newly finished hypotheses into the finished set
+            just_finished = hits_stop & top_num_beam_mask[None, :]
+            finished_scores = topk_log_probs / ((cur_len + 1 - prompt_len) ** length_penalty)
+            beams_full = torch.all(is_sent_finished, dim=-1, keepdim=True) & (early_stopping is True)
+            finished_scores = finished_scores + beams_full.to(torch.float32) * -1.0e9
+            finished_scores = finished_scores + (~heuristic_unsatisfied).to(torch.float32) * -1.0e9
+            finished_scores = finished_scores + (~just_finished) * -1.0e9
+            merged_sequences = torch.cat((sequences, topk_running_sequences), dim=1)
+            merged_scores = torch.cat((beam_scores, finished_scores), dim=1)
+            merged_indices = torch.cat((beam_indices, topk_running_beam_indices), dim=1)
+            merged_finished = torch.cat((is_sent_finished, just_finished), dim=1)
+            keep = torch.topk(merged_scores, k=num_beams)[1]
+            sequences = self._gather(merged_sequences, keep)
+            beam_scores = self._gather(merged_scores, keep)
+            beam_indices = self._gather(merged_indices, keep)
+            is_sent_finished = self._gather(merged_finished, keep)
+
+            # Reorder the KV cache to follow the surviving beams
+            beam_idx = running_beam_indices[..., cur_len - prompt_len].reshape(-1).long()
+            k_cache = k_cache.index_select(1, beam_idx)
+            v_cache = v_cache.index_select(1, beam_idx)
+
+            cur_len += 1
+            if on_step is not None:
+                on_step(running_sequences[:, 0, :cur_len])
+
+            # Early-stop heuristic and loop condition, as in _beam_search
+            if early_stopping == "never" and length_penalty > 0.0:
+                best_len = max_length - prompt_len
+            else:
+                best_len = cur_len - prompt_len
+            best_running = running_beam_scores[:, :1] / (best_len ** length_penalty)
+            worst_finished = torch.where(
+                is_sent_finished, torch.min(beam_scores, dim=1, keepdim=True)[0], -1.0e9
+            )
+            heuristic_unsatisfied = heuristic_unsatisfied & torch.any(best_running > worst_finished, dim=-1, keepdim=True)
+
+            improvement_possible = torch.any(heuristic_unsatisfied)
+            open_beam = ~(torch.all(is_sent_finished) & (early_stopping is True))
+            valid_continuations = ~torch.all(hits_stop)
+            if not (improvement_possible and open_beam and valid_continuations):
+                break
+
+        sequences = sequences[:, 0, :]
+        beam_indices = beam_indices[:, 0, :]
+        generated = ((beam_indices + 1).bool()).sum(dim=1).max()
+        return sequences[:, :prompt_len + generated], beam_scores[:, 0]
@@ -0,0 +1,92 @@
+"""
+Conditional GETs, fast JSON and compression for the list endpoints.
+
+Polling clients re-read /defects and /projects far more often than the
+data changes. Responses carry an ETag built from the change-feed version
+(sync.py), which moves on every insert, update or delete, so an unchanged
+list costs one counter lookup and a 304. Fresh lists skip the ORM and
+pydantic round trip: rows are read as plain mappings and serialized with
+orjson when it is installed. Bodies above COMPRESS_MIN_BYTES are brotli
+(if installed) or gzip compressed according to Accept-Encoding.
+"""
+import json
+import gzip
+import zlib
+
+from fastapi import Response
+
+import sync
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = 1024
+
+
+def dumps(data):
+    """JSON bytes with datetimes as ISO strings, matching FastAPI's default output."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=lambda o: o.isoformat()).encode("utf-8")
+
+
+def etag(session, request):
+    """Weak ETag for this URL at the current data version."""
+    path = f"{request.url.path}?{request.url.query}"
+    return f'W/"{sync.current_version(session)}-{zlib.crc32(path.encode("utf-8")):08x}"'
+
+
+def not_modified(request, tag):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or tag in (t.strip() for t in header.split(","))
+
+
+def accepted_encodings(request):
+    encodings = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+def compress(request, body):
+    """Return (body, content_encoding) using the best encoding the client accepts."""
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    encodings = accepted_encodings(request)
+    if brotli is not None and "br" in encodings:
+        return brotli.compress(body, quality=5), "br"
+    if "gzip" in encodings:
+        return gzip.compress(body, compresslevel=6), "gzip"
+    return body, None
+
+
+def json_rows(request, session, query, source=None):
+    """
+    Run a Core select and answer with its rows as a JSON list, or 304 when the
+    client's If-None-Match still matches. The rows are read from `source`
+    (e.g. an archive shard's session) when given, the tag always from `session`.
+    """
+    # Read the version before the rows: a write landing in between then yields a
+    # newer body under an older tag (refetched next time), never the reverse
+    tag = etag(session, request)
+    headers = {"ETag": tag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if not_modified(request, tag):
+        return Response(status_code=304, headers=headers)
+
+    rows = (source or session).connection().execute(query).mappings().all()
+    body, encoding = compress(request, dumps([dict(row) for row in rows]))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
@@ -0,0 +1,302 @@
+"""
+Single-copy inference server.
+
+One process owns the model and listens on a Unix socket. HTTP workers run
+RemoteEngine, which preprocesses images locally and forwards the pixel
+tensors; the server micro-batches concurrent requests into one generate
+call and sends captions back. Memory stays at one model copy no matter how
+many uvicorn workers are running. Requests carry a priority class and
+optional deadline, so bulk clients never hold up interactive ones.
+
+    INFERENCE_SOCKET=/tmp/house-defect.sock TORCH_INTRA_OP_THREADS=8 uv run inference_server.py
+    INFERENCE_SOCKET=/tmp/house-defect.sock uvicorn app:app --workers 4
+"""
+import os
+import sys
+import json
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+
+import torch
+from PIL import Image
+from transformers import ViTImageProcessor
+
+import config
+import metrics
+from scheduler import DeadlineExceeded, InferenceScheduler, deadline_from_ms
+from decoding import PROFILES
+from defect_head import label_from_caption
+
+_FRAME = struct.Struct("!II")  # header length, payload length
+DEFAULT_SOCKET = "/tmp/house-defect-inference.sock"
+
+_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+
+# --- Wire Format ---
+# Each frame is an 8-byte length prefix, a JSON header, then raw tensor bytes.
+# Tensors travel as contiguous buffers described by shape/dtype in the header,
+# so nothing on the socket is ever unpickled.
+
+def _recv_exact(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Socket closed mid-frame")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_frame(sock, header, payload=b""):
+    data = json.dumps(header).encode("utf-8")
+    sock.sendall(_FRAME.pack(len(data), len(payload)) + data)
+    if payload:
+        sock.sendall(payload)
+
+
+def recv_frame(sock):
+    header_len, payload_len = _FRAME.unpack(_recv_exact(sock, _FRAME.size))
+    header = json.loads(_recv_exact(sock, header_len))
+    payload = _recv_exact(sock, payload_len) if payload_len else b""
+    return header, payload
+
+
+def tensor_to_wire(tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    dtype = str(tensor.dtype).replace("torch.", "")
+    if tensor.dtype == torch.bfloat16:
+        payload = tensor.view(torch.int16).numpy().tobytes()
+    else:
+        payload = tensor.numpy().tobytes()
+    return {"shape": list(tensor.shape), "dtype": dtype}, payload
+
+
+def tensor_from_wire(meta, payload):
+    dtype = _DTYPES[meta["dtype"]]
+    if dtype == torch.bfloat16:
+        return torch.frombuffer(bytearray(payload), dtype=torch.int16).view(torch.bfloat16).reshape(meta["shape"])
+    return torch.frombuffer(bytearray(payload), dtype=dtype).reshape(meta["shape"])
+
+
+def configure_torch_threads(intra_op=None, inter_op=None):
+    """Apply explicit torch thread counts; 0/None keeps torch's default."""
+    if intra_op:
+        torch.set_num_threads(intra_op)
+    if inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError as e:
+            # Only allowed before any inter-op parallel work has started
+            print(f"⚠️ Could not set inter-op threads: {e}")
+
+
+# --- Server ---
+
+class InferenceServer:
+    """
+    Owns an ImageCaptioningEngine. Connection threads submit jobs to an
+    InferenceScheduler, whose single worker runs interactive work first and
+    batches jobs that share a priority class and decoding parameters into a
+    single generate call.
+    """
+
+    def __init__(self, engine, socket_path, max_batch=8, bulk_max_batch=2):
+        self.engine = engine
+        self.socket_path = socket_path
+        self.scheduler = InferenceScheduler(self._caption_rows, max_batch=max_batch, bulk_max_batch=bulk_max_batch)
+        self._server = None
+
+    def _caption_rows(self, rows, priority, **params):
+        """{"caption", "confidence", "label", "severity"} per row, from one encoder pass."""
+        pixel_values = torch.stack(rows).to(self.engine.device, dtype=self.engine.model.dtype)
+        embeddings, hidden = self.engine.embed(pixel_values)
+        output_ids, scores = self.engine.generate(
+            pixel_values, encoder_hidden_states=hidden, return_scores=True, **params
+        )
+        captions = self.engine.decode(output_ids)
+        return [
+            {"caption": caption, "confidence": round(score, 4), **triage}
+            for caption, score, triage in zip(captions, scores.exp().tolist(), self.engine.triage(embeddings, captions))
+        ]
+
+    def submit(self, pixel_values, max_length=None, num_beams=None, repetition_penalty=None,
+               priority="interactive", deadline_ms=None):
+        future = self.scheduler.submit(
+            list(pixel_values), priority=priority, deadline=deadline_from_ms(deadline_ms),
+            max_length=max_length, num_beams=num_beams, repetition_penalty=repetition_penalty,
+        )
+        return future.result()
+
+    def _handler(self):
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                # One connection can carry many requests
+                while True:
+                    try:
+                        header, payload = recv_frame(self.request)
+                    except (ConnectionError, struct.error):
+                        return
+                    try:
+                        if header.get("op") == "ping":
+                            send_frame(self.request, {"ok": True, "model_path": server.engine.model_path})
+                            continue
+                        pixel_values = tensor_from_wire(header["tensor"], payload)
+                        results = server.submit(
+                            pixel_values, header.get("max_length"), header.get("num_beams"),
+                            repetition_penalty=header.get("repetition_penalty"),
+                            priority=header.get("priority", "interactive"),
+                            deadline_ms=header.get("deadline_ms"),
+                        )
+                        send_frame(self.request, {
+                            "ok": True, "captions": [r["caption"] for r in results], "results": results,
+                        })
+                    except DeadlineExceeded as e:
+                        send_frame(self.request, {"ok": False, "error": str(e), "deadline_exceeded": True})
+                    except Exception as e:
+                        send_frame(self.request, {"ok": False, "error": str(e)})
+
+        return Handler
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, self._handler())
+        self._server.daemon_threads = True
+        os.chmod(self.socket_path, 0o660)
+        self.scheduler.start()
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"🧠 Inference server listening on {self.socket_path}")
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        self.scheduler.stop()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def serve_forever(self):
+        self.start()
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+# --- Client ---
+
+class RemoteEngine:
+    """
+    Drop-in for ImageCaptioningEngine in HTTP workers. Only the (small)
+    image processor is loaded here; captions come from the inference server.
+    """
+
+    def __init__(self, socket_path, model_path=None):
+        self.socket_path = socket_path
+        self.model_path = model_path if model_path else config.MODEL_PATH
+        self.device = "cpu"
+        self.processor = ViTImageProcessor.from_pretrained(self.model_path)
+        self._local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _request(self, header, payload=b""):
+        for attempt in range(2):
+            try:
+                sock = self._connection()
+                send_frame(sock, header, payload)
+                response, _ = recv_frame(sock)
+                break
+            except (ConnectionError, OSError):
+                # Server restarted or connection went stale; reconnect once
+                self._local.sock = None
+                if attempt:
+                    raise
+        if response.get("deadline_exceeded"):
+            raise DeadlineExceeded(response.get("error"))
+        if not response.get("ok"):
+            raise RuntimeError(f"Inference server error: {response.get('error')}")
+        return response
+
+    def ping(self):
+        return self._request({"op": "ping"})
+
+    def preprocess(self, images):
+        images = [Image.open(img).convert("RGB") if isinstance(img, str) else img.convert("RGB") for img in images]
+        with metrics.PREDICT_STAGE_SECONDS.time(stage="preprocess"):
+            return self.processor(images=images, return_tensors="pt").pixel_values
+
+    def _caption(self, pixel_values, max_length=None, num_beams=None, repetition_penalty=None,
+                 priority="interactive", deadline_ms=None):
+        meta, payload = tensor_to_wire(pixel_values)
+        header = {
+            "op": "caption", "tensor": meta, "max_length": max_length, "num_beams": num_beams,
+            "repetition_penalty": repetition_penalty, "priority": priority, "deadline_ms": deadline_ms,
+        }
+        with metrics.PREDICT_STAGE_SECONDS.time(stage="remote_generate"):
+            return self._request(header, payload)
+
+    def caption_pixel_values(self, pixel_values, **kwargs):
+        return self._caption(pixel_values, **kwargs)["captions"]
+
+    def predict(self, image_source, **kwargs):
+        return self.predict_batch([image_source], **kwargs)[0]
+
+    def predict_batch(self, image_sources, **kwargs):
+        return self.caption_pixel_values(self.preprocess(image_sources), **kwargs)
+
+    def caption_batch(self, image_sources, **kwargs):
+        """
+        Like ImageCaptioningEngine.caption_batch: caption, confidence, label and
+        severity from the server. Embeddings stay on the server, so "embedding" is None.
+        A server too old to send them leaves confidence and severity None.
+        """
+        response = self._caption(self.preprocess(image_sources), **kwargs)
+        results = response.get("results") or [
+            {"caption": caption, "confidence": None, "label": label_from_caption(caption), "severity": None}
+            for caption in response["captions"]
+        ]
+        return [{**result, "embedding": None, "reused_from": None} for result in results]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the captioning model to local HTTP workers over a Unix socket")
+    parser.add_argument("--socket", default=config.INFERENCE_SOCKET or DEFAULT_SOCKET)
+    parser.add_argument("--model-path", default=None)
+    parser.add_argument("--max-batch", type=int, default=config.INFERENCE_MAX_BATCH)
+    parser.add_argument("--bulk-max-batch", type=int, default=config.SCHEDULER_BULK_MAX_BATCH)
+    parser.add_argument("--intra-op-threads", type=int, default=config.TORCH_INTRA_OP_THREADS)
+    parser.add_argument("--inter-op-threads", type=int, default=config.TORCH_INTER_OP_THREADS)
+    args = parser.parse_args(argv)
+
+    configure_torch_threads(args.intra_op_threads, args.inter_op_threads)
+    from engine import ImageCaptioningEngine
+
+    engine = ImageCaptioningEngine(model_path=args.model_path)
+    engine.warmup(PROFILES.values())
+    print(f"🧵 torch threads: intra-op={torch.get_num_threads()}, inter-op={torch.get_num_interop_threads()}")
+    InferenceServer(engine, args.socket, max_batch=args.max_batch, bulk_max_batch=args.bulk_max_batch).serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+Accept-then-process ingestion.
+
+An accepted upload is written to disk and committed as a DefectRecord with
+status "pending" before the client gets its answer. The database is
+therefore the durable queue. IngestWorker claims pending records in
+batches, captions them through the normal inference path, and writes the
+results back in one transaction.
+
+A record moves pending -> captioning -> done (or failed). Claiming a
+record leases it to one worker (claimed_by, claimed_at). Leases older than
+the lease period were left by a worker that crashed or restarted, and are
+returned to "pending", so no accepted upload is lost. Live workers in other
+processes keep theirs. Clients see the finished caption through /sync,
+because every status change bumps the record's version.
+"""
+import os
+import uuid
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, or_, text, update
+from sqlmodel import Session, select
+
+import database
+import sync
+from models import DefectRecord
+
+PENDING = "pending"
+CAPTIONING = "captioning"
+DONE = "done"
+FAILED = "failed"
+
+
+def _stamp_versions(connection, ids):
+    """
+    Core updates skip sync's before_flush hook, so give the rows they changed
+    their change-feed versions here, in the same transaction. The UPDATE already
+    holds the write lock, and nothing is reserved when no row changed.
+    """
+    if not ids:
+        return
+    table = DefectRecord.__table__
+    connection.execute(
+        update(table).where(table.c.id == bindparam("row_id")).values(version=bindparam("row_version")),
+        [{"row_id": i, "row_version": v} for i, v in zip(ids, sync.next_versions(connection, len(ids)))],
+    )
+
+
+def claim(db_engine, limit, owner=None):
+    """Atomically lease up to `limit` of the oldest pending records to `owner`; returns their ids."""
+    table = DefectRecord.__table__
+    oldest = select(table.c.id).where(table.c.status == PENDING).order_by(table.c.id).limit(limit)
+    with db_engine.begin() as connection:
+        ids = sorted(row[0] for row in connection.execute(
+            update(table).where(table.c.id.in_(oldest))
+            .values(status=CAPTIONING, claimed_at=datetime.now(), claimed_by=owner)
+            .returning(table.c.id)
+        ))
+        _stamp_versions(connection, ids)
+    return ids
+
+
+def requeue_expired(db_engine, lease_seconds):
+    """Return records whose lease ran out (their worker died) to the queue."""
+    table = DefectRecord.__table__
+    cutoff = datetime.now() - timedelta(seconds=lease_seconds)
+    with db_engine.begin() as connection:
+        ids = sorted(row[0] for row in connection.execute(
+            update(table)
+            .where(table.c.status == CAPTIONING, or_(table.c.claimed_at.is_(None), table.c.claimed_at < cutoff))
+            .values(status=PENDING, claimed_at=None, claimed_by=None)
+            .returning(table.c.id)
+        ))
+        _stamp_versions(connection, ids)
+    count = len(ids)
+    if count:
+        print(f"♻️ Re-queued {count} interrupted uploads")
+    return count
+
+
+def pending_count(db_engine):
+    with db_engine.connect() as connection:
+        return connection.execute(
+            text("SELECT count(*) FROM defectrecord WHERE status IN (:pending, :captioning)"),
+            {"pending": PENDING, "captioning": CAPTIONING},
+        ).scalar()
+
+
+class IngestWorker:
+    """
+    Background thread draining pending DefectRecords.
+
+    `load(defect)` returns the scheduler item for a record (raising if its
+    photo is unreadable), `caption(items)` returns one result per item, and
+    `apply(defect, result)` fills the record in before the batch commit.
+    A batch whose captioning raises is retried up to `max_attempts` times.
+    Records whose lease expired and went to another worker meanwhile are
+    left to that worker.
+    """
+
+    def __init__(self, load, caption, apply, batch_size=8, poll_seconds=2.0, max_attempts=3, lease_seconds=600):
+        self.load = load
+        self.caption = caption
+        self.apply = apply
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._attempts = {}
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def notify(self):
+        """Wake the worker now instead of at the next poll."""
+        self._wake.set()
+
+    def run_once(self):
+        """Caption one batch; returns the number of records claimed."""
+        db_engine = database.engine
+        ids = claim(db_engine, self.batch_size, self.owner)
+        if not ids:
+            return 0
+        with Session(db_engine) as session:
+            defects = session.exec(select(DefectRecord).where(DefectRecord.id.in_(ids)).order_by(DefectRecord.id)).all()
+            for defect in defects:
+                defect.claimed_at = defect.claimed_by = None
+            items, ready = [], []
+            for defect in defects:
+                try:
+                    items.append(self.load(defect))
+                    ready.append(defect)
+                except Exception as e:
+                    print(f"❌ Upload {defect.id} unreadable: {e}")
+                    defect.status = FAILED
+            try:
+                results = self.caption(items) if items else []
+            except Exception as e:
+                print(f"❌ Ingest batch failed: {e}")
+                for defect in ready:
+                    attempts = self._attempts.get(defect.id, 0) + 1
+                    self._attempts[defect.id] = attempts
+                    defect.status = FAILED if attempts >= self.max_attempts else PENDING
+                results = None
+            with session.no_autoflush:
+                mine = set(session.exec(
+                    select(DefectRecord.id).where(DefectRecord.id.in_(ids), DefectRecord.claimed_by == self.owner)
+                ).all())
+            for defect in [d for d in defects if d.id not in mine]:
+                print(f"⚠️ Lease on upload {defect.id} expired; leaving it to its new worker")
+                session.expunge(defect)
+            if results is not None:
+                for defect, result in zip(ready, results):
+                    if defect.id not in mine:
+                        continue
+                    self.apply(defect, result)
+                    defect.status = DONE
+                    self._attempts.pop(defect.id, None)
+            session.add_all([d for d in defects if d.id in mine])
+            session.commit()
+        return len(ids)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                # Cheap (status is indexed); picks up uploads abandoned by crashed peers
+                requeue_expired(database.engine, self.lease_seconds)
+                claimed = self.run_once()
+            except Exception as e:
+                print(f"❌ Ingest worker error: {e}")
+                claimed = 0
+            if not claimed:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+            self._thread = None
@@ -0,0 +1,334 @@
+"""
+HTTP load generator for the FastAPI service.
+
+By default it boots app.py in-process on a free port, against a temporary
+SQLite database seeded with realistic volumes and with either a stubbed
+fast engine (--engine stub) or the tiny synthetic model (--engine tiny).
+Point --url at a running server to load-test a real deployment instead.
+
+    uv run loadtest.py --concurrency 1,8,32 --duration 20 --mix predict=1,list=8,patch=3,report=1
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+
+import httpx
+from PIL import Image
+
+import config
+from bench_engine import summarize
+
+DEFAULT_MIX = "predict=2,list=10,patch=4,report=1"
+SAMPLE_CAPTIONS = [
+    "รอยร้าวที่ผนังด้านซ้ายของห้องนั่งเล่น",
+    "คราบน้ำซึมบริเวณเพดานห้องน้ำ",
+    "สีหลุดลอกที่ขอบบัวพื้น",
+    "กระเบื้องแตกบริเวณหน้าประตู",
+]
+ROOMS = ["Living Room", "Bedroom", "Bathroom", "Kitchen", "General"]
+SEVERITIES = ["Low", "Medium", "High"]
+
+
+class StubEngine:
+    """Stands in for ImageCaptioningEngine with a fixed per-image delay."""
+
+    def __init__(self, delay=0.02):
+        self.delay = delay
+
+    def predict(self, image_source, **kwargs):
+        return self.predict_batch([image_source], **kwargs)[0]
+
+    def predict_batch(self, image_sources, **kwargs):
+        time.sleep(self.delay * len(image_sources))
+        return [random.choice(SAMPLE_CAPTIONS) for _ in image_sources]
+
+    def caption_batch(self, image_sources, reuse=None, **kwargs):
+        captions = self.predict_batch(image_sources, **kwargs)
+        return [
+            {"caption": caption, "confidence": 0.9, "label": "unknown", "severity": None,
+             "embedding": None, "reused_from": None}
+            for caption in captions
+        ]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, weight = part.split("=")
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - {"predict", "bulk", "list", "patch", "report"}
+    if unknown:
+        raise ValueError(f"Unknown operations in mix: {sorted(unknown)}")
+    return mix
+
+
+def encode_jpeg(size, seed=0):
+    rng = random.Random(seed)
+    img = Image.new("RGB", size, (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)))
+    # Add some noise stripes so JPEG size resembles a real photo more than a flat fill
+    for y in range(0, size[1], 8):
+        img.paste((rng.randint(0, 255),) * 3, (0, y, size[0], y + 2))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+# --- In-process target ---
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def seed_database(db_engine, uploads_dir, projects, defects_per_project, image_pool=20):
+    """
+    Insert projects and defect rows in bulk. Rows share a small pool of image
+    files on disk so report generation has real images to load.
+    """
+    from sqlmodel import Session
+    from models import Project, DefectRecord
+
+    os.makedirs(uploads_dir, exist_ok=True)
+    image_paths = []
+    for i in range(image_pool):
+        name = f"seed_{i}.jpg"
+        with open(os.path.join(uploads_dir, name), "wb") as f:
+            f.write(encode_jpeg((1600, 1200), seed=i))
+        image_paths.append(f"uploads/{name}")
+
+    rng = random.Random(0)
+    with Session(db_engine) as session:
+        for p in range(projects):
+            project = Project(name=f"Load Project {p}", address=f"Site {p}")
+            session.add(project)
+            session.flush()
+            session.add_all([
+                DefectRecord(
+                    filename=f"seed_{p}_{d}.jpg",
+                    caption=rng.choice(SAMPLE_CAPTIONS),
+                    label="detected_defect",
+                    confidence=0.95,
+                    image_path=rng.choice(image_paths),
+                    room=rng.choice(ROOMS),
+                    severity=rng.choice(SEVERITIES),
+                    project_id=project.id,
+                )
+                for d in range(defects_per_project)
+            ])
+        session.commit()
+    print(f"🌱 Seeded {projects} projects x {defects_per_project} defects")
+
+
+def start_in_process_server(args, work_dir):
+    """Import app with a temp DB/outputs dir, swap in the requested engine and serve it on a thread."""
+    import uvicorn
+    from sqlmodel import create_engine
+    import database
+    import models  # noqa: F401  (registers tables on SQLModel.metadata)
+
+    # The app loads an engine at import; point it at a tiny checkpoint so no real weights are needed
+    from tiny_model import build_tiny_checkpoint
+    config.MODEL_PATH = build_tiny_checkpoint(os.path.join(work_dir, "model"), image_size=args.model_image_size)
+    config.BACKEND_DIR = work_dir
+
+    # get_session and create_db_and_tables read database.engine at call time
+    database.engine = create_engine(
+        f"sqlite:///{os.path.join(work_dir, 'loadtest.db')}",
+        connect_args={"check_same_thread": False},
+    )
+    database.create_db_and_tables()
+
+    import app as app_module
+    if args.engine == "stub":
+        app_module.model_registry.add(config.MODEL_VERSION, StubEngine(delay=args.stub_delay))
+    seed_database(database.engine, app_module.UPLOADS_DIR, args.projects, args.defects_per_project)
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}", server, thread
+
+
+# --- Workload ---
+
+class Workload:
+    def __init__(self, client, mix, upload_bytes, rng):
+        self.client = client
+        self.ops = list(mix)
+        self.weights = [mix[o] for o in self.ops]
+        self.upload_bytes = upload_bytes
+        self.rng = rng
+        self.project_ids = []
+        self.defect_ids = defaultdict(list)
+
+    async def discover(self):
+        projects = (await self.client.get("/projects")).json()
+        self.project_ids = [p["id"] for p in projects]
+        for d in (await self.client.get("/defects")).json():
+            self.defect_ids[d["project_id"]].append(d["id"])
+        if not self.project_ids:
+            raise RuntimeError("Target has no projects; seed it first or use in-process mode")
+
+    async def predict(self, priority="interactive"):
+        project_id = self.rng.choice(self.project_ids)
+        files = {"file": ("load.jpg", self.upload_bytes, "image/jpeg")}
+        data = {"project_id": str(project_id), "priority": priority}
+        r = await self.client.post("/predict", data=data, files=files)
+        body = r.json() if r.status_code == 200 else {}
+        if body.get("success"):
+            self.defect_ids[project_id].append(body["id"])
+        return r.status_code < 400 and body.get("success", False)
+
+    async def bulk(self):
+        # Background backfill traffic; interactive predict latency should hold up under it
+        return await self.predict(priority="bulk")
+
+    async def list(self):
+        r = await self.client.get("/defects", params={"project_id": self.rng.choice(self.project_ids)})
+        return r.status_code == 200
+
+    async def patch(self):
+        ids = self.defect_ids[self.rng.choice(self.project_ids)]
+        if not ids:
+            return True
+        update = {"severity": self.rng.choice(SEVERITIES), "room": self.rng.choice(ROOMS)}
+        r = await self.client.patch(f"/defects/{self.rng.choice(ids)}", json=update)
+        return r.status_code == 200
+
+    async def report(self):
+        ids = self.defect_ids[self.rng.choice(self.project_ids)]
+        if not ids:
+            return True
+        selected = self.rng.sample(ids, min(len(ids), self.rng.randint(6, 24)))
+        r = await self.client.post("/generate-report-db", json=selected)
+        return r.status_code == 200 and r.headers.get("content-type", "").startswith("application/pdf")
+
+    def pick(self):
+        return self.rng.choices(self.ops, weights=self.weights)[0]
+
+
+async def run_level(base_url, mix, concurrency, duration, max_requests, upload_bytes, seed):
+    stats = defaultdict(lambda: {"latencies": [], "errors": 0})
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        workload = Workload(client, mix, upload_bytes, random.Random(seed))
+        await workload.discover()
+        deadline = time.perf_counter() + duration
+        issued = 0
+
+        async def worker():
+            nonlocal issued
+            while time.perf_counter() < deadline and (max_requests is None or issued < max_requests):
+                issued += 1
+                op = workload.pick()
+                start = time.perf_counter()
+                try:
+                    ok = await getattr(workload, op)()
+                except Exception:
+                    ok = False
+                stats[op]["latencies"].append(time.perf_counter() - start)
+                if not ok:
+                    stats[op]["errors"] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    endpoints = {}
+    for op, s in stats.items():
+        count = len(s["latencies"])
+        endpoints[op] = {
+            "requests": count,
+            "throughput_rps": count / elapsed if elapsed else 0.0,
+            "error_rate": s["errors"] / count if count else 0.0,
+            "latency": summarize(s["latencies"]),
+        }
+    total = sum(e["requests"] for e in endpoints.values())
+    return {
+        "concurrency": concurrency,
+        "elapsed_sec": elapsed,
+        "total_requests": total,
+        "throughput_rps": total / elapsed if elapsed else 0.0,
+        "endpoints": endpoints,
+    }
+
+
+def print_level(level):
+    print(f"\n📈 concurrency={level['concurrency']}  {level['throughput_rps']:.1f} req/s over {level['elapsed_sec']:.1f}s")
+    print(f"  {'endpoint':<10}{'reqs':>7}{'rps':>9}{'err%':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for op, e in sorted(level["endpoints"].items()):
+        lat = e["latency"]
+        print(
+            f"  {op:<10}{e['requests']:>7}{e['throughput_rps']:>9.1f}{e['error_rate'] * 100:>7.1f}"
+            f"{lat['p50'] * 1000:>10.1f}{lat['p95'] * 1000:>10.1f}{lat['p99'] * 1000:>10.1f}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the House Defect API")
+    parser.add_argument("--url", default=None, help="Target a running server instead of an in-process one")
+    parser.add_argument("--engine", choices=["stub", "tiny"], default="stub", help="In-process engine")
+    parser.add_argument("--stub-delay", type=float, default=0.02, help="Seconds per image for the stub engine")
+    parser.add_argument("--model-image-size", type=int, default=224)
+    parser.add_argument("--projects", type=int, default=20)
+    parser.add_argument("--defects-per-project", type=int, default=500)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Weighted operations: predict,bulk,list,patch,report")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma list of concurrency levels")
+    parser.add_argument("--duration", type=float, default=15.0, help="Seconds per concurrency level")
+    parser.add_argument("--requests", type=int, default=None, help="Cap requests per level")
+    parser.add_argument("--upload-size", default="1600x1200", help="Resolution of the /predict upload")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write results JSON here")
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    w, h = (int(v) for v in args.upload_size.lower().split("x"))
+    upload_bytes = encode_jpeg((w, h), seed=args.seed)
+
+    server = None
+    tmp_dir = None
+    base_url = args.url
+    if base_url is None:
+        tmp_dir = tempfile.TemporaryDirectory(prefix="loadtest_")
+        base_url, server, thread = start_in_process_server(args, tmp_dir.name)
+        print(f"🚀 In-process server at {base_url} (engine={args.engine})")
+
+    results = {"target": args.url or f"in-process/{args.engine}", "mix": mix, "levels": []}
+    try:
+        for concurrency in (int(c) for c in args.concurrency.split(",")):
+            level = asyncio.run(run_level(
+                base_url, mix, concurrency, args.duration, args.requests, upload_bytes, args.seed
+            ))
+            print_level(level)
+            results["levels"].append(level)
+    finally:
+        if server is not None:
+            server.should_exit = True
+            thread.join(timeout=10)
+            import database
+            database.engine.dispose()
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
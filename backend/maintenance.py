@@ -0,0 +1,326 @@
+"""
+Disk maintenance: orphaned uploads, expired reports, stray temp files and
+SQLite compaction.
+
+- Uploads: outputs/uploads is scanned in batches of BATCH names, and each
+  batch is checked against DefectRecord.image_path with one query. Files no
+  record points to are deleted once they are older than the grace period.
+  The grace period matters because /predict writes the photo before the
+  record commits. Photos of archived projects are passed in as `keep`,
+  worked out under `lock` so no project is archived halfway through.
+- Reports: generated PDFs in reports/ are deleted after the retention
+  period. If the directory is still over its size cap, the oldest go next.
+- Temp files: temp_pdf_*.jpg left by crashed report runs of the old PDF
+  generator, and *.tmp files from interrupted atomic writes.
+- Database: VACUUM rewrites the file without free pages, then ANALYZE
+  refreshes the planner statistics. VACUUM locks out every writer until
+  it finishes, so it is opt-in (MAINTENANCE_VACUUM).
+
+run_maintenance does all of these and returns how much space each step
+reclaimed. MaintenanceScheduler runs it once per interval, inside the
+configured quiet hours, and only while no inference work is queued. Each
+uvicorn worker has a scheduler. They share `state_file`, and a run takes
+its lock, so only one worker runs maintenance and the rest see its report.
+"""
+import os
+import json
+import glob
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+from contextlib import nullcontext
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlmodel import Session, select
+
+import metrics
+from models import DefectRecord
+
+BATCH = 1000
+
+
+def _remove(path, dry_run):
+    """Size of `path` in bytes, deleting it unless dry_run (0 if it vanished meanwhile)."""
+    try:
+        size = os.path.getsize(path)
+        if not dry_run:
+            os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+def _tally(report, key, size):
+    entry = report.setdefault(key, {"files": 0, "bytes": 0})
+    if size:
+        entry["files"] += 1
+        entry["bytes"] += size
+
+
+def _referenced(session, relpaths):
+    query = select(DefectRecord.image_path).where(DefectRecord.image_path.in_(relpaths))
+    return set(session.exec(query).all())
+
+
+def sweep_orphan_uploads(db_engine, outputs_dir, grace_seconds, dry_run=False, report=None, keep=(), lock=None):
+    """
+    Delete files under outputs/uploads that no DefectRecord references (nor
+    `keep`, e.g. archived ones). `keep` may be a callable, which is then
+    evaluated inside `lock` (a context manager held for the whole sweep).
+    """
+    report = {} if report is None else report
+    uploads = os.path.join(outputs_dir, "uploads")
+    report.setdefault("orphan_uploads", {"files": 0, "bytes": 0})
+    if not os.path.isdir(uploads):
+        return report
+    with lock or nullcontext():
+        keep = set(keep() if callable(keep) else keep)
+        _sweep_uploads(db_engine, uploads, grace_seconds, dry_run, report, keep)
+    return report
+
+
+def _sweep_uploads(db_engine, uploads, grace_seconds, dry_run, report, keep):
+    cutoff = time.time() - grace_seconds
+
+    def check(batch):
+        with Session(db_engine) as session:
+            live = _referenced(session, [relpath for relpath, _ in batch])
+        for relpath, path in batch:
+            if relpath not in live and relpath not in keep:
+                _tally(report, "orphan_uploads", _remove(path, dry_run))
+
+    batch = []
+    with os.scandir(uploads) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.stat().st_mtime > cutoff:
+                continue
+            batch.append((f"uploads/{entry.name}", entry.path))
+            if len(batch) >= BATCH:
+                check(batch)
+                batch = []
+    if batch:
+        check(batch)
+
+
+def expire_reports(reports_dir, retention_days, max_bytes=0, dry_run=False, report=None):
+    """Delete PDFs older than retention_days, then the oldest ones while over max_bytes (0 = no cap)."""
+    report = {} if report is None else report
+    report.setdefault("expired_reports", {"files": 0, "bytes": 0})
+    if not os.path.isdir(reports_dir):
+        return report
+    cutoff = time.time() - retention_days * 86400
+    kept = []
+    for path in glob.glob(os.path.join(reports_dir, "*.pdf")):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if stat.st_mtime < cutoff:
+            _tally(report, "expired_reports", _remove(path, dry_run))
+        else:
+            kept.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in kept)
+    for _, size, path in sorted(kept):
+        if not max_bytes or total <= max_bytes:
+            break
+        _tally(report, "expired_reports", _remove(path, dry_run))
+        total -= size
+    return report
+
+
+def sweep_temp_files(directories, grace_seconds, dry_run=False, report=None):
+    """Delete temp_pdf_*.jpg and *.tmp files older than the grace period."""
+    report = {} if report is None else report
+    report.setdefault("temp_files", {"files": 0, "bytes": 0})
+    cutoff = time.time() - grace_seconds
+    seen = set()
+    for directory in directories:
+        for pattern in ("temp_pdf_*.jpg", "*.tmp"):
+            for path in glob.glob(os.path.join(directory, pattern)):
+                path = os.path.realpath(path)
+                if path in seen:
+                    continue
+                seen.add(path)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        _tally(report, "temp_files", _remove(path, dry_run))
+                except FileNotFoundError:
+                    pass
+    return report
+
+
+def sqlite_file(db_engine):
+    database = db_engine.url.database
+    return database if database and database != ":memory:" else None
+
+
+def compact_database(db_engine, dry_run=False, report=None):
+    """VACUUM and ANALYZE the SQLite database; reports the file size before and after."""
+    report = {} if report is None else report
+    path = sqlite_file(db_engine)
+    before = os.path.getsize(path) if path else 0
+    if dry_run:
+        with db_engine.connect() as connection:
+            free_pages = connection.execute(text("PRAGMA freelist_count")).scalar()
+            page_size = connection.execute(text("PRAGMA page_size")).scalar()
+        report["database"] = {"before": before, "after": before, "bytes": free_pages * page_size}
+        return report
+    # VACUUM cannot run inside a transaction
+    with db_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("VACUUM"))
+        connection.execute(text("ANALYZE"))
+    after = os.path.getsize(path) if path else 0
+    report["database"] = {"before": before, "after": after, "bytes": max(0, before - after)}
+    return report
+
+
+def run_maintenance(db_engine, outputs_dir, reports_dir, temp_dirs, grace_seconds, retention_days,
+                    report_max_bytes=0, vacuum=False, dry_run=False, keep=(), lock=None):
+    """Every sweep plus compaction; returns per-step {"files", "bytes"} and the total reclaimed."""
+    started = time.perf_counter()
+    report = {"dry_run": dry_run, "started_at": datetime.now().isoformat(timespec="seconds")}
+    sweep_orphan_uploads(db_engine, outputs_dir, grace_seconds, dry_run, report, keep, lock)
+    expire_reports(reports_dir, retention_days, report_max_bytes, dry_run, report)
+    sweep_temp_files(temp_dirs, grace_seconds, dry_run, report)
+    if vacuum:
+        compact_database(db_engine, dry_run, report)
+
+    steps = ("orphan_uploads", "expired_reports", "temp_files", "database")
+    report["reclaimed_bytes"] = sum(report[step]["bytes"] for step in steps if step in report)
+    report["elapsed_sec"] = round(time.perf_counter() - started, 3)
+    if not dry_run:
+        for step in steps:
+            if step in report:
+                metrics.MAINTENANCE_RECLAIMED_BYTES.inc(report[step]["bytes"], step=step)
+    print(f"🧹 Maintenance {'(dry run) ' if dry_run else ''}reclaimed {report['reclaimed_bytes'] / 1e6:.1f} MB")
+    return report
+
+
+def in_quiet_hours(hour, quiet_hours):
+    """Whether `hour` (0-23) falls in a (start, end) window, which may wrap past midnight."""
+    start, end = quiet_hours
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+class MaintenanceBusy(Exception):
+    """Another process is running maintenance."""
+
+
+class MaintenanceScheduler:
+    """
+    Background thread calling `run()` at most once per `interval_hours`, only
+    inside `quiet_hours` and while `is_idle()` is true. Checks every `poll_seconds`.
+    With a `state_file`, schedulers in several processes share one schedule:
+    last run and report live in that file, and runs take an fcntl lock next to it.
+    """
+
+    def __init__(self, run, quiet_hours, interval_hours=24, is_idle=lambda: True, poll_seconds=300,
+                 clock=datetime.now, state_file=None):
+        self.run = run
+        self.quiet_hours = quiet_hours
+        self.interval_hours = interval_hours
+        self.is_idle = is_idle
+        self.poll_seconds = poll_seconds
+        self.clock = clock
+        self.state_file = state_file
+        self.last_run = None
+        self.last_report = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def load_state(self):
+        """Last run and report as saved by whichever process ran maintenance."""
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file, encoding="utf-8") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.last_run = datetime.fromisoformat(state["last_run"]) if state.get("last_run") else None
+        self.last_report = state.get("last_report")
+
+    def _save_state(self):
+        if not self.state_file:
+            return
+        tmp = f"{self.state_file}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "last_run": self.last_run.isoformat() if self.last_run else None,
+                "last_report": self.last_report,
+            }, f)
+        os.replace(tmp, self.state_file)
+
+    @contextmanager
+    def _exclusive(self):
+        """Serialize with runs in this process and, through the state file's lock, in others."""
+        with self._lock:
+            if not self.state_file:
+                yield
+                return
+            with open(f"{self.state_file}.lock", "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise MaintenanceBusy("Maintenance is already running in another worker")
+                try:
+                    self.load_state()
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def due(self):
+        now = self.clock()
+        if not in_quiet_hours(now.hour, self.quiet_hours) or not self.is_idle():
+            return False
+        self.load_state()
+        return self.last_run is None or (now - self.last_run).total_seconds() >= self.interval_hours * 3600
+
+    def _run(self, **kwargs):
+        report = self.run(**kwargs)
+        if not kwargs.get("dry_run"):
+            self.last_run = self.clock()
+            self.last_report = report
+            self._save_state()
+        return report
+
+    def run_now(self, **kwargs):
+        """Run immediately (serialized with the scheduled runs); returns the report. Raises MaintenanceBusy."""
+        with self._exclusive():
+            return self._run(**kwargs)
+
+    def _loop(self):
+        while not self._stopping.wait(self.poll_seconds):
+            if not self.due():
+                continue
+            try:
+                with self._exclusive():
+                    # Another worker may have run it between due() and taking the lock
+                    if not self.due():
+                        continue
+                    try:
+                        self._run()
+                    except Exception as e:
+                        print(f"❌ Maintenance failed: {e}")
+                        # Try again next interval rather than every poll
+                        self.last_run = self.clock()
+                        self._save_state()
+            except MaintenanceBusy:
+                pass
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+            self._thread = None
@@ -0,0 +1,234 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Default latency buckets (seconds). Covers fast DB commits up to slow beam searches.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape_label_value(value):
+    """Backslash, double quote and newline escaped as the Prometheus text format requires."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = [f'{k}="{_escape_label_value(v)}"' for k, v in sorted(labels.items())]
+    return "{" + ",".join(parts) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self._values = {}
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0.0)
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(dict(k))} {v}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, callback=None):
+        super().__init__(name, documentation)
+        self._values = {}
+        self._callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = float(value)
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount=1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0.0)
+
+    def _samples(self):
+        if self._callback is not None:
+            # Callback gauges are computed at scrape time: {labels_tuple: value}
+            for key, value in self._callback().items():
+                self.set(value, **dict(key))
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(dict(k))} {v}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                self._series[key] = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def count(self, **labels):
+        series = self._series.get(tuple(sorted(labels.items())))
+        return series["count"] if series else 0
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        lines = []
+        with self._lock:
+            items = [(k, dict(v, counts=list(v["counts"]))) for k, v in self._series.items()]
+        for key, series in items:
+            labels = dict(key)
+            for bound, c in zip(self.buckets, series["counts"]):
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {c}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {series['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {series['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {series['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(m.render() for m in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Stage Metrics ---
+PREDICT_STAGE_SECONDS = REGISTRY.register(Histogram(
+    "defect_predict_stage_seconds",
+    "Time spent in each stage of /predict (upload_read, image_decode, preprocess, generate, token_decode, disk_write, db_commit).",
+))
+REPORT_STAGE_SECONDS = REGISTRY.register(Histogram(
+    "defect_report_stage_seconds",
+    "Time spent in each phase of generate_defect_pdf (font_load, image_crop, image_encode, layout, render, output).",
+))
+REQUESTS_TOTAL = REGISTRY.register(Counter(
+    "defect_requests_total",
+    "Requests handled per endpoint and outcome.",
+))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "defect_request_seconds",
+    "End-to-end request latency per endpoint.",
+))
+
+# --- Scheduling ---
+SCHEDULER_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "defect_scheduler_wait_seconds",
+    "Time inference jobs spent queued before running, per priority class.",
+))
+SCHEDULER_DROPPED_TOTAL = REGISTRY.register(Counter(
+    "defect_scheduler_dropped_total",
+    "Queued inference jobs dropped without running, per priority class and reason (cancelled/deadline).",
+))
+
+# --- Gauges ---
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "defect_inference_queue_depth",
+    "Inference requests currently waiting for or running on the engine.",
+))
+QUEUE_DEPTH.set(0)
+MODEL_MEMORY_BYTES = REGISTRY.register(Gauge(
+    "defect_model_memory_bytes",
+    "Bytes held by loaded model parameters and buffers.",
+))
+
+# --- Caches ---
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    "defect_cache_requests_total",
+    "Cache lookups per cache and result (hit/miss).",
+))
+
+
+# --- Maintenance ---
+MAINTENANCE_RECLAIMED_BYTES = REGISTRY.register(Counter(
+    "defect_maintenance_reclaimed_bytes_total",
+    "Disk space freed by maintenance runs, per step (orphan_uploads, expired_reports, temp_files, database).",
+))
+
+
+def _cache_hit_ratio():
+    ratios = {}
+    caches = {dict(k)["cache"] for k in list(CACHE_REQUESTS._values)}
+    for cache in caches:
+        hits = CACHE_REQUESTS.get(cache=cache, result="hit")
+        misses = CACHE_REQUESTS.get(cache=cache, result="miss")
+        total = hits + misses
+        ratios[(("cache", cache),)] = hits / total if total else 0.0
+    return ratios
+
+
+CACHE_HIT_RATIO = REGISTRY.register(Gauge(
+    "defect_cache_hit_ratio",
+    "Fraction of cache lookups that were hits, per cache.",
+    callback=_cache_hit_ratio,
+))
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def model_memory_bytes(model):
+    """Sum of parameter and buffer bytes for a torch module."""
+    total = 0
+    for t in list(model.parameters()) + list(model.buffers()):
+        total += t.numel() * t.element_size()
+    return total
+
+
+def render_latest():
+    return REGISTRY.render()
@@ -0,0 +1,254 @@
+"""
+Registry of named caption model checkpoints with hot-swap and LRU eviction.
+
+Each version is a directory laid out like config.MODEL_PATH: the
+VisionEncoderDecoder weights, vocab_v2.json and the processor config.
+Versions load on a background thread, and traffic moves between them by
+replacing the weights table in one assignment, so a request keeps the
+engine it was given even if the table changes mid-flight. Traffic can go
+to one version or be split by percentage.
+
+Every uvicorn worker has its own registry. set_traffic saves the weights
+to `traffic_file`, and watch_traffic has each worker pick up a split saved
+by another: it loads the new targets first and switches afterwards, as
+set_traffic does. The saved split also survives restarts.
+
+At most `max_resident` models stay loaded, and their combined size stays
+under `memory_budget` bytes when one is set. When a load needs room, the
+least recently used version that receives no traffic is evicted first.
+"""
+import os
+import json
+import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+
+_WEIGHT_EXTENSIONS = (".safetensors", ".bin")
+
+
+def checkpoint_bytes(path):
+    """On-disk size of a checkpoint's weight files, the memory estimate used before loading."""
+    total = 0
+    for name in os.listdir(path):
+        if name.endswith(_WEIGHT_EXTENSIONS):
+            total += os.path.getsize(os.path.join(path, name))
+    return total
+
+
+def _load_engine(path, version):
+    from engine import ImageCaptioningEngine
+    return ImageCaptioningEngine(model_path=path, version=version)
+
+
+class ModelRegistry:
+    def __init__(self, models_dir=None, max_resident=2, memory_budget=0, loader=_load_engine, warmup=(),
+                 traffic_file=None):
+        self.models_dir = models_dir
+        self.max_resident = max(1, max_resident)
+        self.memory_budget = memory_budget
+        self.loader = loader
+        self.warmup = list(warmup)
+        self._paths = {}
+        self._resident = OrderedDict()  # version -> engine, least recently used first
+        self._sizes = {}
+        self._loading = {}  # version -> Future
+        self._traffic = {}
+        self.traffic_file = traffic_file
+        self._traffic_stamp = None
+        self._watching = None
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-load")
+
+    # --- Catalogue ---
+
+    def register(self, version, path):
+        with self._lock:
+            self._paths[version] = path
+
+    def discover(self):
+        """Register every checkpoint directory (one holding a config.json) under models_dir."""
+        if not self.models_dir or not os.path.isdir(self.models_dir):
+            return
+        for name in sorted(os.listdir(self.models_dir)):
+            path = os.path.join(self.models_dir, name)
+            if os.path.isfile(os.path.join(path, "config.json")):
+                self.register(name, path)
+
+    def versions(self):
+        self.discover()
+        with self._lock:
+            return sorted(set(self._paths) | set(self._resident))
+
+    def add(self, version, engine):
+        """Make an already constructed engine resident under `version` (replacing any previous one)."""
+        model = getattr(engine, "model", None)
+        with self._lock:
+            self._resident[version] = engine
+            self._resident.move_to_end(version)
+            self._sizes[version] = metrics.model_memory_bytes(model) if model is not None else 0
+            self._evict(keep={version})
+            self._update_memory()
+
+    # --- Loading and eviction ---
+
+    def load(self, version):
+        """Start loading `version` in the background; returns a Future resolving to its engine."""
+        with self._lock:
+            if version in self._resident:
+                future = Future()
+                future.set_result(self._resident[version])
+                return future
+            if version in self._loading:
+                return self._loading[version]
+            if version not in self._paths:
+                self.discover()
+            if version not in self._paths:
+                raise KeyError(f"Unknown model version '{version}'")
+            future = self._executor.submit(self._load, version)
+            self._loading[version] = future
+            return future
+
+    def _load(self, version):
+        path = self._paths[version]
+        try:
+            # Make room before loading so peak memory stays within the budget
+            with self._lock:
+                self._evict(keep={version}, incoming=checkpoint_bytes(path), incoming_count=1)
+            engine = self.loader(path, version)
+            if self.warmup and hasattr(engine, "warmup"):
+                engine.warmup(self.warmup)
+            self.add(version, engine)
+            print(f"✅ Model version '{version}' ready")
+            return engine
+        finally:
+            with self._lock:
+                self._loading.pop(version, None)
+
+    def _evict(self, keep=(), incoming=0, incoming_count=0):
+        pinned = set(self._traffic) | set(keep)
+        for version in list(self._resident):
+            over_count = len(self._resident) + incoming_count > self.max_resident
+            over_budget = self.memory_budget and sum(self._sizes.values()) + incoming > self.memory_budget
+            if not over_count and not over_budget:
+                return
+            if version in pinned:
+                continue
+            # In-flight batches hold their own reference; memory is freed once they finish
+            del self._resident[version]
+            self._sizes.pop(version, None)
+            print(f"♻️ Evicted model version '{version}'")
+        if self.memory_budget and sum(self._sizes.values()) + incoming > self.memory_budget:
+            print("⚠️ Models receiving traffic exceed the memory budget")
+
+    def _update_memory(self):
+        metrics.MODEL_MEMORY_BYTES.set(sum(self._sizes.values()))
+
+    # --- Traffic ---
+
+    def set_traffic(self, weights, persist=True):
+        """
+        Route traffic by relative weight, e.g. {"v1": 90, "v2": 10}. Every target
+        is loaded before the switch, so no request ever waits on a cold model.
+        With persist, the weights are saved to traffic_file for the other workers.
+        """
+        weights = {version: float(w) for version, w in weights.items() if float(w) > 0}
+        if not weights:
+            raise ValueError("At least one version needs a positive weight")
+        futures = [self.load(version) for version in weights]
+        for future in futures:
+            future.result()
+        with self._lock:
+            self._traffic = weights
+            for version in weights:
+                self._resident.move_to_end(version)
+            if persist and self.traffic_file:
+                self._save_traffic(weights)
+        print(f"🔀 Model traffic: {weights}")
+        return dict(weights)
+
+    def _traffic_file_stamp(self):
+        try:
+            stat = os.stat(self.traffic_file)
+        except (FileNotFoundError, TypeError):
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _save_traffic(self, weights):
+        os.makedirs(os.path.dirname(os.path.abspath(self.traffic_file)), exist_ok=True)
+        tmp = f"{self.traffic_file}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(weights, f)
+        os.replace(tmp, self.traffic_file)
+        self._traffic_stamp = self._traffic_file_stamp()
+
+    def reload_traffic(self):
+        """Adopt the weights saved in traffic_file if they changed; returns whether they did."""
+        stamp = self._traffic_file_stamp()
+        if stamp is None or stamp == self._traffic_stamp:
+            return False
+        with open(self.traffic_file, encoding="utf-8") as f:
+            weights = json.load(f)
+        # Remembered before loading, so a split that fails to load is not retried every poll
+        self._traffic_stamp = stamp
+        if weights == self._traffic:
+            return False
+        self.set_traffic(weights, persist=False)
+        return True
+
+    def watch_traffic(self, poll_seconds):
+        """Background thread calling reload_traffic every `poll_seconds`."""
+        if self._watching is not None or not self.traffic_file:
+            return self
+        self._watching = threading.Event()
+
+        def loop(stopping):
+            while not stopping.wait(poll_seconds):
+                try:
+                    self.reload_traffic()
+                except Exception as e:
+                    print(f"❌ Could not apply saved model traffic: {e}")
+
+        threading.Thread(target=loop, args=(self._watching,), daemon=True).start()
+        return self
+
+    def stop_watching(self):
+        if self._watching is not None:
+            self._watching.set()
+            self._watching = None
+
+    def choose(self):
+        """Pick the version for one request according to the traffic weights."""
+        traffic = self._traffic
+        if len(traffic) == 1:
+            return next(iter(traffic))
+        target = random.random() * sum(traffic.values())
+        for version, weight in traffic.items():
+            target -= weight
+            if target < 0:
+                return version
+        return version
+
+    def get(self, version=None):
+        """Engine for `version` (default: one chosen by traffic), loading it first if evicted."""
+        version = version or self.choose()
+        with self._lock:
+            engine = self._resident.get(version)
+            if engine is not None:
+                self._resident.move_to_end(version)
+                return engine
+        return self.load(version).result()
+
+    def status(self):
+        self.discover()
+        with self._lock:
+            return {
+                "traffic": dict(self._traffic),
+                "resident": [{"version": v, "bytes": self._sizes.get(v, 0)} for v in self._resident],
+                "loading": sorted(self._loading),
+                "available": sorted(self._paths),
+                "max_resident": self.max_resident,
+                "memory_budget": self.memory_budget,
+            }
@@ -1,4 +1,5 @@
 from typing import Optional
+from sqlalchemy import JSON, Column
 from datetime import datetime
 from sqlmodel import Field, SQLModel
 
@@ -7,15 +8,41 @@ class Project(SQLModel, table=True):
     name: str
     address: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.now)
+    version: Optional[int] = Field(default=None, index=True) # Change-feed version, set on every write (see sync.py)
+    archive_path: Optional[str] = None # Shard file (in ARCHIVE_DIR) holding the defects of an archived project (see archive.py)
+    archived_max_defect_id: Optional[int] = None # Highest archived defect id; new defects are numbered above it
 
 class DefectRecord(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     filename: str
     caption: str
     label: str
-    confidence: float
+    confidence: Optional[float] = None # Geometric-mean token probability of the caption; None if not measured
     timestamp: datetime = Field(default_factory=datetime.now)
     image_path: Optional[str] = None
     room: Optional[str] = Field(default="General")
     severity: Optional[str] = Field(default="Low")
     project_id: Optional[int] = Field(default=None, foreign_key="project.id")
+    decoding_profile: Optional[str] = None # Profile that produced the caption (see decoding.py)
+    duplicate_of: Optional[int] = None # Earlier near-identical photo whose caption was reused
+    model_version: Optional[str] = None # Model registry version that produced the caption
+    version: Optional[int] = Field(default=None, index=True) # Change-feed version, set on every write (see sync.py)
+    status: Optional[str] = Field(default="done", index=True) # pending / captioning / done / failed (see ingest.py)
+    claimed_at: Optional[datetime] = None # When an ingest worker claimed it; the lease expires INGEST_LEASE_SECONDS later
+    claimed_by: Optional[str] = None # Ingest worker holding the lease
+    user_edited: Optional[bool] = Field(default=False) # Caption/label/severity changed by hand; re-captioning leaves it alone
+    regions: Optional[list] = Field(default=None, sa_column=Column(JSON)) # [{"caption", "boxes"}] from tiled inference (see tiling.py)
+
+class Tombstone(SQLModel, table=True):
+    """Marks a deleted Project/DefectRecord so syncing clients can drop it."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    kind: str # "project" or "defect"
+    row_id: int
+    project_id: Optional[int] = Field(default=None, index=True)
+    version: int = Field(index=True)
+    deleted_at: datetime = Field(default_factory=datetime.now)
+
+class SyncCounter(SQLModel, table=True):
+    """Single row holding the last change-feed version handed out."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    value: int = 0
@@ -1,7 +1,13 @@
+import io
 import os
+import math
 import re
+import time
 from fpdf import FPDF
+from PIL import Image
 import config
+import metrics
+from card_cache import card_key, image_digest
 
 def contains_thai(text):
     return bool(re.search('[\u0e00-\u0e7f]', str(text)))
@@ -20,111 +26,191 @@ class DefectReportPDF(FPDF):
         self.set_font(font_name, "", 8)
         self.cell(0, 10, f"Page {self.page_no()}/{{nb}}", align="C")
 
-def generate_defect_pdf(report_items, output_path):
+# Grid Settings (6 items per page: 2 cols x 3 rows)
+MARGIN = 10
+COL_WIDTH = 90
+IMG_W = 85
+IMG_H = 60
+ROW_HEIGHT = 85
+ITEMS_PER_PAGE = 6
+COLS = 2
+START_Y = 25
+# Bump when the card layout changes so cached cards are rebuilt
+CARD_LAYOUT_VERSION = 1
+
+SEVERITY_COLORS = {"Critical": (200, 0, 0), "High": (200, 0, 0), "Medium": (200, 100, 0)}
+
+def load_fonts(pdf):
+    """Register the Thai font on `pdf`; returns the font name to use."""
+    font_path = config.FONT_PATH
+    if os.path.exists(font_path):
+        pdf.add_font("ThaiFont", "", font_path)
+        pdf.add_font("ThaiFont", "B", font_path)
+        pdf.add_font("ThaiFont", "I", font_path)
+        return "ThaiFont"
+    print(f"⚠️ Font not found at {font_path}. Falling back to Arial.")
+    return "Arial"
+
+def _font_signature(font_name):
+    if font_name == "Arial":
+        return "Arial"
+    stat = os.stat(config.FONT_PATH)
+    return f"{config.FONT_PATH}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def _crop_box(w, h):
+    """Center crop of a w x h image to the card's aspect ratio."""
+    target_ratio = IMG_W / IMG_H
+    current_ratio = w / h
+
+    if current_ratio > target_ratio:
+        new_w = h * target_ratio
+        left = (w - new_w) / 2
+        return (left, 0, w - left, h)
+    new_h = w / target_ratio
+    top = (h - new_h) / 2
+    return (0, top, w, h - top)
+
+def _open_image(item, print_size):
+    if item.get("image") is not None:
+        return item["image"].convert("RGB")
+    source = item["image_path"] if item.get("image_path") is not None else io.BytesIO(item["image_data"])
+    with Image.open(source) as image:
+        # Let the JPEG decoder scale down by 1/2..1/8 while the crop still covers print size
+        w, h = image.size
+        box = _crop_box(w, h)
+        scale = max(print_size[0] / (box[2] - box[0]), print_size[1] / (box[3] - box[1]))
+        if scale < 1:
+            image.draft("RGB", (math.ceil(w * scale), math.ceil(h * scale)))
+        return image.convert("RGB")
+
+def prepare_card_image(item):
+    """JPEG bytes of the item's photo center-cropped to the card ratio at REPORT_IMAGE_DPI."""
+    phase = metrics.REPORT_STAGE_SECONDS
+    size = (round(IMG_W / 25.4 * config.REPORT_IMAGE_DPI), round(IMG_H / 25.4 * config.REPORT_IMAGE_DPI))
+    with phase.time(phase="image_crop"):
+        img = _open_image(item, size)
+        box = _crop_box(*img.size)
+        # Never upscale; print size is what the PDF shows anyway
+        if size[0] < box[2] - box[0]:
+            img = img.resize(size, Image.BICUBIC, box=box, reducing_gap=3.0)
+        else:
+            img = img.crop(box)
+
+    with phase.time(phase="image_encode"):
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG", quality=config.REPORT_JPEG_QUALITY)
+    return buffer.getvalue()
+
+def measure_card(pdf, font_name, item):
+    """Tag labels, their widths and the wrapped caption lines for a card."""
+    room = item.get('room', 'General')
+    severity = item.get('severity', 'Low')
+    pdf.set_font(font_name, "B", 8)
+    room_label = f"Room: {room}"
+    severity_label = f"Severity: {severity}"
+    layout = {
+        "room_label": room_label,
+        "room_width": pdf.get_string_width(room_label),
+        "severity": severity,
+        "severity_label": severity_label,
+        "severity_width": pdf.get_string_width(severity_label),
+    }
+    pdf.set_font(font_name, "", 9)
+    layout["caption_lines"] = pdf.multi_cell(IMG_W, 4, f"{item['caption']}", dry_run=True, output="LINES")
+    return layout
+
+def render_card(pdf, font_name, index, image_bytes, layout):
+    """Draw card number `index` (0-based) from its prepared image and layout."""
+    item_in_page = index % ITEMS_PER_PAGE
+    col = item_in_page % COLS
+    row = item_in_page // COLS
+
+    # New page trigger
+    if index > 0 and item_in_page == 0:
+        pdf.add_page()
+
+    x = MARGIN + (col * (COL_WIDTH + 10))
+    y = START_Y + (row * ROW_HEIGHT)
+
+    # 1. Defect Label
+    pdf.set_xy(x, y)
+    pdf.set_font(font_name, "B", 10)
+    pdf.cell(COL_WIDTH, 5, f"Defect #{index+1}", ln=False)
+
+    # 2. Image (JPEG bytes are embedded as-is)
+    pdf.image(io.BytesIO(image_bytes), x=x, y=y+6, w=IMG_W, h=IMG_H)
+
+    # 3. Room & Severity Tags
+    pdf.set_xy(x, y + IMG_H + 8)
+    pdf.set_font(font_name, "B", 8)
+    pdf.set_text_color(100, 100, 100) # Gray
+    pdf.cell(layout["room_width"] + 2, 4, layout["room_label"], ln=False)
+
+    pdf.set_text_color(*SEVERITY_COLORS.get(layout["severity"], (0, 150, 0)))
+    pdf.set_x(x + IMG_W - layout["severity_width"])
+    pdf.cell(0, 4, layout["severity_label"], ln=True)
+
+    # 4. Caption, one pre-wrapped line at a time
+    pdf.set_text_color(0, 0, 0) # Reset to black
+    pdf.set_font(font_name, "", 9)
+    for n, line in enumerate(layout["caption_lines"]):
+        pdf.set_xy(x, y + IMG_H + 13 + n * 4)
+        pdf.cell(IMG_W, 4, line)
+
+def generate_defect_pdf(report_items, output_path, card_cache=None):
     """
-    report_items: List of dictionaries { 'image': PIL.Image, 'caption': str, 'room': str, 'severity': str }
+    report_items: List of dictionaries { 'caption': str, 'room': str, 'severity': str } plus the
+    photo as 'image' (PIL.Image), 'image_data' (encoded bytes) or 'image_path'.
+    With a CardCache, each defect's prepared card is looked up by photo hash, caption, room
+    and severity, so unchanged defects are neither decoded nor laid out again.
+    Items whose photo cannot be read are skipped; ValueError if none can be.
     """
     pdf = DefectReportPDF()
     pdf.alias_nb_pages()
     # Disable auto-page-break for precise grid control
     pdf.set_auto_page_break(auto=False)
-    
+
     # Load Thai Font from config (Sarabun is recommended as it has Latin support)
-    font_path = config.FONT_PATH
-    font_name = "ThaiFont"
-    if os.path.exists(font_path):
-        pdf.add_font(font_name, "", font_path)
-        pdf.add_font(font_name, "B", font_path)
-        pdf.add_font(font_name, "I", font_path)
-    else:
-        print(f"⚠️ Font not found at {font_path}. Falling back to Arial.")
-        font_name = "Arial"
+    phase = metrics.REPORT_STAGE_SECONDS
+    with phase.time(phase="font_load"):
+        font_name = load_fonts(pdf)
+    signature = f"{CARD_LAYOUT_VERSION}:{config.REPORT_IMAGE_DPI}:{config.REPORT_JPEG_QUALITY}:{_font_signature(font_name)}"
 
     pdf.add_page()
-    
-    # Grid Settings (6 items per page: 2 cols x 3 rows)
-    margin = 10
-    col_width = 90
-    img_w = 85
-    img_h = 60 
-    row_height = 85 
-    items_per_page = 6
-    cols = 2
-    
-    start_y = 25
-    
-    for i, item in enumerate(report_items):
-        # Calculate grid position relative to the page
-        item_in_page = i % items_per_page
-        col = item_in_page % cols
-        row = item_in_page // cols
-        
-        # New page trigger
-        if i > 0 and item_in_page == 0:
-            pdf.add_page()
-            
-        x = margin + (col * (col_width + 10))
-        y = start_y + (row * row_height)
-        
-        # 1. Defect Label
-        pdf.set_xy(x, y)
-        pdf.set_font(font_name, "B", 10)
-        pdf.cell(col_width, 5, f"Defect #{i+1}", ln=False)
-        
-        # 2. Image
-        img = item['image'].copy()
-        w, h = img.size
-        target_ratio = img_w / img_h
-        current_ratio = w / h
-        
-        if current_ratio > target_ratio:
-            new_w = h * target_ratio
-            left = (w - new_w) / 2
-            img = img.crop((left, 0, w - left, h))
-        else:
-            new_h = w / target_ratio
-            top = (h - new_h) / 2
-            img = img.crop((0, top, w, h - top))
-            
-        temp_img_path = f"outputs/temp_pdf_{i}.jpg"
-        os.makedirs("outputs", exist_ok=True)
-        img.save(temp_img_path)
-        
-        pdf.image(temp_img_path, x=x, y=y+6, w=img_w, h=img_h)
-        
-        # 3. Room & Severity Tags
-        pdf.set_xy(x, y + img_h + 8)
-        room = item.get('room', 'General')
-        severity = item.get('severity', 'Low')
-        
-        # Room tag
-        pdf.set_font(font_name, "B", 8)
-        pdf.set_text_color(100, 100, 100) # Gray
-        pdf.cell(pdf.get_string_width(f"Room: {room}") + 2, 4, f"Room: {room}", ln=False)
-        
-        # Severity tag
-        pdf.set_font(font_name, "B", 8)
-        if severity == "High":
-             pdf.set_text_color(200, 0, 0)
-        elif severity == "Medium":
-             pdf.set_text_color(200, 100, 0)
-        else:
-             pdf.set_text_color(0, 150, 0)
-             
-        # Print "Severity: {severity}"
-        label = f"Severity: {severity}"
-        pdf.set_x(x + img_w - pdf.get_string_width(label))
-        pdf.cell(0, 4, label, ln=True)
-        
-        # 4. Caption
-        pdf.set_xy(x, y + img_h + 13)
-        pdf.set_text_color(0, 0, 0) # Reset to black
-        pdf.set_font(font_name, "", 9)
-        pdf.multi_cell(img_w, 4, f"{item['caption']}")
-        
-        # Clean up
-        if os.path.exists(temp_img_path):
-            os.remove(temp_img_path)
-
-    pdf.output(output_path)
+
+    rendered = 0
+    for item in report_items:
+        try:
+            card = None
+            if card_cache is not None:
+                key = card_cache_key(item, signature)
+                card = card_cache.get(key)
+                metrics.record_cache("report_card", card is not None)
+            if card is None:
+                image_bytes = prepare_card_image(item)
+                layout_start = time.perf_counter()
+                layout = measure_card(pdf, font_name, item)
+                phase.observe(time.perf_counter() - layout_start, phase="layout")
+                card = (image_bytes, layout)
+                if card_cache is not None:
+                    card_cache.put(key, image_bytes, layout)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Skipping report item: {e}")
+            continue
+
+        render_start = time.perf_counter()
+        render_card(pdf, font_name, rendered, *card)
+        phase.observe(time.perf_counter() - render_start, phase="render")
+        rendered += 1
+
+    if not rendered:
+        raise ValueError("Could not load any valid images for the report")
+    with phase.time(phase="output"):
+        pdf.output(output_path)
     return output_path
+
+def card_cache_key(item, signature):
+    return card_key(
+        image_digest(item), signature,
+        item.get('caption', ''), item.get('room', 'General'), item.get('severity', 'Low'),
+    )
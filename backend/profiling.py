@@ -0,0 +1,144 @@
+import os
+import io
+import re
+import hmac
+import pstats
+import cProfile
+import threading
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+import config
+
+# Endpoints that may be profiled. Everything else always runs unprofiled.
+PROFILED_PATHS = {"/predict", "/generate-report", "/generate-report-db"}
+
+# Endpoints whose real work runs on the inference scheduler's worker thread. Their
+# capture profiles that caption job there, in a batch of its own, instead of the
+# request's coroutine (which would only show the event loop awaiting the result).
+SCHEDULED_PATHS = {"/predict"}
+
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# cProfile allows one active profiler per interpreter, so profiled requests take turns
+_active = threading.Lock()
+
+# The deferred capture of the request being handled, for the scheduler to run the job under
+_pending = contextvars.ContextVar("profiling_pending", default=None)
+
+
+class ProfilerBusy(Exception):
+    """Another request is being profiled right now."""
+
+
+def is_admin(token):
+    """Check a presented token against PROFILE_ADMIN_TOKEN (constant-time)."""
+    expected = config.PROFILE_ADMIN_TOKEN
+    if not expected or not token:
+        return False
+    return hmac.compare_digest(str(token), expected)
+
+
+def should_profile(path, headers):
+    """
+    Decide whether a request gets profiled.
+    Enabled globally by config.PROFILE_REQUESTS, or per request with
+    `X-Profile: 1` plus a matching `X-Admin-Token`.
+    """
+    if path not in PROFILED_PATHS:
+        return False
+    if config.PROFILE_REQUESTS:
+        return True
+    return headers.get("x-profile") == "1" and is_admin(headers.get("x-admin-token"))
+
+
+def is_valid_request_id(request_id):
+    return bool(request_id and _REQUEST_ID_RE.match(request_id))
+
+
+def profile_dir(request_id):
+    return os.path.join(config.PROFILES_DIR, request_id)
+
+
+def _torch_profiler():
+    try:
+        import torch
+        from torch.profiler import profile, ProfilerActivity
+    except ImportError:
+        return nullcontext()
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    return profile(activities=activities, record_shapes=True)
+
+
+@contextmanager
+def capture(request_id, deferred=False):
+    """
+    Profile the wrapped block with cProfile and torch.profiler, then write:
+      - cprofile.prof    (pstats binary, open with snakeviz/pstats)
+      - cprofile.txt     (top functions by cumulative time)
+      - torch_ops.txt    (operator-level table, covers model.generate)
+      - torch_trace.json (chrome://tracing / Perfetto)
+    With deferred=True nothing runs under the profiler here; instead pending()
+    hands the capture to whoever does the work, on its own thread (see
+    SCHEDULED_PATHS). Artifacts exist only if that work ran.
+    Raises ProfilerBusy if another capture is running.
+    """
+    if not _active.acquire(blocking=False):
+        raise ProfilerBusy("Another request is being profiled; try again shortly")
+    try:
+        if deferred:
+            token = _pending.set(lambda: _capture(request_id))
+            try:
+                yield profile_dir(request_id)
+            finally:
+                _pending.reset(token)
+        else:
+            with _capture(request_id) as out_dir:
+                yield out_dir
+    finally:
+        _active.release()
+
+
+def pending():
+    """The current request's deferred capture as a context-manager factory, or None."""
+    return _pending.get()
+
+
+@contextmanager
+def _capture(request_id):
+    out_dir = profile_dir(request_id)
+    os.makedirs(out_dir, exist_ok=True)
+
+    profiler = cProfile.Profile()
+    torch_prof = _torch_profiler()
+    with torch_prof as tp:
+        profiler.enable()
+        try:
+            yield out_dir
+        finally:
+            profiler.disable()
+
+    profiler.dump_stats(os.path.join(out_dir, "cprofile.prof"))
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(50)
+    with open(os.path.join(out_dir, "cprofile.txt"), "w", encoding="utf-8") as f:
+        f.write(summary.getvalue())
+
+    if tp is not None:
+        try:
+            table = tp.key_averages().table(sort_by="self_cpu_time_total", row_limit=50)
+            with open(os.path.join(out_dir, "torch_ops.txt"), "w", encoding="utf-8") as f:
+                f.write(table)
+            tp.export_chrome_trace(os.path.join(out_dir, "torch_trace.json"))
+        except Exception as e:
+            print(f"⚠️ Could not export torch profile for {request_id}: {e}")
+    print(f"🔬 Profile saved for request {request_id} at {out_dir}")
+
+
+def list_artifacts(request_id):
+    out_dir = profile_dir(request_id)
+    if not os.path.isdir(out_dir):
+        return []
+    return sorted(os.listdir(out_dir))
@@ -0,0 +1,391 @@
+"""
+Re-captioning existing defects after a model upgrade.
+
+RecaptionJob walks the DefectRecords matching its filters in id order. For
+each page it reads the stored photos from outputs/, captions them in one
+batch, and writes the new captions back in a single transaction. Records a
+user has edited (user_edited, set by PATCH /defects) are never touched. That
+includes records edited while the job is running, because every write
+re-checks the row.
+
+After each committed batch the last id is saved to a checkpoint file. A
+stopped or crashed job started again with the same filters continues after
+that id. Batches are paced by a token bucket of `rate` images per second,
+and the app sends them through the scheduler's bulk class, so interactive
+uploads always go first.
+
+In dry-run mode nothing is written. Changed captions are collected as a
+diff instead (see diff_lines).
+
+With a `state_file`, one job runs across all uvicorn workers: a started job
+holds an fcntl lock next to the file until it ends, and saves its status
+there after every batch (diff entries go to `<state_file>.diff`). Any
+worker can then read the status (load_state), the diff (saved_diff_lines)
+and ask the job to stop (request_stop).
+"""
+import os
+import json
+import time
+import fcntl
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func, or_
+from sqlmodel import Session, select
+
+from models import DefectRecord
+
+DIFF_PREVIEW = 50
+
+
+class RecaptionBusy(Exception):
+    """A re-caption job is already running in another worker."""
+
+
+def _format_diff(entries):
+    for entry in entries:
+        yield f"@@ defect {entry['id']} (project {entry['project_id']}) {entry['old_version']} -> {entry['new_version']}\n"
+        yield f"- {entry['old']}\n"
+        yield f"+ {entry['new']}\n"
+
+
+def _runner_alive(state_file):
+    """True while some worker holds the job lock next to `state_file`."""
+    try:
+        with open(f"{state_file}.lock", encoding="utf-8") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    except FileNotFoundError:
+        pass
+    return False
+
+
+def load_state(state_file):
+    """
+    Status of the last job any worker ran, as saved in `state_file`, or None.
+    A job still marked running whose worker has died is reported as "interrupted".
+    """
+    if not state_file:
+        return None
+    try:
+        with open(state_file, encoding="utf-8") as f:
+            status = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if status.get("state") == "running" and not _runner_alive(state_file):
+        status["state"] = "interrupted"
+    return status
+
+
+def request_stop(state_file):
+    """Ask the job running in whichever worker holds the lock to stop after its current batch."""
+    with open(f"{state_file}.stop", "w", encoding="utf-8"):
+        pass
+
+
+def saved_diff_lines(state_file):
+    """diff_lines() of the last dry run any worker ran."""
+    try:
+        with open(f"{state_file}.diff", encoding="utf-8") as f:
+            yield from _format_diff(json.loads(line) for line in f)
+    except FileNotFoundError:
+        return
+
+
+class RateLimiter:
+    """Token bucket: acquire(n) blocks until n images fit under `rate` per second (0 = unlimited)."""
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+
+    def acquire(self, n, stopping=None):
+        if not self.rate:
+            return
+        while True:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # A batch larger than the bucket goes through once the bucket is full
+            if self.tokens >= min(n, self.capacity):
+                self.tokens -= n
+                return
+            if stopping is not None and stopping.is_set():
+                return
+            self.sleep(min(1.0, (min(n, self.capacity) - self.tokens) / self.rate))
+
+
+def selection(filters, target_version):
+    """WHERE clauses for the records a job with these filters re-captions."""
+    where = [
+        DefectRecord.status == "done",
+        DefectRecord.image_path.is_not(None),
+        or_(DefectRecord.user_edited.is_(None), DefectRecord.user_edited == False),  # noqa: E712
+    ]
+    if filters.get("project_id") is not None:
+        where.append(DefectRecord.project_id == filters["project_id"])
+    if filters.get("model_versions"):
+        where.append(DefectRecord.model_version.in_(filters["model_versions"]))
+    else:
+        # Everything not already captioned by the target model, legacy rows included
+        where.append(or_(DefectRecord.model_version.is_(None), DefectRecord.model_version != target_version))
+    if filters.get("since"):
+        where.append(DefectRecord.timestamp >= datetime.fromisoformat(filters["since"]))
+    if filters.get("until"):
+        where.append(DefectRecord.timestamp < datetime.fromisoformat(filters["until"]))
+    return where
+
+
+class RecaptionJob:
+    """
+    One re-captioning run. `load(defect)` returns the caption item for a
+    record (raising if its photo is gone), `caption(items, model_version)`
+    returns one result per item, `apply(defect, result)` writes a result
+    onto a record, and the optional `index(defect, result)` runs after the
+    batch commits. `filters` may hold project_id, model_versions, and
+    since/until (ISO timestamps). See the module docstring for `state_file`.
+    """
+
+    def __init__(self, db_engine, load, caption, apply, target_version, filters=None, index=None,
+                 batch_size=8, rate=0, dry_run=False, checkpoint_path=None, state_file=None):
+        self.db_engine = db_engine
+        self.load = load
+        self.caption = caption
+        self.apply = apply
+        self.index = index
+        self.target_version = target_version
+        self.filters = dict(filters or {})
+        self.batch_size = batch_size
+        self.limiter = RateLimiter(rate)
+        self.dry_run = dry_run
+        self.checkpoint_path = None if dry_run else checkpoint_path
+        self.state_file = state_file
+        self.last_id = 0
+        self.counts = {"updated": 0, "unchanged": 0, "skipped_edited": 0, "failed": 0}
+        self.diff = []
+        self.total = 0
+        self.state = "idle"
+        self.error = None
+        self.started_at = None
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = None
+        self._resume()
+
+    # --- Checkpoint ---
+
+    def _checkpoint_key(self):
+        return {"filters": self.filters, "target_version": self.target_version}
+
+    def _resume(self):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path, encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved.get("key") == self._checkpoint_key():
+            self.last_id = saved["last_id"]
+            self.counts.update(saved["counts"])
+            print(f"♻️ Resuming re-caption job after defect {self.last_id}")
+
+    def _save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        tmp = f"{self.checkpoint_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"key": self._checkpoint_key(), "last_id": self.last_id, "counts": self.counts}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint_path)
+
+    # --- Shared state ---
+
+    def _claim(self):
+        """Take the job lock for the whole run; raises RecaptionBusy if another worker has it."""
+        if not self.state_file:
+            return
+        lock = open(f"{self.state_file}.lock", "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            raise RecaptionBusy("A re-caption job is already running in another worker")
+        self._lock = lock
+        # A stop request or diff left over from an earlier job
+        for suffix in (".stop", ".diff"):
+            if os.path.exists(f"{self.state_file}{suffix}"):
+                os.remove(f"{self.state_file}{suffix}")
+
+    def _release(self):
+        if self._lock is not None:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+            self._lock.close()
+            self._lock = None
+
+    def _save_state(self):
+        if not self.state_file:
+            return
+        tmp = f"{self.state_file}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.status(), f)
+        os.replace(tmp, self.state_file)
+
+    def _stop_requested(self):
+        """A stop() here, or request_stop() from any worker."""
+        if self.state_file and os.path.exists(f"{self.state_file}.stop"):
+            self._stopping.set()
+        return self._stopping.is_set()
+
+    # --- Work ---
+
+    def _page(self, after_id):
+        with Session(self.db_engine) as session:
+            query = (
+                select(DefectRecord)
+                .where(DefectRecord.id > after_id, *selection(self.filters, self.target_version))
+                .order_by(DefectRecord.id)
+                .limit(self.batch_size)
+            )
+            return session.exec(query).all()
+
+    def _remaining(self):
+        with Session(self.db_engine) as session:
+            query = select(func.count(DefectRecord.id)).where(
+                DefectRecord.id > self.last_id, *selection(self.filters, self.target_version)
+            )
+            return session.exec(query).one()
+
+    def _prepare(self, defects):
+        """(defects whose photos loaded, their caption items, number of unreadable photos)."""
+        ready, items, failed = [], [], 0
+        for defect in defects:
+            try:
+                items.append(self.load(defect))
+                ready.append(defect)
+            except Exception as e:
+                print(f"⚠️ Re-caption skipped defect {defect.id}: {e}")
+                failed += 1
+        return ready, items, failed
+
+    def _write(self, defects, results):
+        """Store one batch of results in a single transaction; returns the (defect, result) pairs written."""
+        read = {d.id: d.caption for d in defects}
+        by_id = {d.id: r for d, r in zip(defects, results)}
+        with Session(self.db_engine) as session:
+            current = session.exec(select(DefectRecord).where(DefectRecord.id.in_(list(read)))).all()
+            written = []
+            for defect in current:
+                result = by_id[defect.id]
+                if defect.user_edited or defect.caption != read[defect.id]:
+                    # Edited by a user since the page was read
+                    self.counts["skipped_edited"] += 1
+                    continue
+                # Same text still gets the new model's version, confidence and triage
+                self.counts["unchanged" if result["caption"] == defect.caption else "updated"] += 1
+                self.apply(defect, result)
+                session.add(defect)
+                written.append((defect, result))
+            session.commit()
+            for defect, _ in written:
+                session.refresh(defect)
+        return written
+
+    def _record_diff(self, defects, results):
+        entries = []
+        for defect, result in zip(defects, results):
+            if result["caption"] == defect.caption:
+                self.counts["unchanged"] += 1
+                continue
+            self.counts["updated"] += 1
+            entries.append({
+                "id": defect.id, "project_id": defect.project_id,
+                "old": defect.caption, "new": result["caption"],
+                "old_version": defect.model_version, "new_version": result["model_version"],
+            })
+        self.diff.extend(entries)
+        if self.state_file and entries:
+            with open(f"{self.state_file}.diff", "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries)
+
+    def run(self):
+        self.state = "running"
+        self.started_at = time.monotonic()
+        try:
+            self.total = self._remaining() + sum(self.counts.values())
+            self._save_state()
+            with ThreadPoolExecutor(max_workers=1) as prefetch:
+                page = self._page(self.last_id)
+                upcoming = prefetch.submit(self._prepare, page)
+                while page and not self._stop_requested():
+                    ready, items, failed = upcoming.result()
+                    self.counts["failed"] += failed
+                    # Read the next page's photos while this one is on the model
+                    next_page = self._page(page[-1].id)
+                    upcoming = prefetch.submit(self._prepare, next_page)
+
+                    self.limiter.acquire(len(items), self._stopping)
+                    results = self.caption(items, self.target_version) if items else []
+                    if self.dry_run:
+                        self._record_diff(ready, results)
+                    else:
+                        for defect, result in self._write(ready, results):
+                            if self.index is not None:
+                                self.index(defect, result)
+                    self.last_id = page[-1].id
+                    self._save_checkpoint()
+                    self._save_state()
+                    page = next_page
+            self.state = "stopped" if self._stopping.is_set() else "done"
+            if self.state == "done" and self.checkpoint_path and os.path.exists(self.checkpoint_path):
+                # Finished records no longer match, so the next run can start from the beginning
+                os.remove(self.checkpoint_path)
+        except Exception as e:
+            print(f"❌ Re-caption job failed after defect {self.last_id}: {e}")
+            self.state, self.error = "failed", str(e)
+        finally:
+            self._save_state()
+            self._release()
+        print(f"✅ Re-caption job {self.state}: {self.counts}")
+        return self.status()
+
+    def start(self):
+        """Run in a background thread. Raises RecaptionBusy if a job is running in another worker."""
+        self._claim()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=30):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+    def status(self):
+        done = sum(self.counts.values())
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        rate = done / elapsed if elapsed and done else 0.0
+        return {
+            "state": self.state,
+            "error": self.error,
+            "dry_run": self.dry_run,
+            "target_version": self.target_version,
+            "filters": self.filters,
+            "total": self.total,
+            "done": done,
+            **self.counts,
+            "last_id": self.last_id,
+            "images_per_sec": round(rate, 2),
+            "eta_sec": round((self.total - done) / rate, 1) if rate else None,
+            "diff_preview": self.diff[:DIFF_PREVIEW],
+        }
+
+    def diff_lines(self):
+        """The dry-run diff as text: one -/+ pair per changed caption."""
+        return _format_diff(self.diff)
@@ -0,0 +1,229 @@
+"""
+Priority scheduler in front of the captioning engine.
+
+Every caption request becomes a job tagged with a priority class
+("interactive" for an inspector waiting on a photo, "bulk" for backfills
+and batch uploads) and an optional deadline. One worker thread always
+serves the highest-priority waiting job, micro-batching it with other jobs
+of the same class and decoding parameters. Jobs whose caller has gone away
+(future cancelled) or whose deadline has passed are dropped instead of
+being run. Bulk batches are kept small, so interactive work waits behind at
+most one short bulk batch.
+"""
+import time
+import heapq
+import itertools
+import threading
+from contextlib import nullcontext
+from concurrent.futures import Future
+
+import metrics
+
+PRIORITIES = {"interactive": 0, "bulk": 1}
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class _Job:
+    __slots__ = ("items", "priority", "deadline", "params", "on_tokens", "wrap", "future", "enqueued_at")
+
+    def __init__(self, items, priority, deadline, params, on_tokens=None, wrap=None):
+        self.items = items
+        self.priority = priority
+        self.deadline = deadline
+        self.params = params
+        self.on_tokens = on_tokens
+        self.wrap = wrap
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+    def expired(self, now):
+        return self.deadline is not None and now >= self.deadline
+
+
+class InferenceScheduler:
+    """
+    `run_batch(items, priority=..., **params)` must return one result per item.
+    Jobs are grouped into one call only when their priority and params match.
+    If any job in a batch streams partial output, run_batch also receives
+    `on_tokens(index, token_ids)` indexed over the whole batch. With
+    forward_deadline, it also receives `deadline`: the latest deadline of the
+    batch's jobs, or None if one of them has none. A job submitted with `wrap`
+    (e.g. a profiler) runs in a batch of its own, inside `wrap()` on the worker thread.
+
+    Dropped jobs are counted in SCHEDULER_DROPPED_TOTAL here and nowhere else.
+    A caller that gives up on an expired job should stop waiting without
+    cancelling it, so it is counted under "deadline" rather than "cancelled".
+    """
+
+    def __init__(self, run_batch, max_batch=8, bulk_max_batch=2, forward_deadline=False):
+        self.run_batch = run_batch
+        self.forward_deadline = forward_deadline
+        self.max_batch = {"interactive": max_batch, "bulk": bulk_max_batch}
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = 0
+        self._stopping = False
+        self._worker = None
+
+    def submit(self, items, priority="interactive", deadline=None, on_tokens=None, wrap=None, **params):
+        """
+        Queue `items` and return a concurrent Future with their results.
+        `deadline` is an absolute time.monotonic() value; cancel the future to drop the job.
+        `on_tokens(index, token_ids)` receives partial output for this job's items while it runs.
+        `wrap()` returns a context manager to run this job's batch under.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{priority}', expected one of {sorted(PRIORITIES)}")
+        job = _Job(list(items), priority, deadline, params, on_tokens, wrap)
+        job.future.add_done_callback(self._on_done)
+        with self._cond:
+            heapq.heappush(self._heap, (PRIORITIES[priority], next(self._seq), job))
+            self._update_depth()
+            self._cond.notify()
+        return job.future
+
+    def pending(self):
+        """Waiting jobs per priority class."""
+        with self._cond:
+            counts = {name: 0 for name in PRIORITIES}
+            for _, _, job in self._heap:
+                if not job.future.cancelled():
+                    counts[job.priority] += 1
+            return counts
+
+    def _update_depth(self):
+        # Cancelled jobs stay in the heap until the worker drops them, but nobody is waiting on them
+        waiting = sum(not job.future.cancelled() for _, _, job in self._heap)
+        metrics.QUEUE_DEPTH.set(waiting + self._running)
+
+    def _on_done(self, future):
+        if future.cancelled():
+            with self._cond:
+                self._update_depth()
+
+    def _drop(self, job, reason):
+        metrics.SCHEDULER_DROPPED_TOTAL.inc(priority=job.priority, reason=reason)
+        if reason == "deadline" and not job.future.done():
+            job.future.set_exception(DeadlineExceeded(f"{job.priority} job expired after queueing"))
+
+    def _claim(self, job, now):
+        """Mark a job as running; returns False (after dropping it) if it should not run."""
+        if job.future.cancelled():
+            self._drop(job, "cancelled")
+            return False
+        if job.expired(now):
+            self._drop(job, "deadline")
+            return False
+        if not job.future.set_running_or_notify_cancel():
+            self._drop(job, "cancelled")
+            return False
+        return True
+
+    def _take_batch(self):
+        with self._cond:
+            while True:
+                while not self._heap and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return None
+
+                now = time.monotonic()
+                first = None
+                while self._heap and first is None:
+                    _, _, job = heapq.heappop(self._heap)
+                    if self._claim(job, now):
+                        first = job
+                if first is None:
+                    self._update_depth()
+                    continue
+
+                # Fill the batch with compatible jobs of the same class, oldest first
+                batch, rows, skipped = [first], len(first.items), []
+                limit = self.max_batch[first.priority] if first.wrap is None else rows
+                while self._heap and rows < limit and self._heap[0][2].priority == first.priority:
+                    entry = heapq.heappop(self._heap)
+                    job = entry[2]
+                    if job.params != first.params or job.wrap is not None or rows + len(job.items) > limit:
+                        skipped.append(entry)
+                    elif self._claim(job, now):
+                        batch.append(job)
+                        rows += len(job.items)
+                for entry in skipped:
+                    heapq.heappush(self._heap, entry)
+
+                self._running = len(batch)
+                self._update_depth()
+                return batch
+
+    def _run(self):
+        while True:
+            jobs = self._take_batch()
+            if jobs is None:
+                return
+            started = time.monotonic()
+            for job in jobs:
+                metrics.SCHEDULER_WAIT_SECONDS.observe(started - job.enqueued_at, priority=job.priority)
+
+            items = [item for job in jobs for item in job.items]
+            extra = {}
+            if any(job.on_tokens is not None for job in jobs):
+                extra["on_tokens"] = self._route_tokens(jobs)
+            if self.forward_deadline:
+                deadlines = [job.deadline for job in jobs]
+                extra["deadline"] = None if None in deadlines else max(deadlines)
+            try:
+                with (jobs[0].wrap or nullcontext)():
+                    results = self.run_batch(items, priority=jobs[0].priority, **extra, **jobs[0].params)
+            except Exception as e:
+                for job in jobs:
+                    job.future.set_exception(e)
+            else:
+                offset = 0
+                for job in jobs:
+                    job.future.set_result(results[offset:offset + len(job.items)])
+                    offset += len(job.items)
+
+            with self._cond:
+                self._running = 0
+                self._update_depth()
+
+    @staticmethod
+    def _route_tokens(jobs):
+        """Map batch-wide item indices back to each job's own on_tokens callback."""
+        owners = []
+        for job in jobs:
+            owners.extend((job, i) for i in range(len(job.items)))
+
+        def on_tokens(index, token_ids):
+            job, local = owners[index]
+            if job.on_tokens is not None:
+                job.on_tokens(local, token_ids)
+
+        return on_tokens
+
+    def start(self):
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._worker is not None:
+            self._worker.join(timeout=10)
+        # Anything still queued will never run
+        with self._cond:
+            while self._heap:
+                _, _, job = heapq.heappop(self._heap)
+                job.future.cancel()
+            self._update_depth()
+
+
+def deadline_from_ms(deadline_ms):
+    """Relative budget in milliseconds -> absolute monotonic deadline (None/0 means no deadline)."""
+    return time.monotonic() + deadline_ms / 1000 if deadline_ms else None
@@ -0,0 +1,107 @@
+"""
+Change feed for offline clients.
+
+Every insert or update of a Project or DefectRecord stamps the row with the
+next value of a single database-wide counter, and every delete leaves a
+Tombstone stamped the same way. A client remembers the highest version it
+has seen and asks for `/sync?since=<version>` to get only what changed.
+
+Versions are handed out by an UPDATE on the counter row inside the writing
+transaction. SQLite holds its write lock from that UPDATE until commit, so
+versions become visible in the order they were issued and a client cursor
+never skips a change that commits later.
+"""
+from sqlalchemy import event, or_, text
+from sqlmodel import Session, select
+
+from models import DefectRecord, Project, Tombstone
+
+TRACKED = {Project: "project", DefectRecord: "defect"}
+
+
+def next_versions(connection, count):
+    """Reserve `count` consecutive versions and return them as a range."""
+    row = connection.execute(
+        text("UPDATE synccounter SET value = value + :n WHERE id = 1 RETURNING value"), {"n": count}
+    ).first()
+    if row is None:
+        connection.execute(text("INSERT INTO synccounter (id, value) VALUES (1, :n)"), {"n": count})
+        last = count
+    else:
+        last = row[0]
+    return range(last - count + 1, last + 1)
+
+
+def current_version(session):
+    row = session.connection().execute(text("SELECT value FROM synccounter WHERE id = 1")).first()
+    return row[0] if row else 0
+
+
+@event.listens_for(Session, "before_flush")
+def _stamp_versions(session, flush_context, instances):
+    changed = [o for o in session.new if type(o) in TRACKED]
+    changed += [o for o in session.dirty if type(o) in TRACKED and session.is_modified(o)]
+    deleted = [o for o in session.deleted if type(o) in TRACKED]
+    if not changed and not deleted:
+        return
+    versions = iter(next_versions(session.connection(), len(changed) + len(deleted)))
+    for obj in changed:
+        obj.version = next(versions)
+    for obj in deleted:
+        kind = TRACKED[type(obj)]
+        session.add(Tombstone(
+            kind=kind,
+            row_id=obj.id,
+            project_id=obj.id if kind == "project" else obj.project_id,
+            version=next(versions),
+        ))
+
+
+def changes_since(session, since=0, project_id=None, limit=1000, defect_session=None):
+    """
+    Rows created, updated or deleted after version `since`, oldest first and at
+    most `limit` of them. With `project_id`, defects (and their tombstones) are
+    limited to that project; project rows are always included. Defects are
+    read from `defect_session` when given (an archived project's shard).
+    Returns a dict with the next cursor in "version" and "has_more".
+    """
+    def fetch(model, *where, source=session):
+        query = select(model).where(model.version > since, *where).order_by(model.version).limit(limit + 1)
+        return source.exec(query).all()
+
+    defect_filter = [DefectRecord.project_id == project_id] if project_id else []
+    tombstone_filter = [or_(Tombstone.kind == "project", Tombstone.project_id == project_id)] if project_id else []
+    entries = sorted(
+        [(p.version, "projects", p) for p in fetch(Project)]
+        + [(d.version, "defects", d) for d in fetch(DefectRecord, *defect_filter, source=defect_session or session)]
+        + [(t.version, "deleted", t) for t in fetch(Tombstone, *tombstone_filter)],
+        key=lambda entry: entry[0],
+    )
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    feed = {"projects": [], "defects": [], "deleted": {"projects": [], "defects": []}}
+    for _, bucket, row in entries:
+        if bucket == "deleted":
+            feed["deleted"][f"{row.kind}s"].append(row.row_id)
+        else:
+            feed[bucket].append(row)
+    feed["version"] = entries[-1][0] if has_more else max(since, current_version(session))
+    feed["has_more"] = has_more
+    return feed
+
+
+def backfill_versions(db_engine):
+    """Version rows written before change tracking existed."""
+    with db_engine.begin() as connection:
+        for model in TRACKED:
+            table = model.__tablename__
+            ids = [row[0] for row in connection.execute(text(f'SELECT id FROM "{table}" WHERE version IS NULL ORDER BY id'))]
+            if not ids:
+                continue
+            versions = next_versions(connection, len(ids))
+            connection.execute(
+                text(f'UPDATE "{table}" SET version = :version WHERE id = :id'),
+                [{"version": v, "id": i} for v, i in zip(versions, ids)],
+            )
+            print(f"✅ Assigned sync versions to {len(ids)} existing '{table}' rows")
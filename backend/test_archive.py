@@ -0,0 +1,113 @@
+import os
+
+import pytest
+from sqlmodel import Session, SQLModel, create_engine, select
+
+import archive
+import sync
+from models import DefectRecord, Project, Tombstone
+
+
+@pytest.fixture
+def db(tmp_path):
+    db_engine = create_engine(f"sqlite:///{tmp_path / 'hot.db'}", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(db_engine)
+    with Session(db_engine) as session:
+        session.add_all([Project(name="Active"), Project(name="Finished")])
+        session.commit()
+        session.add_all([
+            DefectRecord(filename=f"{i}.jpg", caption=f"c{i}", label="crack", confidence=0.9,
+                         image_path=f"uploads/{i}.jpg", project_id=1 if i < 2 else 2)
+            for i in range(5)
+        ])
+        session.commit()
+    return db_engine
+
+
+def test_archive_moves_defects_and_leaves_stub(db, tmp_path):
+    archive_dir = str(tmp_path / "archive")
+    assert archive.archive_project(db, 2, archive_dir) == 3
+
+    with Session(db) as session:
+        stub = session.get(Project, 2)
+        assert stub.archive_path == "project_2.db" and stub.archived_max_defect_id == 5
+        assert [d.project_id for d in session.exec(select(DefectRecord)).all()] == [1, 1]
+        # Moving rows out is not a delete as far as syncing clients are concerned
+        assert session.exec(select(Tombstone)).all() == []
+        assert [p.id for p in sync.changes_since(session, since=stub.version - 1)["projects"]] == [2]
+
+        with archive.shard_session(archive_dir, stub) as shard:
+            assert [d.caption for d in shard.exec(select(DefectRecord).order_by(DefectRecord.id)).all()] == ["c2", "c3", "c4"]
+        assert sorted(d.id for d in archive.find_defects(session, archive_dir, [1, 4, 5])) == [4, 5]
+    assert archive.referenced_images(db, archive_dir) == {"uploads/2.jpg", "uploads/3.jpg", "uploads/4.jpg"}
+
+    with pytest.raises(ValueError):
+        archive.archive_project(db, 2, archive_dir)
+    with pytest.raises(LookupError):
+        archive.archive_project(db, 9, archive_dir)
+
+
+def test_new_defects_do_not_reuse_archived_ids(db, tmp_path):
+    archive.archive_project(db, 2, str(tmp_path / "archive"))
+    with Session(db) as session:
+        defect = DefectRecord(filename="new.jpg", caption="n", label="crack", confidence=0.9, project_id=1)
+        session.add(defect)
+        session.commit()
+        assert defect.id == 6
+
+
+def test_restore_brings_rows_back_with_new_versions(db, tmp_path):
+    archive_dir = str(tmp_path / "archive")
+    archive.archive_project(db, 2, archive_dir)
+    with Session(db) as session:
+        cursor = sync.current_version(session)
+
+    assert archive.restore_project(db, 2, archive_dir) == 3
+    assert not os.path.exists(os.path.join(archive_dir, "project_2.db"))
+    with Session(db) as session:
+        project = session.get(Project, 2)
+        assert project.archive_path is None and project.archived_max_defect_id is None
+        delta = sync.changes_since(session, since=cursor)
+        assert sorted(d.id for d in delta["defects"]) == [3, 4, 5]
+        assert len(session.exec(select(DefectRecord)).all()) == 5
+    with pytest.raises(ValueError):
+        archive.restore_project(db, 2, archive_dir)
+
+
+def test_archive_refuses_projects_with_pending_uploads(db, tmp_path):
+    with Session(db) as session:
+        session.add(DefectRecord(filename="p.jpg", caption="", label="", confidence=0, project_id=2, status="pending"))
+        session.commit()
+    with pytest.raises(ValueError):
+        archive.archive_project(db, 2, str(tmp_path / "archive"))
+    with Session(db) as session:
+        assert session.get(Project, 2).archive_path is None
+
+
+def test_sync_of_archived_project_reads_its_shard(db, tmp_path):
+    archive_dir = str(tmp_path / "archive")
+    archive.archive_project(db, 2, archive_dir)
+    with Session(db) as session:
+        # A device opening the project for the first time syncs it from 0
+        feed = archive.changes_since(session, archive_dir, since=0, project_id=2)
+        assert sorted(d.id for d in feed["defects"]) == [3, 4, 5]
+        assert feed["version"] == sync.current_version(session)
+        assert archive.changes_since(session, archive_dir, since=feed["version"], project_id=2)["defects"] == []
+        assert sorted(d.id for d in archive.changes_since(session, archive_dir, since=0, project_id=1)["defects"]) == [1, 2]
+
+
+def test_open_shards_are_bounded_and_scans_do_not_cache(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(archive.config, "ARCHIVE_OPEN_SHARDS", 1)
+    archive_dir = str(tmp_path / "archive")
+    archive.archive_project(db, 1, archive_dir)
+    archive.archive_project(db, 2, archive_dir)
+    shards = [os.path.join(archive_dir, archive.shard_name(i)) for i in (1, 2)]
+
+    assert len(archive.referenced_images(db, archive_dir)) == 5
+    with Session(db) as session:
+        assert len(archive.find_defects(session, archive_dir, [1, 5])) == 2
+        assert not any(path in archive._engines for path in shards)
+        for project in archive.archived_projects(session):
+            with archive.shard_session(archive_dir, project) as shard:
+                assert len(shard.exec(select(DefectRecord)).all()) in (2, 3)
+    assert [path for path in archive._engines if path in shards] == shards[1:]
@@ -0,0 +1,92 @@
+import os
+import zipfile
+
+import pytest
+from PIL import Image
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from bulk_caption import list_images, run_bulk
+from engine import ImageCaptioningEngine
+from models import DefectRecord, Project
+from tiny_model import build_tiny_checkpoint
+
+
+@pytest.fixture(scope="module")
+def engine(tmp_path_factory):
+    model_dir = build_tiny_checkpoint(str(tmp_path_factory.mktemp("tiny_model")), image_size=32, hidden_size=32)
+    return ImageCaptioningEngine(model_path=model_dir)
+
+
+@pytest.fixture
+def db_engine(tmp_path):
+    db = create_engine(f"sqlite:///{tmp_path / 'bulk.db'}")
+    SQLModel.metadata.create_all(db)
+    with Session(db) as session:
+        session.add(Project(name="Archive"))
+        session.commit()
+    return db
+
+
+def make_archive(folder, count):
+    os.makedirs(folder / "room_a", exist_ok=True)
+    for i in range(count):
+        Image.new("RGB", (40, 30), (i * 20, 0, 0)).save(folder / "room_a" / f"img_{i}.jpg")
+    (folder / "notes.txt").write_text("not an image")
+    (folder / "broken.jpg").write_bytes(b"not really a jpeg")
+
+
+def test_list_images_directory_and_zip(tmp_path):
+    make_archive(tmp_path / "photos", 3)
+    assert list_images(str(tmp_path / "photos")) == [
+        "broken.jpg", "room_a/img_0.jpg", "room_a/img_1.jpg", "room_a/img_2.jpg"
+    ]
+    zip_path = tmp_path / "photos.zip"
+    with zipfile.ZipFile(zip_path, "w") as zf:
+        zf.write(tmp_path / "photos" / "room_a" / "img_0.jpg", "a/img_0.jpg")
+    assert list_images(str(zip_path)) == ["a/img_0.jpg"]
+
+
+def test_run_bulk_resumes_from_checkpoint(tmp_path, engine, db_engine):
+    make_archive(tmp_path / "photos", 5)
+    kwargs = dict(
+        engine=engine, db_engine=db_engine, uploads_dir=str(tmp_path / "uploads"),
+        checkpoint_path=str(tmp_path / "ckpt"), batch_size=2, num_workers=2, max_length=8, num_beams=1,
+    )
+
+    first = run_bulk(str(tmp_path / "photos"), 1, **kwargs)
+    assert first["processed"] == 5
+    assert first["failed"] == 1
+
+    with Session(db_engine) as session:
+        records = session.exec(select(DefectRecord)).all()
+    assert len(records) == 5
+    assert all(os.path.exists(tmp_path / "uploads" / r.image_path.split("/", 1)[1]) for r in records)
+
+    second = run_bulk(str(tmp_path / "photos"), 1, **kwargs)
+    assert second["processed"] == 0
+    assert second["skipped"] == 6
+
+    # The same checkpoint cannot silently skip everything for another project
+    with pytest.raises(ValueError, match="project 1"):
+        run_bulk(str(tmp_path / "photos"), 2, **kwargs)
+
+
+def test_run_bulk_keeps_same_named_photos_apart_and_never_duplicates(tmp_path, engine, db_engine):
+    make_archive(tmp_path / "site_a", 2)
+    make_archive(tmp_path / "site_b", 2)
+    kwargs = dict(
+        engine=engine, db_engine=db_engine, uploads_dir=str(tmp_path / "uploads"),
+        batch_size=2, num_workers=0, max_length=8, num_beams=1,
+    )
+    run_bulk(str(tmp_path / "site_a"), 1, checkpoint_path=str(tmp_path / "ckpt_a"), **kwargs)
+    run_bulk(str(tmp_path / "site_b"), 1, checkpoint_path=str(tmp_path / "ckpt_b"), **kwargs)
+    with Session(db_engine) as session:
+        paths = [r.image_path for r in session.exec(select(DefectRecord)).all()]
+    assert len(paths) == 4 and len(set(paths)) == 4
+
+    # Records committed but never checkpointed (a crash in between) are not inserted again
+    os.remove(tmp_path / "ckpt_a")
+    rerun = run_bulk(str(tmp_path / "site_a"), 1, checkpoint_path=str(tmp_path / "ckpt_a"), **kwargs)
+    assert rerun["processed"] == 0
+    with Session(db_engine) as session:
+        assert len(session.exec(select(DefectRecord)).all()) == 4
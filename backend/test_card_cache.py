@@ -0,0 +1,64 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+import card_cache
+import pdf_generator
+
+
+def jpeg(color, size=(400, 300)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def test_lru_eviction_by_size(tmp_path):
+    cache = card_cache.CardCache(str(tmp_path), max_bytes=3000)
+    for key in "abc":
+        cache.put(key, b"x" * 900, {"caption_lines": [key]})
+    assert cache.get("a") == (b"x" * 900, {"caption_lines": ["a"]})
+    cache.put("d", b"x" * 900, {})
+    # "b" was least recently used once "a" was read
+    assert cache.get("b") is None and cache.get("a") is not None
+    assert cache.total <= 3000
+
+    # Recency survives a restart through file mtimes
+    os.utime(tmp_path / "c.card", (1, 1))
+    reopened = card_cache.CardCache(str(tmp_path), max_bytes=3000)
+    assert len(reopened) == 3
+    reopened.put("e", b"x" * 900, {})
+    assert reopened.get("c") is None and reopened.get("d") is not None
+
+
+def test_image_digest_matches_across_sources(tmp_path):
+    data = jpeg("red")
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(data)
+    assert card_cache.image_digest({"image_data": data}) == card_cache.image_digest({"image_path": str(path)})
+    assert card_cache.image_digest({"image_data": jpeg("blue")}) != card_cache.image_digest({"image_data": data})
+
+
+def test_report_reuses_cards_and_rebuilds_edited_ones(tmp_path, monkeypatch):
+    cache = card_cache.CardCache(str(tmp_path / "cards"), max_bytes=10 * 1024 * 1024)
+    items = [
+        {"image_data": jpeg(color), "caption": f"ผนังมีรอยร้าว {i}" * 4, "room": "Kitchen", "severity": "High"}
+        for i, color in enumerate(["red", "green", "blue"])
+    ]
+    first = pdf_generator.generate_defect_pdf(items, str(tmp_path / "first.pdf"), card_cache=cache)
+    assert os.path.getsize(first) > 0 and len(cache) == 3
+
+    prepared = []
+    original = pdf_generator.prepare_card_image
+    monkeypatch.setattr(pdf_generator, "prepare_card_image", lambda item: prepared.append(item) or original(item))
+    items[1]["caption"] = "แก้ไขแล้ว"
+    pdf_generator.generate_defect_pdf(items, str(tmp_path / "second.pdf"), card_cache=cache)
+    assert prepared == [items[1]] and len(cache) == 4
+
+
+def test_unreadable_photos_are_skipped(tmp_path):
+    items = [{"image_data": b"not an image", "caption": "x"}, {"image_data": jpeg("red"), "caption": "y"}]
+    pdf_generator.generate_defect_pdf(items, str(tmp_path / "report.pdf"))
+    with pytest.raises(ValueError):
+        pdf_generator.generate_defect_pdf(items[:1], str(tmp_path / "empty.pdf"))
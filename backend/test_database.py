@@ -0,0 +1,37 @@
+import sqlite3
+
+from sqlmodel import create_engine
+
+import database
+
+
+def test_add_missing_columns_upgrades_old_database(tmp_path):
+    db_path = tmp_path / "old.db"
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE defectrecord (id INTEGER PRIMARY KEY, filename VARCHAR NOT NULL, caption VARCHAR NOT NULL, "
+        "label VARCHAR NOT NULL, confidence FLOAT NOT NULL, timestamp DATETIME NOT NULL)"
+    )
+    conn.execute("INSERT INTO defectrecord VALUES (1, 'a.jpg', 'ผนังร้าว', 'crack', 0.9, '2024-01-01')")
+    conn.commit()
+    conn.close()
+
+    import models  # noqa: F401  (registers tables on SQLModel.metadata)
+    db_engine = create_engine(f"sqlite:///{db_path}")
+    database.add_missing_columns(db_engine)
+    database.relax_not_null(db_engine)
+    db_engine.dispose()
+
+    conn = sqlite3.connect(db_path)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(defectrecord)")}
+    not_null = {row[1] for row in conn.execute("PRAGMA table_info(defectrecord)") if row[3]}
+    confidences = [row[0] for row in conn.execute("SELECT confidence FROM defectrecord")]
+    indexes = {row[1] for row in conn.execute("PRAGMA index_list(defectrecord)")}
+    statuses = {row[0] for row in conn.execute("SELECT status FROM defectrecord")}
+    conn.close()
+    assert {"project_id", "severity", "decoding_profile", "status"} <= columns
+    assert {"ix_defectrecord_version", "ix_defectrecord_status"} <= indexes
+    # Rows captioned before async ingestion count as done
+    assert statuses == {"done"}
+    # Confidence may now be unknown; the rebuild keeps the existing value
+    assert "confidence" not in not_null and confidences == [0.9]
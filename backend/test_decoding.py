@@ -0,0 +1,34 @@
+import pytest
+
+import config
+from decoding import AdaptiveProfileSelector, PROFILE_ORDER, get_profile
+
+
+def test_profiles_follow_config():
+    quality = get_profile("quality")
+    assert quality == {
+        "num_beams": config.NUM_BEAMS,
+        "max_length": config.MAX_LENGTH,
+        "repetition_penalty": config.REPETITION_PENALTY,
+    }
+    assert get_profile("fast-greedy")["num_beams"] == 1
+    with pytest.raises(ValueError):
+        get_profile("turbo")
+
+
+def test_selector_steps_down_under_queue_depth():
+    selector = AdaptiveProfileSelector(queue_thresholds=[4, 10])
+    assert selector.select("quality", queue_depth=0) == "quality"
+    assert selector.select("quality", queue_depth=4) == "balanced"
+    assert selector.select("quality", queue_depth=50) == "fast-greedy"
+    # Never upgrades and never goes below the cheapest profile
+    assert selector.select("fast-greedy", queue_depth=50) == "fast-greedy"
+    assert selector.select("balanced", queue_depth=0) == "balanced"
+
+
+def test_selector_steps_down_on_latency():
+    selector = AdaptiveProfileSelector(latency_thresholds=[1.0], smoothing=1.0)
+    selector.observe(0.2)
+    assert selector.select("quality", queue_depth=0) == "quality"
+    selector.observe(3.0)
+    assert selector.select("quality", queue_depth=0) == PROFILE_ORDER[1]
@@ -0,0 +1,79 @@
+import torch
+from PIL import Image
+
+import defect_head
+from engine import ImageCaptioningEngine
+from tiny_model import build_tiny_checkpoint
+
+
+def test_label_from_caption():
+    assert defect_head.label_from_caption("ผนังห้องน้ำมีรอยร้าว") == "wall_crack"
+    assert defect_head.label_from_caption("กระเบื้องแตกร้าว") == "broken_tile"
+    assert defect_head.label_from_caption("ท่อน้ำใต้ซิงค์รั่วซึม") == "leaking_pipe"
+    assert defect_head.label_from_caption("ประตูปิดไม่สนิท") == "unknown"
+
+
+def test_fit_learns_separable_classes_and_round_trips(tmp_path):
+    generator = torch.Generator().manual_seed(0)
+    centers = torch.randn(3, 16, generator=generator) * 4
+    embeddings = torch.cat([c + torch.randn(20, 16, generator=generator) for c in centers])
+    labels = ["wall_crack"] * 20 + ["leaking_pipe"] * 20 + ["mold_growth"] * 20
+    # Severity only known for some photos
+    severities = (["High"] * 10 + [None] * 10) + ["Low"] * 20 + [None] * 20
+
+    head = defect_head.fit(embeddings, labels, severities)
+    predictions = head.predict(embeddings)
+    assert [p["label"] for p in predictions] == labels
+    assert [p["severity"] for p in predictions[:10]] == ["High"] * 10
+    assert all(0 < p["label_confidence"] <= 1 for p in predictions)
+
+    head.save(str(tmp_path))
+    loaded = defect_head.DefectHead.load(str(tmp_path))
+    assert loaded.predict(embeddings) == predictions
+    assert defect_head.DefectHead.load(str(tmp_path / "missing")) is None
+
+
+def test_engine_uses_trained_head(tmp_path):
+    model_dir = build_tiny_checkpoint(str(tmp_path / "model"), image_size=32, hidden_size=32)
+    defect_head.DefectHead(32, severities=["Critical"]).save(model_dir)
+    engine = ImageCaptioningEngine(model_path=model_dir)
+    assert engine.defect_head is not None
+    result = engine.caption_batch([Image.new("RGB", (40, 40), "red")], max_length=8, num_beams=1)[0]
+    assert result["severity"] == "Critical" and result["label"] in defect_head.CATEGORIES
+
+
+def test_main_trains_on_corrected_records_of_its_own_version(tmp_path, monkeypatch):
+    from sqlmodel import Session, SQLModel, create_engine
+
+    import database
+    from embedding_index import VersionedEmbeddingStore
+    from models import DefectRecord
+
+    db_engine = create_engine(f"sqlite:///{tmp_path / 'head.db'}")
+    SQLModel.metadata.create_all(db_engine)
+    monkeypatch.setattr(database, "engine", db_engine)
+    stores = VersionedEmbeddingStore(str(tmp_path / "embeddings"))
+    rows = [
+        ("wall_crack", True, "v2"),
+        ("mold_growth", True, "v2"),
+        ("leaking_pipe", False, "v2"),  # the model's own guess
+        ("broken_tile", True, "base"),  # embedded by another encoder
+    ]
+    with Session(db_engine) as session:
+        for i, (label, edited, version) in enumerate(rows):
+            session.add(DefectRecord(id=i + 1, filename=f"{i}.jpg", caption="c", label=label, confidence=0.5,
+                                     user_edited=edited, model_version=version))
+            stores.add(version, i + 1, 1, torch.randn(16).numpy())
+        session.commit()
+
+    fitted = []
+
+    def fit(vectors, labels, severities, **kwargs):
+        fitted.append(labels)
+        return defect_head.DefectHead(vectors.shape[1])
+
+    monkeypatch.setattr(defect_head, "fit", fit)
+    model_dir = tmp_path / "model_versions" / "v2"
+    model_dir.mkdir(parents=True)
+    assert defect_head.main(["--model-dir", str(model_dir), "--embeddings", str(tmp_path / "embeddings")]) == 0
+    assert fitted == [["wall_crack", "mold_growth"]]
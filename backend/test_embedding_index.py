@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import embedding_index
+from embedding_index import EmbeddingStore
+from engine import ImageCaptioningEngine
+from tiny_model import build_tiny_checkpoint
+
+
+def random_vectors(count, dim=16, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+
+
+def test_search_is_per_project_and_skips_removed(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    vectors = random_vectors(6)
+    for i, v in enumerate(vectors):
+        store.add(i + 1, project_id=1 if i < 4 else 2, embedding=v)
+
+    hits = store.search(1, vectors[0], k=3)
+    assert hits[0][0] == 1 and hits[0][1] == pytest.approx(1.0, abs=1e-3)
+    assert {defect_id for defect_id, _ in store.search(1, vectors[0], k=10)} == {1, 2, 3, 4}
+
+    assert store.remove(1)
+    assert store.nearest(1, vectors[0])[0] != 1
+    assert store.search(1, vectors[1], k=10, exclude=2)[0][0] != 2
+
+    store.remove_project(2)
+    assert store.search(2, vectors[4]) == []
+
+
+def test_store_survives_reopen_and_growth(tmp_path):
+    vectors = random_vectors(3000, seed=1)
+    store = EmbeddingStore(str(tmp_path))
+    store.add_many(list(range(1, 3001)), 7, vectors)
+    store.remove(5)
+    store.flush()
+
+    reopened = EmbeddingStore(str(tmp_path))
+    assert reopened.count == 3000
+    assert reopened.get(5) is None
+    np.testing.assert_allclose(reopened.get(10), store.normalize(vectors[9]), atol=1e-3)
+    assert reopened.nearest(7, vectors[99])[0] == 100
+
+
+def test_ivf_index_recall(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_index, "IVF_MIN_ROWS", 500)
+    # Clustered data, like photos of a handful of rooms
+    rng = np.random.default_rng(2)
+    centers = rng.standard_normal((20, 32))
+    vectors = (centers[rng.integers(0, 20, 4000)] + 0.3 * rng.standard_normal((4000, 32))).astype(np.float32)
+    store = EmbeddingStore(str(tmp_path), nprobe=8)
+    store.add_many(list(range(4000)), 1, vectors)
+
+    normed = store.normalize(vectors)
+    recall = []
+    for q in range(0, 4000, 100):
+        exact = set(np.argsort(-(normed @ normed[q]))[:10].tolist())
+        found = {defect_id for defect_id, _ in store.search(1, vectors[q], k=10)}
+        recall.append(len(exact & found) / 10)
+    assert np.mean(recall) >= 0.9
+    assert 1 in store._indexes
+
+    # Rows added after the index was built are still found
+    store.add(9999, 1, -vectors[0])
+    assert store.nearest(1, -vectors[0])[0] == 9999
+
+
+def test_near_duplicates_reuse_caption_without_decoding(tmp_path):
+    model_dir = build_tiny_checkpoint(str(tmp_path / "model"), image_size=32, hidden_size=32)
+    engine = ImageCaptioningEngine(model_path=model_dir)
+    images = [Image.new("RGB", (40, 40), color) for color in ("red", "blue")]
+
+    fresh = engine.caption_batch(images, max_length=8, num_beams=1)
+    assert [r["caption"] for r in fresh] == engine.predict_batch(images, max_length=8, num_beams=1)
+    assert all(r["reused_from"] is None and r["embedding"].shape == (32,) for r in fresh)
+
+    decoded = []
+    original = engine.generate
+    engine.generate = lambda pixel_values, **kwargs: decoded.append(len(pixel_values)) or original(pixel_values, **kwargs)
+    reused = engine.caption_batch(
+        images, max_length=8, num_beams=1, reuse=lambda embeddings: [(42, "ซ้ำ", 0.8), None]
+    )
+    assert decoded == [1]
+    assert reused[0] == {**reused[0], "caption": "ซ้ำ", "confidence": 0.8, "reused_from": 42}
+    assert reused[1]["caption"] == fresh[1]["caption"]
+
+
+def test_stores_sharing_a_directory_see_each_others_rows(tmp_path):
+    vectors = random_vectors(4, seed=3)
+    first, second = EmbeddingStore(str(tmp_path)), EmbeddingStore(str(tmp_path))
+    first.add(1, 1, vectors[0])
+    second.add_many([2, 3], 1, vectors[1:3])
+    # Appended after the other store's rows instead of over them
+    assert second.count == 3
+    assert first.nearest(1, vectors[2])[0] == 3
+
+    first.add(2, 1, vectors[3])
+    assert second.get(2) == pytest.approx(EmbeddingStore.normalize(vectors[3]), abs=1e-2)
+    second.remove(3)
+    assert first.get(3) is None
+    assert {defect_id for defect_id, _ in first.search(1, vectors[0], k=10)} == {1, 2}
+
+
+def test_versions_are_kept_apart(tmp_path):
+    vectors = random_vectors(3, seed=4)
+    legacy = EmbeddingStore(str(tmp_path))
+    legacy.add(1, 1, vectors[0])
+    legacy.flush()
+
+    stores = embedding_index.VersionedEmbeddingStore(str(tmp_path), legacy_version="base")
+    assert stores.versions() == ["base"] and stores.store("base").nearest(1, vectors[0])[0] == 1
+    # Same width, different encoder: a v2 photo never matches a base photo
+    stores.add("v2", 2, 1, vectors[0])
+    assert [hit[0] for hit in stores.store("v2").search(1, vectors[0])] == [2]
+    # Re-captioned under v2, so its base row goes
+    stores.add("v2", 1, 1, vectors[1])
+    assert stores.store("base").get(1) is None and stores.store("v2").get(1) is not None
+    assert stores.remove(1) and stores.store("v2").get(1) is None
+    stores.remove_project(1)
+    assert stores.store("v2").search(1, vectors[0]) == []
@@ -0,0 +1,107 @@
+import pytest
+import torch
+from PIL import Image
+
+import config
+import defect_head
+
+from engine import ImageCaptioningEngine
+from tiny_model import build_tiny_checkpoint
+from bench_engine import percentile, compare
+
+
+@pytest.fixture(scope="module")
+def engine(tmp_path_factory):
+    model_dir = build_tiny_checkpoint(str(tmp_path_factory.mktemp("tiny_model")), image_size=32, hidden_size=32)
+    return ImageCaptioningEngine(model_path=model_dir)
+
+
+def test_predict_batch_matches_single(engine):
+    images = [Image.new("RGB", (64, 48), color) for color in ("red", "blue")]
+    batch = engine.predict_batch(images, max_length=12, num_beams=2)
+    singles = [engine.predict(img, max_length=12, num_beams=2) for img in images]
+    assert batch == singles
+
+
+def test_percentile_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 99) == 99.0
+    assert percentile([], 95) == 0.0
+
+
+def test_compare_flags_regressions():
+    def run(p50):
+        case = {"precision": "fp32", "batch_size": 1, "num_beams": 4, "max_length": 50,
+                "resolution": "224", "latency": {"total": {"p50": p50}}}
+        return {"cases": [case]}
+
+    assert compare(run(0.105), run(0.1), threshold=0.10) == []
+    assert len(compare(run(0.2), run(0.1), threshold=0.10)) == 1
+
+
+def test_fast_generate_matches_hf_generate(engine):
+    images = [Image.new("RGB", (64, 48), color) for color in ("red", "green", "blue")]
+    pixel_values = engine.preprocess(images)
+    assert engine.fast_generator is not None
+    fast = engine.generate(pixel_values, max_length=15, num_beams=4)
+    hf = engine.model.generate(pixel_values, max_length=15, num_beams=4, repetition_penalty=config.REPETITION_PENALTY)
+    assert fast.tolist() == hf.tolist()
+
+
+def test_incremental_detokenizer_handles_beam_rewrites(engine):
+    tok = engine.tokenizer
+    ids = [tok.bos_token_id] + [i for i in range(4, 9)]
+    detok = tok.detokenizer()
+    assert detok.update(ids[:2]) == (tok.decode(ids[:2], skip_special_tokens=True), tok.decode(ids[1:2]), False)
+    text, delta, reset = detok.update(ids[:4])
+    assert text == tok.decode(ids[:4], skip_special_tokens=True) and delta == tok.decode(ids[2:4]) and not reset
+    # Best beam switched to a different continuation after the second token
+    rewritten = ids[:2] + [ids[5], ids[4]]
+    text, delta, reset = detok.update(rewritten)
+    assert reset and text == tok.decode(rewritten, skip_special_tokens=True)
+
+
+def test_tiled_caption_batch_adds_regions_without_changing_caption(engine, monkeypatch):
+    monkeypatch.setattr(config, "TILE_SIZE", 64)
+    monkeypatch.setattr(config, "TILE_MAX_TILES", 6)
+    large, small = Image.new("RGB", (160, 96), "red"), Image.new("RGB", (48, 48), "blue")
+    plain = engine.caption_batch([large, small], max_length=12, num_beams=2)
+    tiled = engine.caption_batch([large, small], max_length=12, num_beams=2, tiled=True)
+    assert [r["caption"] for r in tiled] == [r["caption"] for r in plain]
+    boxes = [box for region in tiled[0]["regions"] for box in region["boxes"]]
+    assert 1 < len(boxes) <= 6 and all(box[2] <= 160 and box[3] <= 96 for box in boxes)
+    assert tiled[1]["regions"] == []
+
+
+@pytest.mark.parametrize("num_beams", [1, 3])
+def test_sequence_scores_match_hf_generate(engine, num_beams):
+    pixel_values = engine.preprocess([Image.new("RGB", (64, 48), color) for color in ("red", "green")])
+    fast_ids, fast_scores = engine.generate(pixel_values, max_length=12, num_beams=num_beams, return_scores=True)
+    fast_generator, engine.fast_generator = engine.fast_generator, None
+    try:
+        hf_ids, hf_scores = engine.generate(pixel_values, max_length=12, num_beams=num_beams, return_scores=True)
+    finally:
+        engine.fast_generator = fast_generator
+    assert fast_ids.tolist() == hf_ids.tolist()
+    assert torch.allclose(fast_scores, hf_scores, atol=1e-4)
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_beam_scores_are_per_token_whatever_the_length_penalty(engine, monkeypatch, fast):
+    if not fast:
+        monkeypatch.setattr(engine, "fast_generator", None)
+    pixel_values = engine.preprocess([Image.new("RGB", (64, 48), color) for color in ("red", "green")])
+    ids, scores = engine.generate(pixel_values, max_length=12, num_beams=3, return_scores=True)
+    monkeypatch.setattr(engine.model.generation_config, "length_penalty", 2.0)
+    penalized_ids, penalized = engine.generate(pixel_values, max_length=12, num_beams=3, return_scores=True)
+    # Where the penalty did not change the winning caption, its confidence must not change either
+    same = (ids == penalized_ids).all(dim=1)
+    assert same.any()
+    assert torch.allclose(scores[same], penalized[same], atol=1e-4)
+
+
+def test_caption_batch_reports_confidence_and_triage(engine):
+    results = engine.caption_batch([Image.new("RGB", (64, 48), "red")], max_length=12, num_beams=2)
+    assert 0 < results[0]["confidence"] <= 1
+    assert results[0]["label"] in defect_head.CATEGORIES and results[0]["severity"] is None
@@ -0,0 +1,67 @@
+import pytest
+import torch
+from transformers import VisionEncoderDecoderModel
+
+from fast_generate import FastCaptionGenerator, bucket_length
+from tiny_model import build_tiny_checkpoint
+
+
+@pytest.fixture(scope="module")
+def model(tmp_path_factory):
+    model_dir = build_tiny_checkpoint(str(tmp_path_factory.mktemp("tiny_model")), image_size=32, hidden_size=32)
+    return VisionEncoderDecoderModel.from_pretrained(model_dir).eval()
+
+
+def pixels(batch_size, seed=0):
+    return torch.randn((batch_size, 3, 32, 32), generator=torch.Generator().manual_seed(seed))
+
+
+@pytest.mark.parametrize("num_beams", [1, 2, 4])
+@pytest.mark.parametrize("batch_size", [1, 3])
+@pytest.mark.parametrize("max_length", [6, 20])
+def test_matches_hf_generate(model, num_beams, batch_size, max_length):
+    pixel_values = pixels(batch_size, seed=batch_size * 7 + num_beams)
+    kwargs = {"max_length": max_length, "num_beams": num_beams, "repetition_penalty": 2.0}
+    with torch.no_grad():
+        expected = model.generate(pixel_values, **kwargs)
+    actual = FastCaptionGenerator(model).generate(pixel_values, **kwargs)
+    assert torch.equal(actual, expected)
+
+
+def test_matches_with_min_length_and_ngram_block(model):
+    pixel_values = pixels(2, seed=5)
+    kwargs = {"max_length": 16, "num_beams": 3, "min_length": 10, "no_repeat_ngram_size": 2}
+    with torch.no_grad():
+        expected = model.generate(pixel_values, **kwargs)
+    assert torch.equal(FastCaptionGenerator(model).generate(pixel_values, **kwargs), expected)
+
+
+def test_bucketed_step_matches_eager(model):
+    pixel_values = pixels(2, seed=3)
+    generator = FastCaptionGenerator(model)
+    eager = generator.generate(pixel_values, max_length=20, num_beams=4)
+    generator._step = generator._step_bucketed
+    assert torch.equal(generator.generate(pixel_values, max_length=20, num_beams=4), eager)
+
+
+def test_unsupported_config_returns_none(model):
+    assert FastCaptionGenerator(model).generate(pixels(1), max_length=8, do_sample=True) is None
+
+
+def test_bucket_length():
+    assert bucket_length(1) == 16
+    assert bucket_length(16) == 16
+    assert bucket_length(50) == 64
+
+
+@pytest.mark.parametrize("num_beams", [1, 3])
+def test_on_step_streams_best_hypothesis(model, num_beams):
+    pixel_values = pixels(2, seed=11)
+    steps = []
+    output = FastCaptionGenerator(model).generate(
+        pixel_values, max_length=12, num_beams=num_beams, on_step=lambda seqs: steps.append(seqs.clone())
+    )
+    assert steps and all(s.shape[0] == 2 for s in steps)
+    assert [s.shape[1] for s in steps] == list(range(2, 2 + len(steps)))
+    if num_beams == 1:
+        assert torch.equal(steps[-1], output[:, :steps[-1].shape[1]])
@@ -0,0 +1,68 @@
+import json
+from datetime import datetime
+
+from fastapi import Depends, FastAPI, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.testclient import TestClient
+from sqlmodel import Session, SQLModel, create_engine, select
+
+import http_cache
+from models import DefectRecord, Project
+
+
+def make_client(tmp_path, defects=60):
+    db = create_engine(f"sqlite:///{tmp_path / 'cache.db'}", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(db)
+    with Session(db) as session:
+        session.add(Project(name="A"))
+        session.commit()
+        session.add_all([
+            DefectRecord(filename=f"{i}.jpg", caption="ผนังร้าว" * 3, label="crack", confidence=0.9,
+                         project_id=1, timestamp=datetime(2024, 1, 1, 12, i % 60))
+            for i in range(defects)
+        ])
+        session.commit()
+
+    def get_session():
+        with Session(db) as session:
+            yield session
+
+    app = FastAPI()
+
+    @app.get("/defects")
+    def defects(request: Request, session: Session = Depends(get_session)):
+        return http_cache.json_rows(request, session, select(DefectRecord.__table__))
+
+    return TestClient(app), db
+
+
+def test_matches_default_serialization_and_revalidates(tmp_path):
+    client, db = make_client(tmp_path)
+    first = client.get("/defects")
+    assert first.status_code == 200
+    with Session(db) as session:
+        expected = jsonable_encoder(session.exec(select(DefectRecord)).all())
+    assert first.json() == json.loads(json.dumps(expected))
+
+    tag = first.headers["etag"]
+    cached = client.get("/defects", headers={"If-None-Match": tag})
+    assert cached.status_code == 304 and cached.content == b""
+
+    with Session(db) as session:
+        defect = session.get(DefectRecord, 1)
+        defect.room = "Kitchen"
+        session.add(defect)
+        session.commit()
+    changed = client.get("/defects", headers={"If-None-Match": tag})
+    assert changed.status_code == 200 and changed.headers["etag"] != tag
+
+
+def test_compresses_large_bodies_only_when_accepted(tmp_path):
+    client, _ = make_client(tmp_path)
+    compressed = client.get("/defects", headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert int(compressed.headers["content-length"]) < len(compressed.content) / 3
+
+    plain = client.get("/defects", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert plain.json() == compressed.json()
@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+import torch
+from PIL import Image
+
+from engine import ImageCaptioningEngine
+from inference_server import InferenceServer, RemoteEngine, tensor_from_wire, tensor_to_wire
+from scheduler import DeadlineExceeded
+from tiny_model import build_tiny_checkpoint
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    return build_tiny_checkpoint(str(tmp_path_factory.mktemp("tiny_model")), image_size=32, hidden_size=32)
+
+
+@pytest.fixture(scope="module")
+def server(model_dir, tmp_path_factory):
+    engine = ImageCaptioningEngine(model_path=model_dir)
+    socket_path = str(tmp_path_factory.mktemp("sock") / "inference.sock")
+    srv = InferenceServer(engine, socket_path, max_batch=4)
+    srv.start()
+    yield srv
+    srv.stop()
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_tensor_wire_roundtrip(dtype):
+    tensor = torch.randn(2, 3, 4, 4).to(dtype)
+    meta, payload = tensor_to_wire(tensor)
+    assert torch.equal(tensor_from_wire(meta, payload), tensor)
+
+
+def test_remote_matches_local(server, model_dir):
+    remote = RemoteEngine(server.socket_path, model_path=model_dir)
+    image = Image.new("RGB", (50, 40), "green")
+    expected = server.engine.predict(image, max_length=10, num_beams=2)
+    assert remote.predict(image, max_length=10, num_beams=2) == expected
+    assert remote.ping()["ok"]
+
+
+def test_concurrent_requests_share_one_model(server, model_dir):
+    remote = RemoteEngine(server.socket_path, model_path=model_dir)
+    images = [Image.new("RGB", (50, 40), (i * 40, 10, 10)) for i in range(6)]
+    expected = [server.engine.predict(img, max_length=10, num_beams=1) for img in images]
+    results = [None] * len(images)
+
+    def call(i):
+        results[i] = remote.predict(images[i], max_length=10, num_beams=1)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(images))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == expected
+
+
+def test_server_applies_the_forwarded_deadline(server, model_dir):
+    remote = RemoteEngine(server.socket_path, model_path=model_dir)
+    image = Image.new("RGB", (50, 40), "blue")
+    assert remote.predict(image, max_length=6, num_beams=1, deadline_ms=60000)
+    with pytest.raises(DeadlineExceeded):
+        remote.predict(image, max_length=6, num_beams=1, deadline_ms=-1)
+
+
+def test_remote_caption_batch_returns_confidence_and_triage(server, model_dir):
+    remote = RemoteEngine(server.socket_path, model_path=model_dir)
+    images = [Image.new("RGB", (50, 40), "green"), Image.new("RGB", (50, 40), "red")]
+    results = remote.caption_batch(images, max_length=10, num_beams=2)
+    expected = server.engine.caption_batch(images, max_length=10, num_beams=2)
+    for result, local in zip(results, expected):
+        assert result["caption"] == local["caption"]
+        assert result["confidence"] == pytest.approx(local["confidence"], abs=1e-3)
+        assert 0 < result["confidence"] <= 1
+        assert (result["label"], result["severity"]) == (local["label"], local["severity"])
+        assert result["embedding"] is None and result["reused_from"] is None
@@ -0,0 +1,131 @@
+import pytest
+from sqlmodel import Session, SQLModel, create_engine, select
+
+import database
+import ingest
+from models import DefectRecord
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    db_engine = create_engine(f"sqlite:///{tmp_path / 'ingest.db'}", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(db_engine)
+    monkeypatch.setattr(database, "engine", db_engine)
+    with Session(db_engine) as session:
+        session.add_all([
+            DefectRecord(filename=f"{i}.jpg", caption="", label="detected_defect", confidence=0.0,
+                         image_path=f"uploads/{i}.jpg", project_id=1, status=ingest.PENDING)
+            for i in range(5)
+        ])
+        session.commit()
+    return db_engine
+
+
+def statuses(db_engine):
+    with Session(db_engine) as session:
+        return [d.status for d in session.exec(select(DefectRecord).order_by(DefectRecord.id)).all()]
+
+
+def make_worker(caption, batch_size=2):
+    def apply(defect, result):
+        defect.caption = result
+
+    return ingest.IngestWorker(
+        load=lambda defect: defect.filename, caption=caption, apply=apply, batch_size=batch_size, max_attempts=2
+    )
+
+
+def test_worker_captions_in_batches_oldest_first(db):
+    batches = []
+
+    def caption(items):
+        batches.append(items)
+        return [f"caption {item}" for item in items]
+
+    worker = make_worker(caption)
+    while worker.run_once():
+        pass
+    assert batches == [["0.jpg", "1.jpg"], ["2.jpg", "3.jpg"], ["4.jpg"]]
+    assert statuses(db) == [ingest.DONE] * 5
+    with Session(db) as session:
+        assert session.get(DefectRecord, 3).caption == "caption 2.jpg"
+    assert ingest.pending_count(db) == 0
+
+
+def test_failed_batches_retry_then_fail(db):
+    def caption(items):
+        raise RuntimeError("engine down")
+
+    worker = make_worker(caption, batch_size=5)
+    worker.run_once()
+    assert statuses(db) == [ingest.PENDING] * 5
+    worker.run_once()
+    assert statuses(db) == [ingest.FAILED] * 5
+
+
+def test_interrupted_claims_are_requeued(db):
+    assert ingest.claim(db, 3, "crashed") == [1, 2, 3]
+    assert ingest.claim(db, 3, "live") == [4, 5]
+    assert ingest.claim(db, 3) == []
+    # A peer starting up leaves leases that are still running alone
+    assert ingest.requeue_expired(db, lease_seconds=600) == 0
+    # Once they run out, nothing claimed before the crash is lost
+    assert ingest.requeue_expired(db, lease_seconds=0) == 5
+    assert ingest.pending_count(db) == 5
+    assert statuses(db) == [ingest.PENDING] * 5
+
+
+def test_claims_and_requeues_reach_the_change_feed(db):
+    import sync
+
+    with Session(db) as session:
+        since = sync.current_version(session)
+    assert ingest.claim(db, 2, "w") == [1, 2]
+    with Session(db) as session:
+        feed = sync.changes_since(session, since)
+        assert [(d.id, d.status) for d in feed["defects"]] == [(1, ingest.CAPTIONING), (2, ingest.CAPTIONING)]
+        since = feed["version"]
+    assert ingest.requeue_expired(db, lease_seconds=0) == 2
+    with Session(db) as session:
+        feed = sync.changes_since(session, since)
+        assert [(d.id, d.status) for d in feed["defects"]] == [(1, ingest.PENDING), (2, ingest.PENDING)]
+        # One version per row, so a paged client cannot skip one
+        assert len({d.version for d in feed["defects"]}) == 2
+        since = feed["version"]
+    # Polling an empty queue leaves the feed (and the /defects ETag) alone
+    ingest.requeue_expired(db, lease_seconds=0)
+    with Session(db) as session:
+        assert sync.current_version(session) == since
+
+
+def test_worker_leaves_records_whose_lease_moved_on(db):
+    def caption(items):
+        # While this worker was slow its lease expired and a peer took the records over
+        ingest.requeue_expired(db, lease_seconds=0)
+        ingest.claim(db, 5, "peer")
+        return [f"late {item}" for item in items]
+
+    make_worker(caption, batch_size=2).run_once()
+    with Session(db) as session:
+        defects = session.exec(select(DefectRecord).order_by(DefectRecord.id)).all()
+        assert [d.claimed_by for d in defects] == ["peer"] * 5
+        assert not any(d.caption for d in defects)
+
+
+def test_pending_uploads_keep_their_own_profile(app_module, monkeypatch):
+    from PIL import Image
+
+    submitted = []
+    submit = app_module.inference_scheduler.submit
+
+    def record(items, **params):
+        submitted.append((len(items), params["num_beams"]))
+        return submit(items, **params)
+
+    monkeypatch.setattr(app_module.inference_scheduler, "submit", record)
+    image = Image.new("RGB", (48, 48), (10, 120, 30))
+    items = [{"image": image, "project_id": 1, "profile": profile} for profile in ("fast-greedy", "quality", "fast-greedy")]
+    results = app_module._caption_pending(items)
+    assert len(results) == 3 and all(result["caption"] is not None for result in results)
+    profiles = app_module.decoding.PROFILES
+    assert sorted(submitted) == sorted([(2, profiles["fast-greedy"]["num_beams"]), (1, profiles["quality"]["num_beams"])])
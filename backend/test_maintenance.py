@@ -0,0 +1,153 @@
+import os
+import time
+from datetime import datetime
+
+import pytest
+from sqlmodel import Session, SQLModel, create_engine, select
+
+import maintenance
+from models import DefectRecord
+
+OLD = time.time() - 7200
+
+
+def touch(path, size=100, mtime=OLD):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+@pytest.fixture
+def db(tmp_path):
+    db_engine = create_engine(f"sqlite:///{tmp_path / 'maintenance.db'}", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(db_engine)
+    with Session(db_engine) as session:
+        session.add_all([
+            DefectRecord(filename=f"{i}.jpg", caption="c", label="unknown", confidence=0.5, image_path=f"uploads/{i}.jpg")
+            for i in range(5)
+        ])
+        session.commit()
+    return db_engine
+
+
+def test_sweep_deletes_only_old_unreferenced_uploads(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(maintenance, "BATCH", 2)
+    outputs = tmp_path / "outputs"
+    live = [touch(str(outputs / "uploads" / f"{i}.jpg")) for i in range(5)]
+    orphans = [touch(str(outputs / "uploads" / f"gone_{i}.jpg"), size=10) for i in range(3)]
+    in_flight = touch(str(outputs / "uploads" / "in_flight.jpg"), mtime=time.time())
+
+    report = maintenance.sweep_orphan_uploads(db, str(outputs), grace_seconds=3600, dry_run=True)
+    assert report["orphan_uploads"] == {"files": 3, "bytes": 30}
+    assert all(os.path.exists(p) for p in orphans)
+
+    maintenance.sweep_orphan_uploads(db, str(outputs), grace_seconds=3600)
+    assert all(os.path.exists(p) for p in live + [in_flight])
+    assert not any(os.path.exists(p) for p in orphans)
+
+
+def test_sweep_lists_kept_files_under_the_lock(db, tmp_path):
+    outputs = tmp_path / "outputs"
+    archived = touch(str(outputs / "uploads" / "archived.jpg"))
+    orphan = touch(str(outputs / "uploads" / "gone.jpg"))
+    held = []
+
+    class Lock:
+        def __enter__(self):
+            held.append(True)
+
+        def __exit__(self, *exc):
+            held.append(False)
+
+    def keep():
+        assert held == [True]
+        return {"uploads/archived.jpg"}
+
+    maintenance.sweep_orphan_uploads(db, str(outputs), grace_seconds=3600, keep=keep, lock=Lock())
+    assert held == [True, False]
+    assert os.path.exists(archived) and not os.path.exists(orphan)
+
+
+def test_expire_reports_by_age_then_size(tmp_path):
+    reports = tmp_path / "reports"
+    day = 86400
+    expired = touch(str(reports / "old.pdf"), mtime=time.time() - 40 * day)
+    older = touch(str(reports / "older.pdf"), mtime=time.time() - 2 * day)
+    newer = touch(str(reports / "newer.pdf"), mtime=time.time() - day)
+
+    report = maintenance.expire_reports(str(reports), retention_days=30, max_bytes=150)
+    assert report["expired_reports"] == {"files": 2, "bytes": 200}
+    assert not os.path.exists(expired) and not os.path.exists(older)
+    assert os.path.exists(newer)
+
+
+def test_run_maintenance_compacts_and_totals(db, tmp_path):
+    with Session(db) as session:
+        session.add_all([DefectRecord(filename="big.jpg", caption="x" * 5000, label="unknown", confidence=0.5)
+                         for _ in range(200)])
+        session.commit()
+        for defect in session.exec(select(DefectRecord).where(DefectRecord.filename == "big.jpg")).all():
+            session.delete(defect)
+        session.commit()
+    outputs = tmp_path / "outputs"
+    temp = touch(str(outputs / "temp_pdf_0.jpg"), size=50)
+    touch(str(outputs / "uploads" / "gone.jpg"), size=10)
+
+    args = (db, str(outputs), str(tmp_path / "reports"), [str(outputs)], 3600, 30)
+    assert "database" not in maintenance.run_maintenance(*args, dry_run=True)
+    dry = maintenance.run_maintenance(*args, vacuum=True, dry_run=True)
+    assert dry["database"]["bytes"] > 0 and os.path.exists(temp)
+
+    report = maintenance.run_maintenance(*args, vacuum=True)
+    assert report["temp_files"] == {"files": 1, "bytes": 50}
+    assert report["database"]["after"] < report["database"]["before"]
+    assert report["reclaimed_bytes"] == 60 + report["database"]["bytes"]
+    with Session(db) as session:
+        assert len(session.exec(select(DefectRecord)).all()) == 5
+
+
+def test_scheduler_runs_in_quiet_hours_when_idle():
+    now = [datetime(2024, 6, 1, 1, 0)]
+    idle = [True]
+    runs = []
+    scheduler = maintenance.MaintenanceScheduler(
+        lambda **kwargs: runs.append(kwargs) or {"reclaimed_bytes": 0}, quiet_hours=(23, 4), interval_hours=24,
+        is_idle=lambda: idle[0], clock=lambda: now[0],
+    )
+    idle[0] = False
+    assert not scheduler.due()
+    idle[0] = True
+    assert scheduler.due()
+    scheduler.run_now()
+    assert not scheduler.due()
+    now[0] = datetime(2024, 6, 2, 12, 0)  # a day later, but outside the window
+    assert not scheduler.due()
+    now[0] = datetime(2024, 6, 2, 23, 30)
+    assert scheduler.due()
+    assert maintenance.in_quiet_hours(3, (2, 5)) and not maintenance.in_quiet_hours(5, (2, 5))
+
+
+def test_schedulers_in_several_workers_share_one_run(tmp_path):
+    now = datetime(2024, 6, 1, 3, 0)
+    runs = []
+
+    def make():
+        return maintenance.MaintenanceScheduler(
+            lambda **kwargs: runs.append(kwargs) or {"reclaimed_bytes": len(runs)}, quiet_hours=(2, 5),
+            clock=lambda: now, state_file=str(tmp_path / "maintenance.json"),
+        )
+
+    first, second = make(), make()
+    assert first.due() and second.due()
+    holder = open(tmp_path / "maintenance.json.lock", "a")
+    maintenance.fcntl.flock(holder, maintenance.fcntl.LOCK_EX)
+    with pytest.raises(maintenance.MaintenanceBusy):
+        second.run_now()
+    holder.close()
+
+    first.run_now()
+    # The other worker sees the run and its report
+    assert not second.due()
+    assert second.last_report == {"reclaimed_bytes": 1} and len(runs) == 1
@@ -0,0 +1,46 @@
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_histogram_buckets_are_cumulative():
+    hist = Histogram("stage_seconds", "test", buckets=(0.1, 1.0))
+    hist.observe(0.05, stage="generate")
+    hist.observe(0.5, stage="generate")
+    hist.observe(5.0, stage="generate")
+
+    text = hist.render()
+    assert 'stage_seconds_bucket{le="0.1",stage="generate"} 1' in text
+    assert 'stage_seconds_bucket{le="1.0",stage="generate"} 2' in text
+    assert 'stage_seconds_bucket{le="+Inf",stage="generate"} 3' in text
+    assert 'stage_seconds_count{stage="generate"} 3' in text
+
+
+def test_histogram_time_context_records_once():
+    hist = Histogram("t_seconds", "test")
+    with hist.time(stage="db_commit"):
+        pass
+    assert hist.count(stage="db_commit") == 1
+
+
+def test_registry_renders_counters_and_gauges():
+    registry = Registry()
+    counter = registry.register(Counter("requests_total", "test"))
+    gauge = registry.register(Gauge("queue_depth", "test"))
+    counter.inc(endpoint="/predict")
+    counter.inc(endpoint="/predict")
+    gauge.set(3)
+
+    text = registry.render()
+    assert "# TYPE requests_total counter" in text
+    assert 'requests_total{endpoint="/predict"} 2.0' in text
+    assert "queue_depth 3.0" in text
+
+
+def test_callback_gauge_computed_at_scrape():
+    gauge = Gauge("hit_ratio", "test", callback=lambda: {(("cache", "card"),): 0.5})
+    assert 'hit_ratio{cache="card"} 0.5' in gauge.render()
+
+
+def test_label_values_are_escaped():
+    counter = Counter("errors_total", "test")
+    counter.inc(reason='bad "quote"\\path\nnext')
+    assert 'errors_total{reason="bad \\"quote\\"\\\\path\\nnext"} 1.0' in counter.render()
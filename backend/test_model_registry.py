@@ -0,0 +1,98 @@
+import threading
+from collections import Counter
+
+import pytest
+
+import model_registry
+from model_registry import ModelRegistry
+
+
+class FakeEngine:
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+
+
+@pytest.fixture
+def registry(tmp_path):
+    for version in ("a", "b", "c"):
+        (tmp_path / version).mkdir()
+        (tmp_path / version / "config.json").write_text("{}")
+        (tmp_path / version / "model.safetensors").write_bytes(b"\0" * 100)
+    return ModelRegistry(str(tmp_path), max_resident=2, loader=FakeEngine)
+
+
+def resident(registry):
+    return [entry["version"] for entry in registry.status()["resident"]]
+
+
+def test_discovers_checkpoints_and_loads_in_background(registry):
+    assert registry.versions() == ["a", "b", "c"]
+    engine = registry.load("b").result()
+    assert engine.version == "b" and registry.get("b") is engine
+    with pytest.raises(KeyError):
+        registry.load("missing")
+
+
+def test_evicts_least_recently_used_idle_model(registry):
+    registry.set_traffic({"a": 100})
+    registry.get("b")
+    registry.get("c")
+    # "a" carries traffic so it stays; "b" was the idle LRU entry
+    assert resident(registry) == ["a", "c"]
+
+    registry.set_traffic({"c": 100})
+    registry.get("b")
+    assert resident(registry) == ["c", "b"]
+
+
+def test_memory_budget_limits_resident_models(registry, monkeypatch):
+    monkeypatch.setattr(model_registry.metrics, "model_memory_bytes", lambda model: 100)
+    registry.max_resident = 3
+    registry.memory_budget = 250
+    registry.loader = lambda path, version: type("Engine", (), {"model": object()})()
+    registry.set_traffic({"a": 1})
+    registry.get("b")
+    registry.get("c")
+    assert resident(registry) == ["a", "c"]
+
+
+def test_traffic_split_and_atomic_switch(registry):
+    registry.set_traffic({"a": 75, "b": 25})
+    counts = Counter(registry.choose() for _ in range(4000))
+    assert set(counts) == {"a", "b"}
+    assert 0.7 < counts["a"] / 4000 < 0.8
+
+    # Readers racing a switch only ever see a complete table
+    stop = threading.Event()
+    seen = set()
+
+    def read():
+        while not stop.is_set():
+            seen.add(registry.choose())
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    registry.set_traffic({"c": 100})
+    stop.set()
+    reader.join()
+    assert seen <= {"a", "b", "c"}
+    assert {registry.choose() for _ in range(100)} == {"c"}
+
+    with pytest.raises(ValueError):
+        registry.set_traffic({"a": 0})
+
+
+def test_saved_traffic_reaches_other_workers(tmp_path, registry):
+    traffic_file = str(tmp_path / "traffic.json")
+    registry.traffic_file = traffic_file
+    peer = ModelRegistry(registry.models_dir, max_resident=2, loader=FakeEngine, traffic_file=traffic_file)
+    peer.set_traffic({"a": 100}, persist=False)
+
+    registry.set_traffic({"a": 50, "b": 50})
+    assert peer.reload_traffic()
+    assert peer.status()["traffic"] == {"a": 50.0, "b": 50.0} and sorted(resident(peer)) == ["a", "b"]
+    # Unchanged file, nothing to do; a restarted worker starts from the saved split
+    assert not peer.reload_traffic()
+    restarted = ModelRegistry(registry.models_dir, loader=FakeEngine, traffic_file=traffic_file)
+    assert restarted.reload_traffic() and restarted.status()["traffic"] == {"a": 50.0, "b": 50.0}
@@ -0,0 +1,91 @@
+import pytest
+
+import config
+import profiling
+
+
+def test_profiling_off_by_default(monkeypatch):
+    monkeypatch.setattr(config, "PROFILE_REQUESTS", False)
+    monkeypatch.setattr(config, "PROFILE_ADMIN_TOKEN", "secret")
+    assert not profiling.should_profile("/predict", {})
+    assert not profiling.should_profile("/predict", {"x-profile": "1", "x-admin-token": "wrong"})
+
+
+def test_profile_header_requires_admin_token(monkeypatch):
+    monkeypatch.setattr(config, "PROFILE_REQUESTS", False)
+    monkeypatch.setattr(config, "PROFILE_ADMIN_TOKEN", "secret")
+    headers = {"x-profile": "1", "x-admin-token": "secret"}
+    assert profiling.should_profile("/predict", headers)
+    assert profiling.should_profile("/generate-report-db", headers)
+    assert not profiling.should_profile("/defects", headers)
+
+
+def test_capture_writes_artifacts(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "PROFILES_DIR", str(tmp_path))
+    with profiling.capture("req123"):
+        sum(range(1000))
+    artifacts = profiling.list_artifacts("req123")
+    assert "cprofile.prof" in artifacts
+    assert "cprofile.txt" in artifacts
+
+
+def test_request_id_validation():
+    assert profiling.is_valid_request_id("abc-123_DEF")
+    assert not profiling.is_valid_request_id("../etc/passwd")
+    assert not profiling.is_valid_request_id("")
+
+
+def test_only_one_capture_at_a_time(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "PROFILES_DIR", str(tmp_path))
+    with profiling.capture("first"):
+        with pytest.raises(profiling.ProfilerBusy):
+            with profiling.capture("second"):
+                pass
+    # Free again once the first one is written
+    with profiling.capture("third"):
+        pass
+    assert profiling.list_artifacts("third") and not profiling.list_artifacts("second")
+
+
+def test_profile_id_is_chosen_by_the_server(app_module, monkeypatch, tmp_path):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(config, "PROFILES_DIR", str(tmp_path))
+    monkeypatch.setattr(config, "PROFILE_ADMIN_TOKEN", "secret")
+    client = TestClient(app_module.app)
+    headers = {"X-Profile": "1", "X-Admin-Token": "secret", "X-Request-ID": "victim-profile"}
+    response = client.post("/generate-report-db", headers=headers, json=[])
+    profile_id = response.headers["X-Profile-Id"]
+    assert profile_id != "victim-profile" and response.headers["X-Request-ID"] == "victim-profile"
+    assert profiling.list_artifacts(profile_id) and not profiling.list_artifacts("victim-profile")
+
+
+def test_predict_profile_covers_generate_on_the_worker(app_module, monkeypatch, tmp_path):
+    import io
+
+    from fastapi.testclient import TestClient
+    from PIL import Image
+    from sqlmodel import Session
+
+    import database
+    from models import Project
+
+    monkeypatch.setattr(config, "PROFILES_DIR", str(tmp_path))
+    monkeypatch.setattr(config, "PROFILE_ADMIN_TOKEN", "secret")
+    with Session(database.engine) as session:
+        project = Project(name="Profiled")
+        session.add(project)
+        session.commit()
+        project_id = project.id
+    image = io.BytesIO()
+    Image.new("RGB", (40, 40), "gray").save(image, format="JPEG")
+    client = TestClient(app_module.app)
+    response = client.post(
+        "/predict", data={"project_id": project_id}, files={"file": ("p.jpg", image.getvalue(), "image/jpeg")},
+        headers={"X-Profile": "1", "X-Admin-Token": "secret"},
+    )
+    assert response.status_code == 200
+    artifacts = profiling.list_artifacts(response.headers["X-Profile-Id"])
+    assert "cprofile.txt" in artifacts
+    with open(tmp_path / response.headers["X-Profile-Id"] / "cprofile.txt", encoding="utf-8") as f:
+        assert "(generate)" in f.read()
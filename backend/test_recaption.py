@@ -0,0 +1,184 @@
+import json
+import time
+from datetime import datetime
+
+import pytest
+from sqlmodel import Session, SQLModel, create_engine, select
+
+import recaption
+from models import DefectRecord
+
+
+@pytest.fixture
+def db(tmp_path):
+    db_engine = create_engine(f"sqlite:///{tmp_path / 'recaption.db'}", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(db_engine)
+    with Session(db_engine) as session:
+        session.add_all([
+            DefectRecord(filename=f"{i}.jpg", caption=f"old {i}", label="unknown", confidence=0.5,
+                         image_path=f"uploads/{i}.jpg", project_id=1 if i < 8 else 2,
+                         model_version="new" if i == 6 else "base", user_edited=i == 3,
+                         timestamp=datetime(2024, 1, 1 + i))
+            for i in range(10)
+        ])
+        session.commit()
+    return db_engine
+
+
+def apply(defect, result):
+    defect.caption = result["caption"]
+    defect.model_version = result["model_version"]
+
+
+def make_job(db, tmp_path, calls=None, fail_after=None, **kwargs):
+    calls = [] if calls is None else calls
+
+    def caption(items, model_version):
+        if fail_after is not None and len(calls) >= fail_after:
+            raise RuntimeError("engine went away")
+        calls.append(items)
+        # Photo 4 comes out the same under the new model
+        return [{"caption": "old 4" if item == "4.jpg" else f"new {item}", "model_version": model_version} for item in items]
+
+    return recaption.RecaptionJob(
+        db, load=lambda defect: defect.filename, caption=caption, apply=apply, target_version="new",
+        batch_size=2, checkpoint_path=str(tmp_path / "checkpoint.json"), **kwargs
+    )
+
+
+def captions(db):
+    with Session(db) as session:
+        return {d.id: (d.caption, d.model_version) for d in session.exec(select(DefectRecord)).all()}
+
+
+def test_updates_matching_records_and_skips_edited(db, tmp_path):
+    calls = []
+    status = make_job(db, tmp_path, calls, filters={"project_id": 1, "until": "2024-01-06"}).run()
+    assert status["state"] == "done"
+    # Ids 1-5 are photos 0-4; photo 3 was edited by hand
+    assert calls == [["0.jpg", "1.jpg"], ["2.jpg", "4.jpg"]]
+    after = captions(db)
+    assert after[1] == ("new 0.jpg", "new") and after[4] == ("old 3", "base")
+    assert after[5] == ("old 4", "new") and after[6] == ("old 5", "base")
+    assert status["updated"] == 3 and status["unchanged"] == 1 and status["total"] == 4
+    # A finished job leaves no checkpoint behind
+    assert not (tmp_path / "checkpoint.json").exists()
+
+
+def test_interrupted_job_resumes_after_last_batch(db, tmp_path):
+    first = make_job(db, tmp_path, fail_after=2).run()
+    assert first["state"] == "failed" and first["last_id"] == 5
+    saved = json.loads((tmp_path / "checkpoint.json").read_text())
+    assert saved["last_id"] == 5
+
+    calls = []
+    second = make_job(db, tmp_path, calls).run()
+    assert second["state"] == "done"
+    # Photo 6 is already on the target version; photos 0-4 were done by the first run
+    assert calls == [["5.jpg", "7.jpg"], ["8.jpg", "9.jpg"]]
+    assert second["updated"] == 7 and second["unchanged"] == 1
+
+
+def test_dry_run_reports_diff_without_writing(db, tmp_path):
+    before = captions(db)
+    job = make_job(db, tmp_path, dry_run=True, filters={"model_versions": ["base"], "project_id": 2})
+    status = job.run()
+    assert captions(db) == before
+    assert [(d["id"], d["old"], d["new"]) for d in status["diff_preview"]] == [
+        (9, "old 8", "new 8.jpg"), (10, "old 9", "new 9.jpg")
+    ]
+    assert "".join(job.diff_lines()).splitlines()[:3] == ["@@ defect 9 (project 2) base -> new", "- old 8", "+ new 8.jpg"]
+    assert not (tmp_path / "checkpoint.json").exists()
+
+
+def test_one_job_across_workers_through_the_state_file(db, tmp_path):
+    import threading
+
+    state_file = str(tmp_path / "recaption.json")
+    gate = threading.Event()
+    first = make_job(db, tmp_path, state_file=state_file, dry_run=True)
+    caption = first.caption
+
+    def slow_caption(items, model_version):
+        gate.wait(5)
+        return caption(items, model_version)
+
+    first.caption = slow_caption
+    first.start()
+    # Another worker can neither start a second job nor miss that this one is running
+    with pytest.raises(recaption.RecaptionBusy):
+        make_job(db, tmp_path, state_file=state_file).start()
+    deadline = time.monotonic() + 5
+    while (recaption.load_state(state_file) or {}).get("state") != "running" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert recaption.load_state(state_file)["state"] == "running"
+
+    # ...and can stop it after the current batch
+    recaption.request_stop(state_file)
+    gate.set()
+    first._thread.join(5)
+    status = recaption.load_state(state_file)
+    assert status["state"] == "stopped" and status["done"] == 2
+    assert "".join(recaption.saved_diff_lines(state_file)) == "".join(first.diff_lines())
+    # The lock went with the job
+    second = make_job(db, tmp_path, state_file=state_file, dry_run=True).start()
+    second._thread.join(5)
+    assert recaption.load_state(state_file)["state"] == "done"
+
+
+def test_job_whose_worker_died_is_reported_interrupted(tmp_path):
+    state_file = tmp_path / "recaption.json"
+    state_file.write_text(json.dumps({"state": "running", "dry_run": False}))
+    assert recaption.load_state(str(state_file))["state"] == "interrupted"
+    assert recaption.load_state(str(tmp_path / "missing.json")) is None
+
+
+def test_user_edit_during_run_wins(db, tmp_path):
+    job = make_job(db, tmp_path)
+    defects = job._page(0)
+    with Session(db) as session:
+        edited = session.get(DefectRecord, defects[0].id)
+        edited.caption = "fixed by inspector"
+        session.add(edited)
+        session.commit()
+    job._write(defects, [{"caption": "new", "model_version": "new"}] * 2)
+    assert captions(db)[defects[0].id] == ("fixed by inspector", "base")
+    assert job.counts["skipped_edited"] == 1 and job.counts["updated"] == 1
+
+
+def test_rate_limiter_paces_batches():
+    now = [0.0]
+    limiter = recaption.RateLimiter(4, clock=lambda: now[0], sleep=lambda s: now.__setitem__(0, now[0] + s))
+    for _ in range(5):
+        limiter.acquire(4)
+    # A full bucket of 4, then 4 images per second
+    assert now[0] == pytest.approx(4.0)
+
+
+def test_recaption_decodes_fresh_instead_of_reusing_own_caption(app_module, monkeypatch):
+    from PIL import Image
+
+    import database
+
+    monkeypatch.setattr(app_module.config, "NEAR_DUPLICATE_THRESHOLD", 0.97)
+    version = app_module.config.MODEL_VERSION
+    item = {"image": Image.new("RGB", (48, 48), (200, 30, 30)), "project_id": 1}
+    first = app_module._caption_recaption([item], version)[0]
+    with Session(database.engine) as session:
+        defect = DefectRecord(filename="a.jpg", caption="คำบรรยายเดิม", label="unknown", confidence=0.5, project_id=1)
+        session.add(defect)
+        session.commit()
+        session.refresh(defect)
+    app_module.embedding_stores.add(version, defect.id, 1, first["embedding"])
+
+    # An upload of the same photo reuses the stored caption...
+    reused = app_module.inference_scheduler.submit([item], priority="bulk", model_version=version).result()[0]
+    assert reused["reused_from"] == defect.id and reused["caption"] == "คำบรรยายเดิม"
+    # ...but re-captioning that photo runs the decoder
+    fresh = app_module._caption_recaption([item], version)[0]
+    assert fresh["reused_from"] is None
+    assert fresh["caption"] == first["caption"] != "คำบรรยายเดิม"
+    # The record then carries the profile it was re-captioned with
+    defect.decoding_profile = "fast-greedy"
+    app_module.apply_caption(defect, fresh)
+    assert defect.decoding_profile == app_module.config.RECAPTION_PROFILE
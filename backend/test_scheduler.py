@@ -0,0 +1,190 @@
+import time
+import threading
+
+import pytest
+
+from scheduler import InferenceScheduler, DeadlineExceeded
+
+
+class Recorder:
+    """run_batch stand-in that records calls and can be held on a gate."""
+
+    def __init__(self):
+        self.calls = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self, items, priority, **params):
+        self.gate.wait()
+        self.calls.append((priority, list(items)))
+        return [f"caption-{item}" for item in items]
+
+
+@pytest.fixture
+def recorder():
+    return Recorder()
+
+
+@pytest.fixture
+def sched(recorder):
+    s = InferenceScheduler(recorder, max_batch=4, bulk_max_batch=2).start()
+    yield s
+    recorder.gate.set()
+    s.stop()
+
+
+def hold_worker(sched, recorder):
+    """Occupy the worker with one job so the next submissions queue up."""
+    recorder.gate.clear()
+    blocker = sched.submit(["blocker"], priority="bulk")
+    while not blocker.running():
+        time.sleep(0.005)
+    return blocker
+
+
+def test_interactive_runs_before_queued_bulk(sched, recorder):
+    hold_worker(sched, recorder)
+    bulk = [sched.submit([f"b{i}"], priority="bulk") for i in range(4)]
+    interactive = sched.submit(["i0"], priority="interactive")
+    recorder.gate.set()
+
+    assert interactive.result(timeout=5) == ["caption-i0"]
+    for f in bulk:
+        f.result(timeout=5)
+    order = [priority for priority, _ in recorder.calls]
+    assert order[:2] == ["bulk", "interactive"]
+    # Bulk batches are capped at bulk_max_batch rows
+    assert all(len(items) <= 2 for priority, items in recorder.calls if priority == "bulk")
+
+
+def test_compatible_jobs_share_a_batch(sched, recorder):
+    hold_worker(sched, recorder)
+    futures = [sched.submit([f"i{i}"], max_length=10) for i in range(3)]
+    other = sched.submit(["x"], max_length=20)
+    recorder.gate.set()
+
+    assert [f.result(timeout=5) for f in futures] == [["caption-i0"], ["caption-i1"], ["caption-i2"]]
+    assert other.result(timeout=5) == ["caption-x"]
+    assert ("interactive", ["i0", "i1", "i2"]) in recorder.calls
+
+
+def test_wrapped_job_runs_alone_inside_its_wrapper(sched, recorder):
+    from contextlib import contextmanager
+
+    seen = []
+
+    @contextmanager
+    def wrap():
+        seen.append((threading.current_thread(), len(recorder.calls)))
+        yield
+
+    hold_worker(sched, recorder)
+    before = sched.submit(["i0"])
+    profiled = sched.submit(["p0"], wrap=wrap)
+    after = sched.submit(["i1"])
+    recorder.gate.set()
+
+    for f in (before, profiled, after):
+        f.result(timeout=5)
+    assert ("interactive", ["p0"]) in recorder.calls
+    assert ("interactive", ["i0", "i1"]) in recorder.calls
+    # Entered once, on the worker thread, around the profiled batch only
+    [(thread, calls_before)] = seen
+    assert thread is sched._worker and recorder.calls[calls_before] == ("interactive", ["p0"])
+
+
+def test_expired_and_cancelled_jobs_are_dropped(sched, recorder):
+    hold_worker(sched, recorder)
+    expired = sched.submit(["late"], deadline=time.monotonic() + 0.01)
+    cancelled = sched.submit(["gone"])
+    cancelled.cancel()
+    kept = sched.submit(["kept"])
+    time.sleep(0.05)
+    recorder.gate.set()
+
+    assert kept.result(timeout=5) == ["caption-kept"]
+    with pytest.raises(DeadlineExceeded):
+        expired.result(timeout=5)
+    ran = [item for _, items in recorder.calls for item in items]
+    assert "late" not in ran and "gone" not in ran
+
+
+def test_cancelled_jobs_leave_the_queue_depth(sched, recorder):
+    import metrics
+
+    hold_worker(sched, recorder)
+    queued = [sched.submit([f"q{i}"]) for i in range(3)]
+    assert metrics.QUEUE_DEPTH.get() == 4
+    queued[0].cancel()
+    queued[1].cancel()
+    # Still in the heap, but no longer counted as load
+    assert metrics.QUEUE_DEPTH.get() == 2
+    assert sched.pending()["interactive"] == 1
+    recorder.gate.set()
+    assert queued[2].result(timeout=5) == ["caption-q2"]
+
+
+def test_abandoned_expired_job_is_counted_once_as_deadline(sched, recorder):
+    import metrics
+
+    before = {reason: metrics.SCHEDULER_DROPPED_TOTAL.get(priority="interactive", reason=reason)
+              for reason in ("deadline", "cancelled")}
+    hold_worker(sched, recorder)
+    # The HTTP handler gives up at the deadline and leaves the job for the scheduler to drop
+    abandoned = sched.submit(["late"], deadline=time.monotonic() + 0.01)
+    time.sleep(0.05)
+    recorder.gate.set()
+    with pytest.raises(DeadlineExceeded):
+        abandoned.result(timeout=5)
+    after = {reason: metrics.SCHEDULER_DROPPED_TOTAL.get(priority="interactive", reason=reason)
+             for reason in ("deadline", "cancelled")}
+    assert after == {"deadline": before["deadline"] + 1, "cancelled": before["cancelled"]}
+
+
+def test_forwarded_deadline_is_the_latest_in_the_batch():
+    seen = []
+    gate = threading.Event()
+
+    def run_batch(items, priority, deadline=None, **params):
+        gate.wait()
+        seen.append((list(items), deadline))
+        return items
+
+    sched = InferenceScheduler(run_batch, max_batch=4, forward_deadline=True).start()
+    try:
+        hold = sched.submit(["hold"])
+        while not hold.running():
+            time.sleep(0.005)
+        soon, later = time.monotonic() + 30, time.monotonic() + 60
+        first = sched.submit(["a"], deadline=soon)
+        second = sched.submit(["b"], deadline=later)
+        gate.set()
+        hold.result(timeout=5), first.result(timeout=5), second.result(timeout=5)
+        assert seen == [(["hold"], None), (["a", "b"], later)]
+    finally:
+        sched.stop()
+
+
+def test_unknown_priority_rejected(sched):
+    with pytest.raises(ValueError):
+        sched.submit(["x"], priority="urgent")
+
+
+def test_partial_tokens_are_routed_to_their_job():
+    def run_batch(items, priority, on_tokens=None, **params):
+        for step in range(1, 3):
+            for i, item in enumerate(items):
+                on_tokens(i, [item] * step)
+        return items
+
+    sched = InferenceScheduler(run_batch, max_batch=4)
+    seen = {"a": [], "b": []}
+    hold = threading.Event()
+    blocker = sched.submit(["x"], on_tokens=lambda i, ids: hold.wait())
+    sched.start()
+    a = sched.submit(["a"], on_tokens=lambda i, ids: seen["a"].append(ids))
+    b = sched.submit(["b"], on_tokens=lambda i, ids: seen["b"].append(ids))
+    hold.set()
+    assert a.result(timeout=5) == ["a"] and b.result(timeout=5) == ["b"] and blocker.result(timeout=5) == ["x"]
+    sched.stop()
+    assert seen == {"a": [["a"], ["a", "a"]], "b": [["b"], ["b", "b"]]}
@@ -0,0 +1,74 @@
+from sqlalchemy import text
+from sqlmodel import Session, SQLModel, create_engine
+
+import sync
+from models import DefectRecord, Project
+
+
+def make_defect(project_id, caption="รอยร้าว"):
+    return DefectRecord(filename="a.jpg", caption=caption, label="crack", confidence=0.9, project_id=project_id)
+
+
+def test_feed_returns_only_changes_since_cursor(tmp_path):
+    db = create_engine(f"sqlite:///{tmp_path / 'sync.db'}")
+    SQLModel.metadata.create_all(db)
+
+    with Session(db) as session:
+        site_a, site_b = Project(name="A"), Project(name="B")
+        session.add_all([site_a, site_b])
+        session.commit()
+        session.add_all([make_defect(site_a.id), make_defect(site_a.id), make_defect(site_b.id)])
+        session.commit()
+
+        full = sync.changes_since(session, since=0)
+        assert len(full["projects"]) == 2 and len(full["defects"]) == 3
+        cursor = full["version"]
+        assert sync.changes_since(session, since=cursor)["defects"] == []
+
+        first, second = session.get(DefectRecord, 1), session.get(DefectRecord, 2)
+        first.room = "Kitchen"
+        session.add(first)
+        session.delete(second)
+        session.commit()
+
+        delta = sync.changes_since(session, since=cursor)
+        assert [d.id for d in delta["defects"]] == [1]
+        assert delta["deleted"] == {"projects": [], "defects": [2]}
+        assert delta["version"] > cursor
+
+        # Other projects' changes are filtered out, project rows are not
+        session.add(make_defect(site_b.id))
+        session.commit()
+        scoped = sync.changes_since(session, since=delta["version"], project_id=site_a.id)
+        assert scoped["defects"] == [] and scoped["version"] > delta["version"]
+
+
+def test_feed_pages_with_limit(tmp_path):
+    db = create_engine(f"sqlite:///{tmp_path / 'sync.db'}")
+    SQLModel.metadata.create_all(db)
+    with Session(db) as session:
+        session.add(Project(name="A"))
+        session.commit()
+        session.add_all([make_defect(1, caption=str(i)) for i in range(5)])
+        session.commit()
+
+        seen, since, pages = [], 0, 0
+        while True:
+            page = sync.changes_since(session, since=since, limit=2)
+            seen += [d.caption for d in page["defects"]]
+            since, pages = page["version"], pages + 1
+            if not page["has_more"]:
+                break
+        assert sorted(seen) == ["0", "1", "2", "3", "4"]
+        assert pages == 3
+
+
+def test_backfill_versions_legacy_rows(tmp_path):
+    db = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    SQLModel.metadata.create_all(db)
+    with db.begin() as connection:
+        connection.execute(text("INSERT INTO project (name, created_at) VALUES ('Old', '2024-01-01')"))
+    sync.backfill_versions(db)
+    with Session(db) as session:
+        assert session.get(Project, 1).version == 1
+        assert sync.current_version(session) == 1
@@ -0,0 +1,34 @@
+import tiling
+
+
+def test_tiles_cover_large_photo_with_overlap():
+    boxes = tiling.tile_boxes(4000, 3000, tile_size=1024, overlap=0.25, max_tiles=12)
+    assert 1 < len(boxes) <= 12
+    assert min(b[0] for b in boxes) == 0 and max(b[2] for b in boxes) == 4000
+    assert min(b[1] for b in boxes) == 0 and max(b[3] for b in boxes) == 3000
+    tile = boxes[0][2] - boxes[0][0]
+    assert all(b[2] - b[0] == tile and b[3] - b[1] == tile for b in boxes)
+    # Horizontal neighbours share at least a quarter of a tile
+    row = sorted(b for b in boxes if b[1] == 0)
+    assert all(a[2] - b[0] >= tile // 4 for a, b in zip(row, row[1:]))
+
+
+def test_small_photo_is_not_tiled():
+    assert tiling.tile_boxes(800, 600, tile_size=1024) == [(0, 0, 800, 600)]
+    # Only one axis long enough: a strip of tiles the full height
+    strip = tiling.tile_boxes(3000, 900, tile_size=1024)
+    assert len(strip) > 1 and all(b[1] == 0 and b[3] == 900 for b in strip)
+
+
+def test_merge_regions_collapses_similar_captions():
+    regions = [
+        ("ผนังมีรอยร้าว", (0, 0, 10, 10)),
+        ("", (10, 0, 20, 10)),
+        ("ผนังมีรอยร้าวเล็ก", (20, 0, 30, 10)),
+        ("ท่อน้ำรั่วซึม", (0, 10, 10, 20)),
+        ("ผนังมีรอยร้าว ", (10, 10, 20, 20)),
+    ]
+    assert tiling.merge_regions(regions, similarity=0.8) == [
+        {"caption": "ผนังมีรอยร้าว", "boxes": [[0, 0, 10, 10], [20, 0, 30, 10], [10, 10, 20, 20]]},
+        {"caption": "ท่อน้ำรั่วซึม", "boxes": [[0, 10, 10, 20]]},
+    ]
@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+from sqlmodel import Session, SQLModel, create_engine
+
+import training_data
+from models import DefectRecord
+from tiny_model import build_tiny_checkpoint
+from tokenizer import ThaiTokenizerV2
+
+
+@pytest.fixture(scope="module")
+def checkpoint(tmp_path_factory):
+    return build_tiny_checkpoint(str(tmp_path_factory.mktemp("tiny")), image_size=32)
+
+
+@pytest.fixture
+def setup(tmp_path, checkpoint):
+    outputs = tmp_path / "outputs"
+    os.makedirs(outputs / "uploads")
+    db = create_engine(f"sqlite:///{tmp_path / 'train.db'}", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(db)
+    with Session(db) as session:
+        for i in range(6):
+            Image.new("RGB", (120, 80), (40 * i, 90, 200)).save(outputs / "uploads" / f"{i}.jpg")
+            session.add(DefectRecord(
+                filename=f"{i}.jpg", caption="รอยร้าว ที่ ผนัง" if i % 2 else "คราบ น้ำ ซึม บน เพดาน",
+                label="crack", confidence=0.9, image_path=f"uploads/{i}.jpg", user_edited=i != 5,
+            ))
+        # Edited, but its photo is gone
+        session.add(DefectRecord(filename="x.jpg", caption="สนิม", label="crack", confidence=0.9,
+                                 image_path="uploads/missing.jpg", user_edited=True))
+        session.commit()
+
+    def run(**kwargs):
+        return training_data.build(
+            db, str(tmp_path / "data"), os.path.join(checkpoint, "vocab_v2.json"),
+            training_data.image_spec(checkpoint), str(outputs), max_length=16, workers=1, **kwargs
+        )
+    return db, run, tmp_path / "data"
+
+
+def test_build_matches_tokenizer_and_processor_size(setup, checkpoint):
+    db, run, directory = setup
+    counts = run()
+    assert counts == {"added": 5, "replaced": 0, "removed": 0, "skipped": 1, "live": 5}
+
+    dataset = training_data.TrainingDataset(str(directory))
+    assert sorted(dataset.defect_ids.tolist()) == [1, 2, 3, 4, 5]
+    item = dataset[0]
+    tokenizer = ThaiTokenizerV2(vocab_file=os.path.join(checkpoint, "vocab_v2.json"))
+    with Session(db) as session:
+        caption = session.get(DefectRecord, item["defect_id"]).caption
+    assert item["input_ids"].dtype == np.int32
+    assert item["input_ids"].tolist() == tokenizer(caption, max_length=16).input_ids[0]
+    assert item["pixel_values"].dtype == np.uint8 and item["pixel_values"].shape == (3, 32, 32)
+    assert isinstance(item["pixel_values"].base, np.memmap) or isinstance(item["pixel_values"], np.memmap)
+
+    # Nothing changed, nothing to do
+    assert run() == {"added": 0, "replaced": 0, "removed": 0, "skipped": 0, "live": 5}
+
+
+def test_incremental_build_appends_edits_and_drops_deletes(setup):
+    db, run, directory = setup
+    run()
+    with Session(db) as session:
+        edited = session.get(DefectRecord, 2)
+        edited.caption = "กระเบื้อง แตก"
+        session.add(edited)
+        session.delete(session.get(DefectRecord, 3))
+        unedited = session.get(DefectRecord, 6)
+        unedited.user_edited = True
+        session.add(unedited)
+        session.commit()
+
+    assert run() == {"added": 1, "replaced": 1, "removed": 1, "skipped": 0, "live": 5}
+    dataset = training_data.TrainingDataset(str(directory))
+    assert sorted(dataset.defect_ids.tolist()) == [1, 2, 4, 5, 6]
+    # The edited record's new row was appended after the originals
+    assert dataset.defect_ids.tolist()[-2:] == [2, 6]
+
+    # A different selection starts over
+    assert run(edited_only=False)["live"] == 5
+    assert len(training_data.TrainingDataset(str(directory))) == 5
+
+
+def test_parallel_build_writes_the_same_rows(setup, tmp_path, checkpoint):
+    db, run, directory = setup
+    run()
+    parallel = training_data.build(
+        db, str(tmp_path / "parallel"), os.path.join(checkpoint, "vocab_v2.json"),
+        training_data.image_spec(checkpoint), str(tmp_path / "outputs"), max_length=16, workers=2,
+    )
+    assert parallel["live"] == 5
+    serial, pooled = training_data.TrainingDataset(str(directory)), training_data.TrainingDataset(str(tmp_path / "parallel"))
+    for i in range(len(serial)):
+        assert np.array_equal(serial[i]["input_ids"], pooled[i]["input_ids"])
+        assert np.array_equal(serial[i]["pixel_values"], pooled[i]["pixel_values"])
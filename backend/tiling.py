@@ -0,0 +1,61 @@
+"""
+Tiled inference for high-resolution photos.
+
+The ViT processor squashes the whole photo to the encoder's input size, so a
+hairline crack in a 4000x3000 shot is a pixel or two wide by the time the
+model sees it. In tiled mode the photo is also cut into overlapping square
+tiles. Each tile is captioned alongside the usual global view, in the same
+encoder and decoder batch. Neighbouring tiles often show the same defect, so
+near-identical regional captions are merged and keep the boxes of every tile
+that produced them.
+"""
+import math
+from difflib import SequenceMatcher
+
+
+def _count(length, tile, overlap):
+    if length <= tile:
+        return 1
+    return math.ceil((length - tile) / (tile * (1 - overlap))) + 1
+
+
+def _positions(length, tile, count):
+    if count == 1:
+        return [0]
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def tile_boxes(width, height, tile_size, overlap=0.25, max_tiles=12):
+    """
+    (left, top, right, bottom) boxes of square tiles covering a width x height
+    image, neighbours overlapping by at least `overlap` of a tile. Tiles grow
+    past `tile_size` until at most `max_tiles` are needed. A single box means
+    the image is too small to be worth tiling.
+    """
+    tile = tile_size
+    while _count(width, tile, overlap) * _count(height, tile, overlap) > max_tiles:
+        tile = math.ceil(tile * 1.25)
+    tile_w, tile_h = min(tile, width), min(tile, height)
+    xs = _positions(width, tile_w, _count(width, tile, overlap))
+    ys = _positions(height, tile_h, _count(height, tile, overlap))
+    return [(x, y, x + tile_w, y + tile_h) for y in ys for x in xs]
+
+
+def merge_regions(regions, similarity=0.8):
+    """
+    Collapse (caption, box) pairs whose captions are at least `similarity`
+    alike (difflib ratio, which suits unsegmented Thai) into
+    {"caption", "boxes"} entries, in first-seen order. Empty captions are dropped.
+    """
+    merged = []
+    for caption, box in regions:
+        caption = caption.strip()
+        if not caption:
+            continue
+        for entry in merged:
+            if entry["caption"] == caption or SequenceMatcher(None, entry["caption"], caption).ratio() >= similarity:
+                entry["boxes"].append(list(box))
+                break
+        else:
+            merged.append({"caption": caption, "boxes": [list(box)]})
+    return merged
@@ -0,0 +1,79 @@
+import os
+import json
+import torch
+from transformers import (
+    GPT2Config,
+    ViTConfig,
+    ViTImageProcessor,
+    VisionEncoderDecoderConfig,
+    VisionEncoderDecoderModel,
+)
+
+# A handful of real caption words so decoded output looks like a Thai caption
+SAMPLE_WORDS = [
+    "รอยร้าว", "ผนัง", "เพดาน", "พื้น", "คราบ", "น้ำ", "รั่ว", "ซึม", "สี", "หลุดลอก",
+    "กระเบื้อง", "แตก", "ประตู", "หน้าต่าง", "ขอบ", "บัว", "ห้องน้ำ", "ห้องครัว", "ท่อ", "สนิม",
+    "ขนาด", "เล็ก", "ใหญ่", "บริเวณ", "มุม", "ด้าน", "ซ้าย", "ขวา", "บน", "ล่าง",
+    "มี", "พบ", "ที่", "และ", "ของ", "เป็น", "ทาง", "ยาว", "เชื้อรา", "ปูน",
+]
+
+
+def build_tiny_checkpoint(output_dir, image_size=224, hidden_size=64, num_layers=2, seed=0):
+    """
+    Write a randomly-initialized ViT-GPT2 checkpoint laid out exactly like
+    config.MODEL_PATH (weights, processor config, vocab_v2.json), so
+    ImageCaptioningEngine can load it on any CPU box without the real weights.
+
+    Captions are gibberish; only the shapes and code paths matter.
+    """
+    torch.manual_seed(seed)
+    special = ["<pad>", "<s>", "</s>", "<unk>"]
+    vocab = {token: i for i, token in enumerate(special + SAMPLE_WORDS)}
+
+    encoder = ViTConfig(
+        hidden_size=hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        intermediate_size=hidden_size * 4,
+        image_size=image_size,
+        patch_size=16,
+    )
+    decoder = GPT2Config(
+        vocab_size=len(vocab),
+        n_embd=hidden_size,
+        n_layer=num_layers,
+        n_head=4,
+        n_positions=128,
+        is_decoder=True,
+        add_cross_attention=True,
+        bos_token_id=vocab["<s>"],
+        eos_token_id=vocab["</s>"],
+        pad_token_id=vocab["<pad>"],
+    )
+    model_config = VisionEncoderDecoderConfig.from_encoder_decoder_configs(encoder, decoder)
+    model_config.decoder_start_token_id = vocab["<s>"]
+    model_config.eos_token_id = vocab["</s>"]
+    model_config.pad_token_id = vocab["<pad>"]
+
+    model = VisionEncoderDecoderModel(config=model_config)
+    model.generation_config.decoder_start_token_id = vocab["<s>"]
+    model.generation_config.eos_token_id = vocab["</s>"]
+    model.generation_config.pad_token_id = vocab["<pad>"]
+
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(output_dir)
+    ViTImageProcessor(size={"height": image_size, "width": image_size}).save_pretrained(output_dir)
+    with open(os.path.join(output_dir, "vocab_v2.json"), "w", encoding="utf-8") as f:
+        json.dump(vocab, f, ensure_ascii=False, indent=2)
+    return output_dir
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build a tiny random ViT-GPT2 checkpoint for tests and benchmarks")
+    parser.add_argument("output_dir")
+    parser.add_argument("--image-size", type=int, default=224)
+    args = parser.parse_args()
+    build_tiny_checkpoint(args.output_dir, image_size=args.image_size)
+    print(f"✅ Tiny checkpoint written to {args.output_dir}")
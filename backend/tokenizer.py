@@ -80,6 +80,9 @@ class ThaiTokenizerV2:
     def batch_decode(self, sequences, skip_special_tokens=False):
         return [self.decode(ids, skip_special_tokens) for ids in sequences]
 
+    def detokenizer(self, skip_special_tokens=True):
+        return IncrementalDetokenizer(self, skip_special_tokens=skip_special_tokens)
+
     # --- Properties for compatibility ---
     @property
     def pad_token_id(self): return self.vocab[self.pad_token]
@@ -144,3 +147,33 @@ class ThaiTokenizerV2:
                 return self.data
         
         return BatchEncoding(batch_input_ids)
+
+
+class IncrementalDetokenizer:
+    """
+    Turns a growing (or, for beam search, changing) sequence of token ids into
+    text updates without re-decoding the whole caption each step. Words map to
+    text one-to-one, so only ids past the shared prefix need decoding.
+    """
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.ids = []
+        self.pieces = []
+
+    def update(self, token_ids):
+        """
+        Feed the latest full hypothesis. Returns (text, delta, reset): the
+        full caption so far, the newly appended text, and whether earlier
+        text was replaced (the best beam switched to a different prefix).
+        """
+        common = 0
+        limit = min(len(self.ids), len(token_ids))
+        while common < limit and self.ids[common] == token_ids[common]:
+            common += 1
+        reset = common < len(self.ids)
+
+        new_pieces = [self.tokenizer.decode([i], skip_special_tokens=self.skip_special_tokens) for i in token_ids[common:]]
+        self.ids = list(token_ids)
+        self.pieces = self.pieces[:common] + new_pieces
+        return "".join(self.pieces), "".join(new_pieces), reset
@@ -0,0 +1,398 @@
+"""
+Tokenized, memory-mapped fine-tuning data built from DefectRecords.
+
+    python training_data.py                  # captions corrected by hand (user_edited)
+    python training_data.py --all --workers 8
+
+Every usable record becomes one row. Its caption goes through
+ThaiTokenizerV2.__call__ (truncated and padded to max_length) and is stored
+as int32. Its photo is resized the way the model's ViTImageProcessor
+resizes it and stored as uint8 [3, H, W]. Rows live in fixed-size shard
+files (captions_00000.i32, pixels_00000.u8), with an index of defect_id,
+version and token count per row, and dataset.json holding the shapes,
+normalization constants and build state. TrainingDataset reads rows as
+zero-copy slices of the memory maps, so an epoch does no tokenizing or
+JPEG decoding.
+
+Builds are incremental. dataset.json records the change-feed version
+(sync.py) the data has caught up to, and the next build streams only the
+records written since then. An edited record is appended again and its old
+row is tombstoned (defect_id -1, as in the embedding store). Rows of deleted
+records are tombstoned too. A build with a different vocabulary, image
+size, max_length or selection starts from scratch. Tokenizing and image
+decoding run in a process pool, and each worker writes its rows straight
+into the shard files.
+"""
+import os
+import json
+import glob
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from sqlmodel import Session, select
+
+import sync
+from models import DefectRecord, Tombstone
+from tokenizer import ThaiTokenizerV2
+
+SHARD_ROWS = 1024
+CHUNK = 64
+META_FILE = "dataset.json"
+_INITIAL_CAPACITY = 1024
+_INDEX = (("defect_ids.i64", np.int64), ("versions.i64", np.int64), ("lengths.i32", np.int32))
+
+
+def _shard_file(directory, kind, shard):
+    return os.path.join(directory, f"{kind}_{shard:05d}." + ("i32" if kind == "captions" else "u8"))
+
+
+def _shard_shape(spec, kind):
+    if kind == "captions":
+        return (spec["shard_rows"], spec["max_length"])
+    return (spec["shard_rows"], 3, spec["height"], spec["width"])
+
+
+def _open_shard(directory, spec, kind, shard, mode):
+    dtype = np.int32 if kind == "captions" else np.uint8
+    return np.memmap(_shard_file(directory, kind, shard), dtype=dtype, mode=mode, shape=_shard_shape(spec, kind))
+
+
+def image_spec(model_dir):
+    """Resize and normalization settings of the checkpoint's ViTImageProcessor."""
+    from transformers import ViTImageProcessor
+
+    processor = ViTImageProcessor.from_pretrained(model_dir)
+    return {
+        "height": processor.size["height"],
+        "width": processor.size["width"],
+        "resample": int(processor.resample),
+        "image_mean": list(processor.image_mean),
+        "image_std": list(processor.image_std),
+    }
+
+
+# --- Workers ---
+
+_tokenizer = None
+
+
+def _init_worker(vocab_file, tokenizer=None):
+    global _tokenizer
+    _tokenizer = tokenizer or ThaiTokenizerV2(vocab_file=vocab_file)
+
+
+def _load_pixels(path, spec):
+    with Image.open(path) as image:
+        # JPEGs decode straight at a reduced scale that still covers the target size
+        image.draft("RGB", (spec["width"], spec["height"]))
+        image = image.convert("RGB").resize((spec["width"], spec["height"]), Image.Resampling(spec["resample"]))
+    return np.asarray(image).transpose(2, 0, 1)
+
+
+def _encode_chunk(job):
+    """
+    Tokenize and resize one chunk of (caption, photo path) records into rows
+    start.. of the shards. Returns each row's token count, -1 where the photo
+    could not be read.
+    """
+    directory, spec, start, records = job
+    ids = np.asarray(
+        _tokenizer([caption for caption, _ in records], padding="max_length", max_length=spec["max_length"]).input_ids,
+        dtype=np.int32,
+    )
+    lengths = np.count_nonzero(ids != spec["pad_token_id"], axis=1)
+    shards = {}
+    for i, (_, path) in enumerate(records):
+        shard, offset = divmod(start + i, spec["shard_rows"])
+        if shard not in shards:
+            shards[shard] = (_open_shard(directory, spec, "captions", shard, "r+"),
+                             _open_shard(directory, spec, "pixels", shard, "r+"))
+        captions, pixels = shards[shard]
+        try:
+            pixels[offset] = _load_pixels(path, spec)
+        except Exception as e:
+            print(f"⚠️ Training data skipped {path}: {e}")
+            lengths[i] = -1
+            continue
+        captions[offset] = ids[i]
+    for captions, pixels in shards.values():
+        captions.flush()
+        pixels.flush()
+    return lengths.tolist()
+
+
+# --- Storage ---
+
+class _Store:
+    """Shard files plus the per-row index, written by the build's main process."""
+
+    def __init__(self, directory, spec):
+        self.directory = directory
+        self.spec = spec
+        self.count = 0
+        self.capacity = 0
+        self.version = 0
+        self.shards = 0
+        self._columns = None
+        self._row_of = {}
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, META_FILE)
+        meta = None
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+        if meta is not None and meta["spec"] == spec:
+            self.count, self.capacity, self.version, self.shards = (
+                meta["count"], meta["capacity"], meta["version"], meta["shards"]
+            )
+            self._open()
+            ids = np.asarray(self._columns[0][:self.count])
+            live = np.flatnonzero(ids >= 0)
+            self._row_of = dict(zip(ids[live].tolist(), live.tolist()))
+        else:
+            if meta is not None:
+                print("♻️ Vocabulary, image size or selection changed; rebuilding training data")
+            self._clear()
+
+    def _clear(self):
+        patterns = ["captions_*.i32", "pixels_*.u8", META_FILE] + [name for name, _ in _INDEX]
+        for pattern in patterns:
+            for path in glob.glob(os.path.join(self.directory, pattern)):
+                os.remove(path)
+
+    def _open(self):
+        self._columns = [
+            np.memmap(os.path.join(self.directory, name), dtype=dtype, mode="r+", shape=(self.capacity,))
+            for name, dtype in _INDEX
+        ]
+
+    def reserve(self, end):
+        """Make room for rows up to `end`: grow the index and create missing shard files."""
+        if end > self.capacity:
+            capacity = max(_INITIAL_CAPACITY, self.capacity)
+            while capacity < end:
+                capacity *= 2
+            if self._columns is not None:
+                for column in self._columns:
+                    column.flush()
+            for name, dtype in _INDEX:
+                with open(os.path.join(self.directory, name), "ab") as f:
+                    f.truncate(capacity * np.dtype(dtype).itemsize)
+            self.capacity = capacity
+            self._open()
+        while self.shards * self.spec["shard_rows"] < end:
+            for kind, dtype in (("captions", np.int32), ("pixels", np.uint8)):
+                with open(_shard_file(self.directory, kind, self.shards), "ab") as f:
+                    f.truncate(int(np.prod(_shard_shape(self.spec, kind))) * np.dtype(dtype).itemsize)
+            self.shards += 1
+
+    def remove(self, defect_id):
+        row = self._row_of.pop(defect_id, None)
+        if row is not None:
+            self._columns[0][row] = -1
+        return row is not None
+
+    def commit(self, start, records, lengths):
+        """Index the rows a worker filled; returns (added, replaced)."""
+        defect_ids, versions, token_counts = self._columns
+        added = replaced = 0
+        for row, ((defect_id, version), length) in enumerate(zip(records, lengths), start=start):
+            versions[row] = version
+            token_counts[row] = length
+            if length < 0:
+                defect_ids[row] = -1
+                continue
+            replaced += self.remove(defect_id)
+            added += 1
+            defect_ids[row] = defect_id
+            self._row_of[defect_id] = row
+        self.count = start + len(records)
+        return added, replaced
+
+    def __len__(self):
+        return len(self._row_of)
+
+    def save(self):
+        if self._columns is not None:
+            for column in self._columns:
+                column.flush()
+        meta = {
+            "spec": self.spec, "count": self.count, "capacity": self.capacity,
+            "version": self.version, "shards": self.shards, "live": len(self),
+        }
+        tmp = os.path.join(self.directory, META_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp, os.path.join(self.directory, META_FILE))
+
+
+# --- Build ---
+
+def _usable(defect, edited_only):
+    return (
+        defect.status == "done" and bool(defect.caption) and bool(defect.image_path)
+        and (bool(defect.user_edited) or not edited_only)
+    )
+
+
+def build(db_engine, directory, vocab_file, images, outputs_dir, max_length=None, edited_only=True, workers=None):
+    """
+    Bring the dataset in `directory` up to date with the database. `images`
+    is an image_spec() dict and photos are read from `outputs_dir`. Returns
+    counts of rows added, replaced (edited records), removed and skipped
+    (unreadable photos), plus the live total.
+    """
+    tokenizer = ThaiTokenizerV2(vocab_file=vocab_file)
+    with open(vocab_file, "rb") as f:
+        vocab_hash = hashlib.file_digest(f, "sha1").hexdigest()
+    spec = {
+        **images,
+        "max_length": max_length or tokenizer.model_max_length,
+        "pad_token_id": tokenizer.pad_token_id,
+        "vocab_sha1": vocab_hash,
+        "edited_only": edited_only,
+        "shard_rows": SHARD_ROWS,
+    }
+    store = _Store(directory, spec)
+    counts = {"added": 0, "replaced": 0, "removed": 0, "skipped": 0}
+
+    with Session(db_engine) as session:
+        target = sync.current_version(session)
+        since = store.version
+        deleted = session.exec(
+            select(Tombstone.row_id).where(Tombstone.kind == "defect", Tombstone.version > since, Tombstone.version <= target)
+        ).all()
+    counts["removed"] += sum(store.remove(defect_id) for defect_id in deleted)
+
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(vocab_file,)) if workers > 1 else None
+    if pool is None:
+        _init_worker(vocab_file, tokenizer)
+    pending = deque()
+    next_row = store.count
+
+    def finish_oldest():
+        future, start, records, version = pending.popleft()
+        lengths = future.result() if pool is not None else future
+        added, replaced = store.commit(start, records, lengths)
+        counts["added"] += added - replaced
+        counts["replaced"] += replaced
+        counts["skipped"] += sum(1 for length in lengths if length < 0)
+        # Everything up to this chunk is on disk, so a crash resumes after it
+        store.version = version
+        store.save()
+
+    def submit(chunk):
+        nonlocal next_row
+        start, next_row = next_row, next_row + len(chunk)
+        store.reserve(next_row)
+        job = (directory, spec, start, [(d.caption, os.path.join(outputs_dir, d.image_path)) for d in chunk])
+        result = pool.submit(_encode_chunk, job) if pool is not None else _encode_chunk(job)
+        pending.append((result, start, [(d.id, d.version) for d in chunk], chunk[-1].version))
+        while len(pending) > 2 * workers:
+            finish_oldest()
+
+    try:
+        with Session(db_engine) as session:
+            query = (
+                select(DefectRecord)
+                .where(DefectRecord.version > since, DefectRecord.version <= target)
+                .order_by(DefectRecord.version)
+                .execution_options(yield_per=CHUNK)
+            )
+            chunk = []
+            for defect in session.exec(query):
+                if not _usable(defect, edited_only):
+                    # No longer qualifies (e.g. failed or emptied); drop any earlier row
+                    counts["removed"] += store.remove(defect.id)
+                    continue
+                chunk.append(defect)
+                if len(chunk) == CHUNK:
+                    submit(chunk)
+                    chunk = []
+            if chunk:
+                submit(chunk)
+        while pending:
+            finish_oldest()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    store.version = target
+    store.save()
+    counts["live"] = len(store)
+    return counts
+
+
+# --- Reading ---
+
+class TrainingDataset:
+    """
+    Map-style dataset over a built directory. Items are {"defect_id",
+    "input_ids" (int32 [max_length]), "pixel_values" (uint8 [3, H, W])},
+    all views of the memory-mapped shards. normalize() turns a batch of
+    uint8 pixels into the processor's float input.
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.spec = meta["spec"]
+        ids = np.memmap(os.path.join(directory, _INDEX[0][0]), dtype=np.int64, mode="r", shape=(meta["capacity"],))
+        self.rows = np.flatnonzero(ids[:meta["count"]] >= 0)
+        self.defect_ids = np.asarray(ids[self.rows])
+        # Copy-on-write maps: zero-copy reads, and torch accepts them as writable arrays
+        self._captions = [_open_shard(directory, self.spec, "captions", s, "c") for s in range(meta["shards"])]
+        self._pixels = [_open_shard(directory, self.spec, "pixels", s, "c") for s in range(meta["shards"])]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        shard, offset = divmod(int(self.rows[index]), self.spec["shard_rows"])
+        return {
+            "defect_id": int(self.defect_ids[index]),
+            "input_ids": self._captions[shard][offset],
+            "pixel_values": self._pixels[shard][offset],
+        }
+
+    def normalize(self, pixel_values):
+        """uint8 [..., 3, H, W] tensor -> float32 scaled and normalized like ViTImageProcessor."""
+        import torch
+
+        mean = torch.tensor(self.spec["image_mean"]).view(3, 1, 1)
+        std = torch.tensor(self.spec["image_std"]).view(3, 1, 1)
+        return (pixel_values.float() / 255.0 - mean) / std
+
+
+def main(argv=None):
+    import config
+    import database
+
+    parser = argparse.ArgumentParser(description="Build or update memory-mapped fine-tuning data from DefectRecords")
+    parser.add_argument("--out", default=os.path.join(config.BACKEND_DIR, "training_data"))
+    parser.add_argument("--model-dir", default=config.MODEL_PATH, help="Checkpoint whose tokenizer and image size to use")
+    parser.add_argument("--all", action="store_true", help="Include model captions, not only ones corrected by hand")
+    parser.add_argument("--max-length", type=int, default=None, help="Token length (default: the tokenizer's)")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per core)")
+    args = parser.parse_args(argv)
+
+    database.create_db_and_tables()
+    counts = build(
+        database.engine, args.out,
+        vocab_file=os.path.join(args.model_dir, "vocab_v2.json"),
+        images=image_spec(args.model_dir),
+        outputs_dir=os.path.join(config.BACKEND_DIR, "outputs"),
+        max_length=args.max_length,
+        edited_only=not args.all,
+        workers=args.workers,
+    )
+    print(f"✅ Training data in {args.out}: {counts}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
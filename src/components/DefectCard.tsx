@@ -78,7 +78,7 @@ export const DefectCard: React.FC<DefectCardProps> = ({ data }) => {
                     {isDone && (
                         <div className="flex items-center gap-1 text-xs font-bold text-slate-700">
                             <span className="text-slate-400 font-normal text-[10px] uppercase tracking-wider">Confidence</span>
-                            {(data.confidence * 100).toFixed(0)}%
+                            {data.confidence == null ? "–" : `${(data.confidence * 100).toFixed(0)}%`}
                         </div>
                     )}
                 </div>
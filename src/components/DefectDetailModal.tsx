@@ -187,7 +187,7 @@ const ModalContent: React.FC<ModalContentProps> = ({ analysis, onUpdate, onDelet
                         </div>
                         <div className="text-right">
                             <div className="text-3xl font-bold text-slate-800">
-                                {(analysis.confidence * 100).toFixed(1)}<span className="text-lg text-slate-400">%</span>
+                                {analysis.confidence == null ? "–" : <>{(analysis.confidence * 100).toFixed(1)}<span className="text-lg text-slate-400">%</span></>}
                             </div>
                             <p className="text-[10px] text-slate-400 uppercase tracking-widest font-bold">Confidence</p>
                         </div>
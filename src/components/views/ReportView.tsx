@@ -111,7 +111,7 @@ export const ReportView: React.FC = () => {
                                         }`}>{defect.room}</div>
                                 </div>
                                 <div className="text-xs font-mono opacity-60">
-                                    {(defect.confidence * 100).toFixed(0)}%
+                                    {defect.confidence == null ? "–" : `${(defect.confidence * 100).toFixed(0)}%`}
                                 </div>
                             </div>
                         ))
@@ -10,6 +10,12 @@ const LABEL_MAP_EN: Record<string, string> = {
     'unknown': 'Unknown Defect',
 };
 
+const STATUS_MAP: Record<string, DefectAnalysisUI['status']> = {
+    'pending': 'processing',
+    'captioning': 'processing',
+    'failed': 'error',
+};
+
 export const defectMapper = {
     toUI: (dbResponse: InferenceResponseDB, id: string, imageUrl: string): DefectAnalysisUI => {
         // Use caption from model if available (Thai text), otherwise fallback to mapped label
@@ -46,7 +52,7 @@ export const defectMapper = {
             confidence: record.confidence,
             room: (record.room as any) || 'General',
             timestamp: new Date(record.timestamp),
-            status: 'done',
+            status: STATUS_MAP[record.status ?? 'done'] ?? 'done',
             severity: record.severity,
         };
     }
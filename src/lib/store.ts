@@ -1,8 +1,9 @@
 import { create } from 'zustand';
 import { persist, createJSONStorage } from 'zustand/middleware';
-import type { DefectAnalysisUI, ProjectStats, Project } from '../types/defect';
+import type { DefectAnalysisUI, ProjectStats, Project, SyncResponse } from '../types/defect';
 import { defectService } from '../services/defectService';
 import { projectService } from '../services/projectService';
+import { syncService } from '../services/syncService';
 import { defectMapper } from './mappers/defectMapper';
 
 export type AppView = 'home' | 'history' | 'report';
@@ -14,6 +15,9 @@ interface AppState {
     currentView: AppView;
     projects: Project[];
     currentProjectId: number | null;
+    // Change-feed cursor for the persisted analyses (see backend/sync.py)
+    syncVersion: number;
+    syncProjectId: number | null;
 
     addAnalysis: (analysis: DefectAnalysisUI) => void;
     updateAnalysis: (id: string, updates: Partial<DefectAnalysisUI>) => void;
@@ -42,6 +46,18 @@ const calculateStats = (analyses: DefectAnalysisUI[]): ProjectStats => {
     };
 };
 
+// Merge a change-feed delta into the cached analyses, newest first like /defects.
+// Local placeholder entries (non-numeric ids) are dropped; their saved records arrive in the delta.
+const applySyncDelta = (analyses: DefectAnalysisUI[], delta: SyncResponse): DefectAnalysisUI[] => {
+    const changed = delta.defects.map(defectMapper.fromBackend);
+    const replaced = new Set([...changed.map((a) => a.id), ...delta.deleted.defects.map(String)]);
+    const deleted = new Set(delta.deleted.defects.map(String));
+    return [
+        ...changed.filter((a) => !deleted.has(a.id)),
+        ...analyses.filter((a) => !isNaN(Number(a.id)) && !replaced.has(a.id)),
+    ].sort((a, b) => new Date(b.timestamp).getTime() - new Date(a.timestamp).getTime());
+};
+
 const initialStats: ProjectStats = {
     totalDefects: 0,
     processedCount: 0,
@@ -57,6 +73,8 @@ export const useStore = create<AppState>()(
             currentView: 'home',
             projects: [],
             currentProjectId: null,
+            syncVersion: 0,
+            syncProjectId: null,
 
             addAnalysis: (analysis: DefectAnalysisUI) => set((state: AppState) => {
                 const newAnalyses = [analysis, ...state.analyses];
@@ -121,10 +139,26 @@ export const useStore = create<AppState>()(
             },
 
             switchProject: async (projectId: number) => {
-                set({ currentProjectId: projectId, analyses: [] }); // Clear current view
+                const state = get();
+                // The persisted analyses belong to this project: only fetch what changed since
+                const since = state.syncProjectId === projectId ? state.syncVersion : 0;
+                if (since === 0) {
+                    set({ currentProjectId: projectId, analyses: [] }); // Clear current view
+                } else {
+                    set({ currentProjectId: projectId });
+                }
+
+                const delta = await syncService.changesSince(since, projectId);
+                if (delta) {
+                    const analyses = applySyncDelta(since === 0 ? [] : get().analyses, delta);
+                    set({ analyses, stats: calculateStats(analyses), syncVersion: delta.version, syncProjectId: projectId });
+                    return;
+                }
+
+                // Sync unavailable: fall back to a full fetch and start over next time
                 const records = await defectService.getAll(projectId);
                 const analyses = records.map(defectMapper.fromBackend);
-                set({ analyses, stats: calculateStats(analyses) });
+                set({ analyses, stats: calculateStats(analyses), syncVersion: 0, syncProjectId: null });
             },
 
             deleteProject: async (projectId: number) => {
@@ -152,7 +186,9 @@ export const useStore = create<AppState>()(
             partialize: (state) => ({
                 analyses: state.analyses,
                 stats: state.stats,
-                currentProjectId: state.currentProjectId
+                currentProjectId: state.currentProjectId,
+                syncVersion: state.syncVersion,
+                syncProjectId: state.syncProjectId
                 // Don't persist projects list, fetch fresh on init
             }),
         }
@@ -0,0 +1,41 @@
+import { CONFIG } from '../config';
+import type { SyncResponse } from '../types/defect';
+import { apiFetch } from './apiFetch';
+
+export const syncService = {
+    // Fetch every change after `since` (following pages until the feed is drained).
+    // Returns null on failure so callers can fall back to a full fetch.
+    changesSince: async (since: number, projectId?: number): Promise<SyncResponse | null> => {
+        try {
+            const merged: SyncResponse = {
+                version: since,
+                has_more: false,
+                projects: [],
+                defects: [],
+                deleted: { projects: [], defects: [] },
+            };
+            let cursor = since;
+            let hasMore = true;
+            while (hasMore) {
+                const params = new URLSearchParams({ since: String(cursor) });
+                if (projectId) params.set('project_id', String(projectId));
+
+                const response = await apiFetch(`${CONFIG.apiUrl}/sync?${params}`);
+                if (!response.ok) throw new Error('Failed to sync');
+                const page: SyncResponse = await response.json();
+
+                merged.projects.push(...page.projects);
+                merged.defects.push(...page.defects);
+                merged.deleted.projects.push(...page.deleted.projects);
+                merged.deleted.defects.push(...page.deleted.defects);
+                merged.version = page.version;
+                cursor = page.version;
+                hasMore = page.has_more;
+            }
+            return merged;
+        } catch (error) {
+            console.error('Error syncing changes:', error);
+            return null;
+        }
+    },
+};
@@ -2,7 +2,7 @@ export type DefectSeverity = 'low' | 'medium' | 'high' | 'critical';
 
 export interface InferenceResponseDB {
     label: string;
-    confidence: number;
+    confidence: number | null; // null when the backend could not measure it
     caption?: string;
     bbox?: number[];
 }
@@ -14,7 +14,7 @@ export interface DefectAnalysisUI {
     imageUrl: string;
     labelThai: string;
     labelEn: string;
-    confidence: number;
+    confidence: number | null; // null when the backend could not measure it
     room: RoomType;
     timestamp: Date;
     status: 'processing' | 'done' | 'error';
@@ -32,12 +32,14 @@ export interface DefectRecordBackend {
     filename: string;
     caption: string;
     label: string;
-    confidence: number;
+    confidence: number | null; // null when the backend could not measure it
     timestamp: string; // ISO string from backend
     image_path: string;
     room?: string;
     severity?: string;
     project_id?: number;
+    status?: 'pending' | 'captioning' | 'done' | 'failed';
+    regions?: { caption: string; boxes: number[][] }[]; // Tiled /predict only: [left, top, right, bottom] per tile
 }
 
 export interface Project {
@@ -45,4 +47,16 @@ export interface Project {
     name: string;
     address?: string;
     created_at: string;
+    archive_path?: string | null; // Set while the project is archived (read-only until restored)
+}
+
+export interface SyncResponse {
+    version: number;
+    has_more: boolean;
+    projects: Project[];
+    defects: DefectRecordBackend[];
+    deleted: {
+        projects: number[];
+        defects: number[];
+    };
 }